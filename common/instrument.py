@@ -0,0 +1,188 @@
+import os
+import json
+import argparse
+import time
+import threading
+import subprocess
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+    Bộ đếm thời gian / bộ đếm theo stage, ghi từng sự kiện ra file JSONL.
+
+    Tắt mặc định (timer gần như không tốn gì); bật bằng biến môi trường
+    ADNI_TRACE=<file.jsonl> hoặc configure(path). Mỗi tiến trình (kể cả worker
+    của DataLoader, tiến trình con của preprocessing) ghi nối vào cùng một file,
+    summarize(path) gộp lại thành bảng.
+    """
+    def __init__(self, path=None):
+        self.path = None
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.configure(path or os.environ.get("ADNI_TRACE"))
+
+    def configure(self, path):
+        self.close()
+        self.path = path
+        if path:
+            # tiến trình con (worker DataLoader, subprocess) kế thừa cấu hình qua môi trường
+            os.environ["ADNI_TRACE"] = path
+        return self
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _write(self, record):
+        with self._lock:
+            if self._pid != os.getpid():
+                # sau fork: mở lại file riêng cho tiến trình này
+                self._file = open(self.path, "a", buffering=1)
+                self._pid = os.getpid()
+            self._file.write(json.dumps(record) + "\n")
+
+    def _aggregate(self, stats, name, value):
+        with self._lock:
+            _add(stats, name, value)
+
+    def record(self, stage, seconds, **tags):
+        if not self.enabled:
+            return
+        self._aggregate(self.timers, stage, seconds)
+        self._write({"stage": stage, "seconds": seconds, "pid": os.getpid(), "time": time.time(), **tags})
+
+    def count(self, name, n=1, **tags):
+        if not self.enabled:
+            return
+        self._aggregate(self.counters, name, n)
+        self._write({"counter": name, "value": n, "pid": os.getpid(), "time": time.time(), **tags})
+
+    @contextmanager
+    def timer(self, stage, sync=False, **tags):
+        """
+        with trace.timer("train.forward"): ...
+        sync=True gọi torch.cuda.synchronize() trước khi dừng đồng hồ (đo đúng thời gian GPU).
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if sync:
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+            self.record(stage, time.perf_counter() - start, **tags)
+
+    def run(self, cmd, stage=None, **kwargs):
+        """ subprocess.run có đo thời gian, stage mặc định là tên lệnh (bet, dtifit, flirt, dcm2niix...). """
+        with self.timer(stage or os.path.basename(str(cmd[0])), cmd=" ".join(map(str, cmd))):
+            return subprocess.run(cmd, **kwargs)
+
+    def iterate(self, iterable, stage="train.data_wait"):
+        """ Bọc DataLoader: đo thời gian chờ batch tiếp theo (data-wait) của vòng lặp train. """
+        it = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self):
+        return format_table(self.timers, self.counters)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+            self._pid = None
+
+
+def _add(stats, name, value):
+    s = stats.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+    s["count"] += 1
+    s["total"] += value
+    s["max"] = max(s["max"], value)
+
+
+def summarize(path):
+    """ Gộp file JSONL (của mọi tiến trình) thành (timers, counters), mỗi mục {count, total, max}. """
+    timers, counters = {}, {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if "stage" in record:
+                _add(timers, record["stage"], record["seconds"])
+            else:
+                _add(counters, record["counter"], record["value"])
+    return timers, counters
+
+
+def format_table(timers, counters=None):
+    lines = [f"{'stage':<28} {'count':>8} {'total(s)':>10} {'mean(ms)':>10} {'max(ms)':>10}"]
+    for name, s in sorted(timers.items(), key=lambda kv: -kv[1]["total"]):
+        mean = s["total"] / max(s["count"], 1)
+        lines.append(f"{name:<28} {s['count']:>8} {s['total']:>10.2f} {mean * 1000:>10.2f} {s['max'] * 1000:>10.2f}")
+    if counters:
+        lines.append(f"{'counter':<28} {'total':>8}")
+        for name, s in sorted(counters.items()):
+            lines.append(f"{name:<28} {s['total']:>8g}")
+    return "\n".join(lines)
+
+
+class StepProfiler:
+    """
+    torch.profiler cho N bước train (bỏ qua `wait` bước, khởi động `warmup` bước).
+    steps=0: không làm gì. Gọi step() sau mỗi batch; kết quả cho TensorBoard trong out_dir.
+    """
+    def __init__(self, steps=0, out_dir="profile", wait=1, warmup=1):
+        self.profiler = None
+        if steps > 0:
+            import torch
+            import torch.profiler as tp
+            activities = [tp.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(tp.ProfilerActivity.CUDA)
+            self.profiler = tp.profile(
+                activities=activities,
+                schedule=tp.schedule(wait=wait, warmup=warmup, active=steps, repeat=1),
+                on_trace_ready=tp.tensorboard_trace_handler(out_dir),
+                record_shapes=True,
+                profile_memory=True,
+            )
+
+    def __enter__(self):
+        if self.profiler is not None:
+            self.profiler.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler.__exit__(*exc)
+
+    def step(self):
+        if self.profiler is not None:
+            self.profiler.step()
+
+
+trace = Tracer()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In bảng tổng hợp thời gian từ file trace JSONL.")
+    parser.add_argument("trace")
+    args = parser.parse_args()
+    print(format_table(*summarize(args.trace)))
+
+
+if __name__ == "__main__":
+    main()
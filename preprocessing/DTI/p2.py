@@ -1,31 +1,16 @@
 import os
+import sys
 import pandas as pd 
-import random
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from splits import augmentation_manifest, DTI_SKIP_PROB
 
-df = pd.read_csv('data/train.csv')
-df1 = pd.DataFrame(columns=df.columns)
-random.seed(46) 
 
-# duyệt qua từng hàng trong DataFrame
-for index, row in df.iterrows():
-    if row['diagnosis'] == 2:
-        if random.random() < 0.7:
-            continue
-    elif row['diagnosis'] == 3:
-        if random.random() < 0.2:
-            continue
-    else:
-        continue
+df = pd.read_csv('data/train.csv')
 
-    # chọn ngẫu nhiên 1 số từ 1 đến 3:
-    num = random.randint(1, 3)
-    for i in range(1, num + 1):
-        dti_link = f'{row["dti_link"]}/{i}'
-        mri_link = f'{row["mri_link"]}/{i}'
-        df1.loc[len(df1)] = [row['diagnosis'], row['ptdobyy'], row['ptgender'], dti_link, mri_link]
+# nhãn 2 giữ lại với xác suất 0.3, nhãn 3 với xác suất 0.8; mỗi dòng giữ lại sinh 1-3 bản sao (seed 46)
+df1 = augmentation_manifest(df, DTI_SKIP_PROB, seed=46)
 
 # lưu df1 vào file CSV
 df1.to_csv('data/train_augmented.csv', index=False)
 print("Done")
-    
\ No newline at end of file
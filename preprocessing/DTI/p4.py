@@ -6,7 +6,14 @@ import pandas as pd
 import glob
 from nipype.interfaces import fsl
 import nibabel.orientations as nio
-import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+from scratch import ScratchDir, fsl_env
+from instrument import trace
+from registration import ENGINE, register_file_pooled
 
 
 # df = pd.read_csv('data/train.csv')
@@ -14,27 +21,42 @@ import subprocess
 df = pd.read_csv('data/test.csv')
 
 
-def dicom_to_nifti(path, save_path):
+def read_pixels(dcm_file, out):
+    """ Giải mã pixel của một lát cắt thẳng vào mảng int16 đã cấp phát sẵn. """
+    np.copyto(out, pydicom.dcmread(dcm_file).pixel_array, casting="unsafe")
+
+
+def dicom_to_nifti(path, save_path, workers=8):
+    """
+    Chuyển một series DICOM sang NIfTI.
+
+    Chỉ đọc header (stop_before_pixels) để tính thứ tự lát cắt và affine bằng NumPy,
+    sau đó giải mã pixel song song bằng thread vào một mảng int16 cấp phát trước;
+    không có bước ép kiểu sang float64.
+    """
     dcm_files = glob.glob(os.path.join(path, "*.dcm"))
-    slices = [pydicom.dcmread(f) for f in dcm_files]
+    headers = [pydicom.dcmread(f, stop_before_pixels=True) for f in dcm_files]
 
-    if not all(hasattr(s, "ImagePositionPatient") and hasattr(s, "ImageOrientationPatient") for s in slices):
+    if not all(hasattr(h, "ImagePositionPatient") and hasattr(h, "ImageOrientationPatient") for h in headers):
         raise ValueError("Thiếu ImagePositionPatient hoặc ImageOrientationPatient trong DICOM")
 
-    orientation = np.array(slices[0].ImageOrientationPatient).reshape(2, 3)
+    orientation = np.array(headers[0].ImageOrientationPatient, dtype=np.float64).reshape(2, 3)
     row_cosine, col_cosine = orientation
     normal = np.cross(row_cosine, col_cosine)
 
-    positions = np.array([s.ImagePositionPatient for s in slices])
+    positions = np.array([h.ImagePositionPatient for h in headers], dtype=np.float64)
     distances = positions @ normal
-    sorted_slices = [s for _, s in sorted(zip(distances, slices), key=lambda x: x[0])]
+    order = np.argsort(distances, kind="stable")
 
-    img3d = np.stack([s.pixel_array for s in sorted_slices]).astype(np.int16)
+    img3d = np.empty((len(headers), int(headers[0].Rows), int(headers[0].Columns)), dtype=np.int16)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() để exception của thread được ném ra ở đây
+        list(executor.map(read_pixels, [dcm_files[i] for i in order], img3d))
     img3d = np.transpose(img3d, (2, 1, 0))
 
-    spacing = list(map(float, slices[0].PixelSpacing))
+    spacing = list(map(float, headers[0].PixelSpacing))
     try:
-        slice_thickness = float(slices[0].SliceThickness)
+        slice_thickness = float(headers[0].SliceThickness)
     except:
         slice_thickness = np.abs(distances[1] - distances[0])
 
@@ -42,7 +64,7 @@ def dicom_to_nifti(path, save_path):
     affine[:3, 0] = row_cosine * spacing[1]
     affine[:3, 1] = col_cosine * spacing[0]
     affine[:3, 2] = normal * slice_thickness
-    affine[:3, 3] = slices[0].ImagePositionPatient
+    affine[:3, 3] = headers[0].ImagePositionPatient
 
     # Chuẩn hóa hướng ảnh về RAS
     affine[0, :] *= -1  # L->R
@@ -56,15 +78,22 @@ def dicom_to_nifti(path, save_path):
     nib.save(nii_img, save_path)
 
 def reorient_to_RAS(img):
+    """ Đưa ảnh về RAS bằng lật/hoán vị trục, giữ nguyên kiểu dữ liệu (không get_fdata). """
     current_ornt = nio.io_orientation(img.affine)
     ras_ornt = nio.axcodes2ornt(('R', 'A', 'S'))
     transform = nio.ornt_transform(current_ornt, ras_ornt)
-    reoriented_data = nio.apply_orientation(img.get_fdata(), transform)
+    reoriented_data = nio.apply_orientation(np.asanyarray(img.dataobj), transform)
     new_affine = img.affine @ nio.inv_ornt_aff(transform, img.shape)
     return nib.Nifti1Image(reoriented_data, new_affine)
 
 
 def register_to_mni(nni_path, template_path, save_path):
+    if ENGINE != "flirt":
+        # template FMRIB58 chỉ được đọc và dựng pyramid một lần trong mỗi worker của pool
+        with trace.timer("register"):
+            register_file_pooled(nni_path, template_path, os.path.join(save_path, "image.nii.gz"), dof=6)
+        return
+
     # Bước 1: Linear registration về MNI bằng FLIRT
     flirt = fsl.FLIRT()
     flirt.inputs.in_file = nni_path
@@ -73,7 +102,8 @@ def register_to_mni(nni_path, template_path, save_path):
     flirt.inputs.out_file = os.path.join(save_path, "image.nii.gz")
     flirt.inputs.out_matrix_file = os.path.join(save_path, "flirt_matrix.mat")
     flirt.inputs.dof = 6  # Bằng 12 nếu ảnh là T1, dùng 6 nếu FA
-    flirt.run()
+    with trace.timer("flirt"):
+        flirt.run()
 
     # Xóa file tạm
     os.remove(os.path.join(save_path, "flirt_matrix.mat"))
@@ -81,9 +111,11 @@ def register_to_mni(nni_path, template_path, save_path):
 
 def clean_background_with_bet(nifti_path, cleaned_path):
     # Tạo ảnh não đã loại bỏ nền với BET
-    subprocess.run(['bet', nifti_path, cleaned_path, '-f', '0.35', '-g', '0', '-m'])
+    compressed = cleaned_path.endswith(".gz")
+    trace.run(['bet', nifti_path, cleaned_path, '-f', '0.35', '-g', '0', '-m'], env=fsl_env(compressed))
 
-    mask_path = cleaned_path.replace(".nii.gz", "_mask.nii.gz")
+    stem = cleaned_path[:-len(".nii.gz")] if compressed else cleaned_path[:-len(".nii")]
+    mask_path = stem + ("_mask.nii.gz" if compressed else "_mask.nii")
     if os.path.exists(mask_path):
         os.remove(mask_path)
 
@@ -98,17 +130,21 @@ for path in df['dti_link']:
         save_path = os.path.join(save_path, f)
         os.makedirs(save_path, exist_ok=True)
 
-    raw_nifti_path = os.path.join(save_path, "image_raw.nii")
     template_path = 'template/FMRIB58_FA_1mm.nii.gz'
-    
-    dicom_to_nifti(path, raw_nifti_path)
-    cleaned_path = os.path.join(save_path, "image2.nii.gz")
-    clean_background_with_bet(raw_nifti_path, cleaned_path)
-    register_to_mni(cleaned_path, template_path, save_path)
-
-    os.remove(raw_nifti_path)
-    os.remove(cleaned_path)
+
+    # file trung gian không nén trong scratch (mặc định /dev/shm), luôn bị xóa kể cả khi lỗi
+    with ScratchDir() as scratch:
+        raw_nifti_path = scratch.join("image_raw.nii")
+        with trace.timer("dicom_to_nifti"):
+            dicom_to_nifti(path, raw_nifti_path)
+        cleaned_path = scratch.join("image2.nii")
+        clean_background_with_bet(raw_nifti_path, cleaned_path)
+        register_to_mni(cleaned_path, template_path, save_path)
+
     print(f"Done {path}")
 
+if trace.enabled:
+    print(trace.summary())
+
 
 
@@ -1,16 +1,33 @@
 import os
+import sys
+import glob
+import json
+import argparse
 import subprocess
-from concurrent.futures import ProcessPoolExecutor
-from functools import partial
+from concurrent.futures import as_completed
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from stage_cache import StageCache, Journal, hash_dir, hash_files, stage_key
+from scheduler import Scheduler, Task
+from scratch import ScratchDir, compress_nifti, fsl_env
+from registration import ENGINE, register_file_pooled
+
+
+# Tham số các stage; thay đổi sẽ làm mất hiệu lực cache của stage đó và các stage sau
+BET_FRAC = "0.35"
+FLIRT_DOF = "12"
+
+# Bộ nhớ ước tính (GB) của từng stage, dùng để Scheduler không chạy quá nhiều stage nặng cùng lúc
+STAGE_MEM_GB = {"hash": 0.1, "dcm2niix": 0.5, "fslroi": 0.3, "bet": 0.5, "dtifit": 1.5, "flirt": 1.0, "export": 0.1}
+
 
 def dicom_to_nifti(dicom_path, output_dir):
     """ Chuyển đổi DICOM sang NIfTI sử dụng dcm2niix. """
     try:
         subprocess.run([
             "dcm2niix",
-            "-z", "y",                 # nén .nii.gz
+            "-z", "n",                 # file trung gian không nén
             "-f", "dti",               # tên tệp đầu ra
             "-o", output_dir,
             dicom_path
@@ -19,7 +36,7 @@ def dicom_to_nifti(dicom_path, output_dir):
         print(e)
         raise RuntimeError("Failed to convert DICOM to NIfTI using dcm2niix.")
 
-    nii_file = os.path.join(output_dir, "dti.nii.gz")
+    nii_file = os.path.join(output_dir, "dti.nii")
     bvecs = os.path.join(output_dir, "dti.bvec")
     bvals = os.path.join(output_dir, "dti.bval")
     return nii_file, bvecs, bvals
@@ -31,11 +48,11 @@ def extract_b0(nii_file, output_dir):
 
     Ảnh b0 dùng dùng để thực hiện skull stripping.
     """
-    b0_file = os.path.join(output_dir, "b0.nii.gz")
+    b0_file = os.path.join(output_dir, "b0.nii")
     try:
         subprocess.run([
             "fslroi", nii_file, b0_file, "0", "1"
-        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=fsl_env())
     except subprocess.CalledProcessError as e:
         print(e)
         raise RuntimeError("Failed to extract b0 image using fslroi.")
@@ -43,13 +60,13 @@ def extract_b0(nii_file, output_dir):
     return b0_file
 
 
-def skull_strip(b0_file, output_dir):
+def skull_strip(b0_file, output_dir, frac=BET_FRAC):
     """ Thực hiện skull stripping trên ảnh b0 sử dụng BET. """
     bet_output = os.path.join(output_dir, "nodif_brain")
     try:
         subprocess.run([
-            "bet", b0_file, bet_output, '-f', '0.35', "-m"
-        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            "bet", b0_file, bet_output, '-f', frac, "-m"
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=fsl_env())
     except subprocess.CalledProcessError as e:
         print(e)
         raise RuntimeError("Failed to perform skull stripping using BET.")
@@ -76,20 +93,24 @@ def fit_dti(dti_ec, bet_output, bvecs, bvals, output_dir):
             "dtifit",
             "-k", dti_ec,
             "-o", os.path.join(output_dir, "dti"),
-            "-m", f"{bet_output}_mask.nii.gz",
+            "-m", f"{bet_output}_mask.nii",
             "-r", bvecs,
             "-b", bvals
-        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=fsl_env())
     except subprocess.CalledProcessError as e:
         print(e)
         raise RuntimeError("Failed to fit DTI model using dtifit.")
 
-    return os.path.join(output_dir, "dti_FA.nii.gz")
+    return os.path.join(output_dir, "dti_FA.nii")
 
 
-def register_to_mni(fa_image, output_dir, mni_template):
-    """ Đăng ký FA image với template MNI sử dụng FLIRT. """
-    output_registered = os.path.join(output_dir, "image.nii.gz")
+def register_to_mni(fa_image, output_dir, mni_template, dof=FLIRT_DOF):
+    """ Đăng ký FA image với template MNI, trong tiến trình (registration.py) hoặc bằng FLIRT. """
+    output_registered = os.path.join(output_dir, "image.nii")
+    if ENGINE != "flirt":
+        register_file_pooled(fa_image, mni_template, output_registered, dof=int(dof))
+        return output_registered
+
     matrix_file = os.path.join(output_dir, "fa2mni.mat")
     
     try:
@@ -99,8 +120,8 @@ def register_to_mni(fa_image, output_dir, mni_template):
             "-ref", mni_template,
             "-out", output_registered,
             "-omat", matrix_file,
-            "-dof", "12" 
-        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            "-dof", dof
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=fsl_env())
     except subprocess.CalledProcessError as e:
         print(e)
         raise RuntimeError("Failed to register FA image to MNI template using FLIRT.")
@@ -108,30 +129,88 @@ def register_to_mni(fa_image, output_dir, mni_template):
     return output_registered
 
 
-def remove_intermediate_files(output_dir):
-    """ Xoá các tệp trung gian không cần thiết, chỉ giữ lại ảnh đã đăng ký. """
-    files_to_keep = ["image.nii.gz"]
-    all_files = os.listdir(output_dir)
-    files_to_delete = [f for f in all_files if f not in files_to_keep ]
-
-    for file in files_to_delete:
-        file_path = os.path.join(output_dir, file)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-
-    return os.path.join(output_dir, "dti_FA.nii.gz")
-
+def build_dti_dag(dicom_path, output_dir, mni_template, cache, template_hash, events, scratch):
+    """
+    DAG các stage xử lý DTI từ DICOM đến FA image đã đăng ký với MNI template.
 
-def process_dti(dicom_path, output_dir, mni_template):
-    """ Xử lý DTI từ DICOM đến FA image đã đăng ký với MNI template."""
-    nii_file, bvecs, bvals = dicom_to_nifti(dicom_path, output_dir)
-    b0_file = extract_b0(nii_file, output_dir)
-    bet_output = skull_strip(b0_file, output_dir)
-    # dti_ec = eddy_correction(nii_file, output_dir)
-    # fa_image = fit_dti(dti_ec, bet_output, bvecs, bvals, output_dir)
-    fa_image = fit_dti(nii_file, bet_output, bvecs, bvals, output_dir)
-    register_to_mni(fa_image, output_dir, mni_template)
-    
+    bet / dtifit / flirt được cache theo nội dung DICOM + tham số, nên chạy lại chỉ tính
+    các stage bị thiếu hoặc có tham số thay đổi. Mỗi stage trả về (khóa, output).
+    dti.nii 4D (dcm2niix) và b0 (fslroi) chỉ là file trung gian trong scratch, chỉ được
+    tạo khi stage cache phía sau cần tính lại.
+    """
+    def keys(k_dcm):
+        k_b0 = stage_key("fslroi", k_dcm, "0", "1")
+        k_bet = stage_key("bet", k_b0, BET_FRAC)
+        return k_b0, k_bet, stage_key("dtifit", k_dcm, k_bet)
+
+    def skip(stage, key):
+        events.append({"stage": stage, "key": key, "status": "skipped", "path": dicom_path})
+
+    def hash_dicom(inputs):
+        return stage_key("dcm2niix", hash_dir(dicom_path), "-z n")
+
+    def convert(inputs):
+        k_dcm = inputs["hash"]
+        _, k_bet, k_fit = keys(k_dcm)
+        if cache.lookup("bet", k_bet) and cache.lookup("dtifit", k_fit):
+            skip("dcm2niix", k_dcm)
+            return k_dcm, None
+        return k_dcm, dicom_to_nifti(dicom_path, scratch.create())
+
+    def b0(inputs):
+        k_dcm, converted = inputs["dcm2niix"]
+        k_b0, k_bet, _ = keys(k_dcm)
+        if cache.lookup("bet", k_bet):
+            skip("fslroi", k_b0)
+            return k_b0, None
+        return k_b0, extract_b0(converted[0], scratch.create())
+
+    def bet(inputs):
+        k_b0, b0_file = inputs["fslroi"]
+
+        def run_bet(d):
+            bet_output = skull_strip(b0_file, d)
+            return f"{bet_output}.nii", f"{bet_output}_mask.nii"
+
+        k_bet = stage_key("bet", k_b0, BET_FRAC)
+        bet_image, _ = cache.run("bet", k_bet, run_bet, events, path=dicom_path)
+        return k_bet, bet_image[:-len(".nii")]
+
+    def dtifit(inputs):
+        k_dcm, converted = inputs["dcm2niix"]
+        k_bet, bet_output = inputs["bet"]
+
+        def run_fit(d):
+            nii_file, bvecs, bvals = converted
+            # dti_ec = eddy_correction(nii_file, output_dir)
+            # fa_image = fit_dti(dti_ec, bet_output, bvecs, bvals, output_dir)
+            return fit_dti(nii_file, bet_output, bvecs, bvals, d)
+
+        k_fit = stage_key("dtifit", k_dcm, k_bet)
+        return k_fit, cache.run("dtifit", k_fit, run_fit, events, path=dicom_path)
+
+    def flirt(inputs):
+        k_fit, fa_image = inputs["dtifit"]
+        # engine khác flirt cho kết quả khác nên có khóa cache riêng; với flirt khóa giữ như cũ
+        k_reg = stage_key("flirt", k_fit, template_hash, FLIRT_DOF, *(() if ENGINE == "flirt" else (ENGINE,)))
+        return k_reg, cache.run(
+            "flirt", k_reg, lambda d: register_to_mni(fa_image, d, mni_template), events, path=dicom_path)
+
+    def export(inputs):
+        k_reg, registered = inputs["flirt"]
+        # chỉ artifact cuối cùng được nén
+        compress_nifti(registered, os.path.join(output_dir, "image.nii.gz"))
+        return k_reg
+
+    return {
+        "hash":     Task(hash_dicom, kind="io", mem_gb=STAGE_MEM_GB["hash"]),
+        "dcm2niix": Task(convert, ["hash"], kind="io", mem_gb=STAGE_MEM_GB["dcm2niix"]),
+        "fslroi":   Task(b0, ["dcm2niix"], kind="io", mem_gb=STAGE_MEM_GB["fslroi"]),
+        "bet":      Task(bet, ["fslroi"], kind="cpu", mem_gb=STAGE_MEM_GB["bet"]),
+        "dtifit":   Task(dtifit, ["dcm2niix", "bet"], kind="cpu", mem_gb=STAGE_MEM_GB["dtifit"]),
+        "flirt":    Task(flirt, ["dtifit"], kind="cpu", mem_gb=STAGE_MEM_GB["flirt"]),
+        "export":   Task(export, ["flirt"], kind="io", mem_gb=STAGE_MEM_GB["export"]),
+    }
 
 
 def get_leaf_directories(root_path):
@@ -150,22 +229,30 @@ def get_leaf_directories(root_path):
     return leaf_dirs
 
 
-def process_single_subject(dicom_path, output_folder, template_path):
-    """ Xử lý một folder DICOM và ghi output. """
-    try:
-        output_dir = os.path.join(*dicom_path.split("/")[7:])  # Tạo relative path
-        output_dir = os.path.join(output_folder, output_dir)
-        os.makedirs(output_dir, exist_ok=True)
+def submit_subject(scheduler, dicom_path, output_folder, template_path, cache, template_hash):
+    """ Gửi DAG của một folder DICOM vào scheduler. Trả về (future, danh sách sự kiện stage). """
+    output_dir = os.path.join(*dicom_path.split("/")[7:])  # Tạo relative path
+    output_dir = os.path.join(output_folder, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    print(f"Processing {dicom_path}")
+    events = []
+    scratch = ScratchDir(prefix="z1-")
+    dag = build_dti_dag(dicom_path, output_dir, template_path, cache, template_hash, events, scratch)
+    future = scheduler.submit(dag)
+    # luôn xóa scratch khi DAG kết thúc, kể cả khi lỗi
+    future.add_done_callback(lambda f: scratch.cleanup())
+    return future, events
+
 
-        print(f"Processing {dicom_path}")
-        process_dti(dicom_path, output_dir, template_path)
-        remove_intermediate_files(output_dir)
-        print(f"✅ Done {dicom_path}")
-    except Exception as e:
-        print(f"❌ Failed {dicom_path}: {e}")
-        # ghi dữ liệu lỗi vào file lỗi:
-        with open("error_log.txt", "a") as f:
-            f.write(f"{dicom_path}\n")
+def subject_record(dicom_path, future, events):
+    """ Bản ghi kết quả của một folder cho journal. """
+    error = future.exception()
+    if error is not None:
+        print(f"❌ Failed {dicom_path}: {error}")
+        return {"path": dicom_path, "status": "failed", "error": str(error), "stages": events}
+    print(f"✅ Done {dicom_path}")
+    return {"path": dicom_path, "status": "done", "key": future.result()["export"], "stages": events}
 
 
 def t1(path):
@@ -177,67 +264,76 @@ def t2(path):
     t = os.path.join("data", "DTI" ,*s[7:])
     return t
 
+def load_done_paths(journal_paths):
+    """ Các folder DICOM đã xử lý thành công trong những lần chạy trước. """
+    done = set()
+    for journal_path in journal_paths:
+        with open(journal_path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get("status") == "done":
+                    done.add(record["path"])
+    return done
+
+
 def main():
     script_dir = os.path.dirname(os.path.abspath(__file__))
 
+    parser = argparse.ArgumentParser(description="Xử lý DTI: dcm2niix -> fslroi -> bet -> dtifit -> flirt.")
+    # vd. "DHCN_C4_DTI*" để chạy lần lượt DHCN_C4_DTI (1), DHCN_C4_DTI2, ..., DHCN_C4_DTI_Additional8
+    parser.add_argument("data", nargs="*", default=["DHCN_C4_DTI2"], help="tên (hoặc glob) thư mục trong data/")
+    parser.add_argument("--cache-dir", default=os.path.join(script_dir, "cache"))
+    parser.add_argument("--log-dir", default=os.path.join(script_dir, "logs"))
+    parser.add_argument("--resume", nargs="*", default=[], help="journal của các lần chạy trước; bỏ qua folder đã xong")
+    parser.add_argument("--workers", type=int, default=None, help="số stage nặng chạy song song (mặc định: số core)")
+    parser.add_argument("--mem-gb", type=float, default=None, help="ngân sách bộ nhớ (mặc định: 80%% bộ nhớ trống)")
+    args = parser.parse_args()
+
     output_folder = os.path.join(script_dir, "adni")
     os.makedirs(output_folder, exist_ok=True)
 
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI_Additional_dataset")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI_Additional")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI_Additional1")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI_Additional2")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI_Additional3")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI_Additional4")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI_Additional5")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI_Additional6")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI_Additional7")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI_Additional8")
-
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI (1)")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI1 (1)")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI2")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI3")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI4")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI5")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI6")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI7")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI8")
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI9")
-
-    # data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI2_dataset")
-    data_path = os.path.join(script_dir, "data", "DHCN_C4_DTI2")
-
-
-
-    
-
     template_path = 'templates/FMRIB58_FA_1mm.nii.gz'
-
-    data_paths = get_leaf_directories(data_path)
+    template_hash = hash_files([template_path])
 
     df = pd.read_csv("data/final_dataset.csv")
     # dti_links = set([link.lower().replace(" ", "_") for link in df['dti_link']])
     dti_links = set([link for link in df['dti_link']])
 
+    data_dirs = sorted({p for pattern in args.data for p in glob.glob(os.path.join(script_dir, "data", pattern))})
+    done = load_done_paths(args.resume)
+    journal = Journal(args.log_dir, name="z1")
+    print(f"Journal: {journal.path}")
 
-    # data_paths = [path for path in data_paths if t1(path) in dti_links]
-    data_paths = [path for path in data_paths if t2(path) in dti_links]
-
-    # lưu data_paths ra file.
-    with open(f"data/{data_path.split('/')[-1]}.txt", "w") as f:
-        for path in data_paths:
-            f.write(f"{path}\n")
+    queued = []
+    for data_path in data_dirs:
+        data_paths = get_leaf_directories(data_path)
 
-    workers = 4
+        # data_paths = [path for path in data_paths if t1(path) in dti_links]
+        data_paths = [path for path in data_paths if t2(path) in dti_links]
 
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        task = partial(process_single_subject, output_folder=output_folder, template_path=template_path)
-        executor.map(task, data_paths)
+        # lưu data_paths ra file.
+        with open(f"data/{data_path.split('/')[-1]}.txt", "w") as f:
+            for path in data_paths:
+                f.write(f"{path}\n")
 
+        data_paths = [path for path in data_paths if path not in done]
+        queued.extend((path, data_path) for path in data_paths)
 
+    cache = StageCache(args.cache_dir)
+    with Scheduler(cpu_slots=args.workers, mem_budget_gb=args.mem_gb) as scheduler:
+        print(f"Scheduler: {scheduler.cpu_slots} cpu / {scheduler.io_slots} io slots, "
+              f"{scheduler.memory.budget:.1f} GB")
+        futures = {}
+        for path, data_path in queued:
+            future, events = submit_subject(scheduler, path, output_folder, template_path, cache, template_hash)
+            futures[future] = (path, data_path, events)
 
+        for future in as_completed(futures):
+            path, data_path, events = futures[future]
+            record = subject_record(path, future, events)
+            record["data_dir"] = data_path
+            journal.write([record])
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -4,15 +4,22 @@ import pydicom
 import nibabel as nib
 import numpy as np
 import pandas as pd
-import subprocess
 from scipy.ndimage import affine_transform
 from nipype.interfaces import fsl
 import nibabel.orientations as nio
-import multiprocessing
+import sys
+from concurrent.futures import as_completed
 import dicom2nifti
 import warnings
 warnings.filterwarnings("ignore") 
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+from scheduler import Scheduler, Task
+from scratch import ScratchDir, fsl_env
+from instrument import trace
+from registration import ENGINE, register_file_pooled
+
 def safe_remove(path):
     try:
         if os.path.exists(path):
@@ -21,14 +28,15 @@ def safe_remove(path):
         print(f"Không thể xóa {path}: {e}")
 
 def reorient_to_RAS(img):
+    """ Đưa ảnh về RAS bằng lật/hoán vị trục, giữ nguyên kiểu dữ liệu (không get_fdata). """
     current_ornt = nio.io_orientation(img.affine)
     ras_ornt = nio.axcodes2ornt(('R', 'A', 'S'))
     transform = nio.ornt_transform(current_ornt, ras_ornt)
-    reoriented_data = nio.apply_orientation(img.get_fdata(), transform)
+    reoriented_data = nio.apply_orientation(np.asanyarray(img.dataobj), transform)
     new_affine = img.affine @ nio.inv_ornt_aff(transform, img.shape)
     return nib.Nifti1Image(reoriented_data, new_affine)
 
-def dicom_to_nifti(dicom_dir, save_path):
+def dicom_to_nifti(dicom_dir, save_path, compression=True):
     try:
         dicom_files = glob.glob(os.path.join(dicom_dir.replace('\\', '/'), "*.dcm")) or \
                       glob.glob(os.path.join(dicom_dir.replace('\\', '/'), "I*"))
@@ -44,77 +52,124 @@ def dicom_to_nifti(dicom_dir, save_path):
             raise ValueError(f"File DICOM không hợp lệ: {dicom_file}, lỗi: {str(e)}")
 
         output_dir = os.path.dirname(save_path)
-        dicom2nifti.convert_directory(dicom_dir, output_dir, compression=True)
+        dicom2nifti.convert_directory(dicom_dir, output_dir, compression=compression)
         
-        nifti_files = glob.glob(os.path.join(output_dir, "*.nii.gz"))
+        nifti_files = glob.glob(os.path.join(output_dir, "*.nii.gz" if compression else "*.nii"))
         if not nifti_files:
             raise ValueError(f"Không tìm thấy file NIfTI sau khi chuyển đổi từ {dicom_dir}")
         
         os.rename(nifti_files[0], save_path)
         
-        nii_img = nib.load(save_path)
-        nii_img = reorient_to_RAS(nii_img)
-        nib.save(nii_img, save_path)
+        # .nii không nén được memmap: ghi ra file tạm rồi đổi tên, không ghi đè file đang được đọc
+        nii_img = reorient_to_RAS(nib.load(save_path))
+        tmp_path = os.path.join(output_dir, ".ras-" + os.path.basename(save_path))
+        nib.save(nii_img, tmp_path)
+        os.replace(tmp_path, save_path)
         
         return True
     except Exception as e:
         print(f"Lỗi khi chuyển DICOM sang NIfTI cho {dicom_dir}: {str(e)}")
         return False
 
+def nifti_stem(path):
+    return path[:-len(".nii.gz")] if path.endswith(".nii.gz") else path[:-len(".nii")]
+
 def register_to_mni(in_path, template_path, out_path):
+    if ENGINE != "flirt":
+        # template và pyramid được dựng một lần trong mỗi worker của pool, dùng lại cho mọi ảnh
+        with trace.timer("register"):
+            register_file_pooled(in_path, template_path, out_path, dof=12)
+        return
     flirt = fsl.FLIRT()
     flirt.inputs.in_file = in_path
     flirt.inputs.reference = template_path
-    flirt.inputs.output_type = "NIFTI_GZ"
+    flirt.inputs.output_type = "NIFTI_GZ" if out_path.endswith(".gz") else "NIFTI"
     flirt.inputs.out_file = out_path
     flirt.inputs.dof = 12
-    flirt.inputs.out_matrix_file = out_path.replace(".nii.gz", "_matrix.mat")
-    flirt.run()
+    flirt.inputs.out_matrix_file = nifti_stem(out_path) + "_matrix.mat"
+    with trace.timer("flirt"):
+        flirt.run()
     safe_remove(flirt.inputs.out_matrix_file)
 
 def clean_background_and_save(input_path, output_path):
-    subprocess.run(['bet', input_path, output_path, '-f', '0.38', '-g', '0', '-m'])
-    mask_path = output_path.replace(".nii.gz", "_mask.nii.gz")
+    compressed = output_path.endswith(".gz")
+    trace.run(['bet', input_path, output_path, '-f', '0.38', '-g', '0', '-m'], env=fsl_env(compressed))
+    mask_path = nifti_stem(output_path) + ("_mask.nii.gz" if compressed else "_mask.nii")
     safe_remove(mask_path)
 
 
-def process_subject(row, template_path):
+# Bộ nhớ ước tính (GB) của từng stage, dùng để Scheduler không chạy quá nhiều stage nặng cùng lúc
+STAGE_MEM_GB = {"dicom2nifti": 1.0, "flirt": 1.0, "bet": 0.5}
+
+
+def build_subject_dag(row, template_path, scratch):
+    """
+    DAG các stage của một ảnh MRI: dicom2nifti -> flirt -> bet.
+
+    File trung gian (image_raw, image_reg) là .nii không nén trong scratch;
+    chỉ ảnh cuối image.nii.gz được nén và ghi vào adni/.
+    """
     dicom_path = row['mri_link']
-    print(f"🔄 Đang xử lý: {dicom_path}")
 
     subpath = "/".join(dicom_path.replace("\\", "/").split("/")[1:])
     output_dir = os.path.join("adni", subpath)
-    os.makedirs(output_dir, exist_ok=True)
+    raw_nii = lambda: scratch.join("image_raw.nii")
+    registered_nii = lambda: scratch.join("image_reg.nii")
+    final_nii = os.path.join(output_dir, "image.nii.gz")
 
-    raw_nii = os.path.join(output_dir, "image_raw.nii.gz")
-    if not dicom_to_nifti(dicom_path, raw_nii):
-        return
+    def convert(inputs):
+        print(f"🔄 Đang xử lý: {dicom_path}")
+        os.makedirs(output_dir, exist_ok=True)
+        # dicom2nifti ghi vào thư mục con riêng để không lẫn với file khác trong scratch
+        os.makedirs(scratch.join("dicom2nifti"), exist_ok=True)
+        with trace.timer("dicom2nifti"):
+            converted = dicom_to_nifti(dicom_path, scratch.join("dicom2nifti", "image_raw.nii"), compression=False)
+        if not converted:
+            raise RuntimeError(f"Lỗi khi chuyển DICOM sang NIfTI cho {dicom_path}")
+        os.replace(scratch.join("dicom2nifti", "image_raw.nii"), raw_nii())
+        return raw_nii()
 
-    registered_nii = os.path.join(output_dir, "image_reg.nii.gz")
-    try:
-        register_to_mni(raw_nii, template_path, registered_nii)
-        safe_remove(raw_nii)
-    except Exception as e:
-        print(f"Lỗi khi đăng ký MNI cho {dicom_path}: {e}")
-        safe_remove(raw_nii)
-        return
+    def register(inputs):
+        try:
+            register_to_mni(raw_nii(), template_path, registered_nii())
+        except Exception as e:
+            raise RuntimeError(f"Lỗi khi đăng ký MNI cho {dicom_path}: {e}")
+        finally:
+            safe_remove(raw_nii())
+        return registered_nii()
 
-    final_nii = os.path.join(output_dir, "image.nii.gz")
-    try:
-        clean_background_and_save(registered_nii, final_nii)
-        safe_remove(registered_nii)
-    except Exception as e:
-        print(f"Lỗi khi tách nền cho {dicom_path}: {e}")
-        safe_remove(registered_nii)
-        return
+    def strip(inputs):
+        try:
+            clean_background_and_save(registered_nii(), final_nii)
+        except Exception as e:
+            raise RuntimeError(f"Lỗi khi tách nền cho {dicom_path}: {e}")
+        finally:
+            safe_remove(registered_nii())
+        print(f"BET hoàn tất: {final_nii}")
+        print(f"Hoàn tất: {dicom_path}")
+        return final_nii
+
+    return {
+        "dicom2nifti": Task(convert, kind="io", mem_gb=STAGE_MEM_GB["dicom2nifti"]),
+        "flirt":       Task(register, ["dicom2nifti"], kind="cpu", mem_gb=STAGE_MEM_GB["flirt"]),
+        "bet":         Task(strip, ["flirt"], kind="cpu", mem_gb=STAGE_MEM_GB["bet"]),
+    }
 
-    print(f"BET hoàn tất: {final_nii}")
-    print(f"Hoàn tất: {dicom_path}")
 
 if __name__ == "__main__":
     df = pd.read_csv('data/final_dataset.csv')
     template_path = 'template/MNI152_T1_1mm.nii.gz'
 
-    num_processes = min(4, multiprocessing.cpu_count() - 1)
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        pool.starmap(process_subject, [(row, template_path) for _, row in df.iterrows()])
\ No newline at end of file
+    with Scheduler() as scheduler:
+        futures = {}
+        for row in df.to_dict('records'):
+            scratch = ScratchDir()
+            future = scheduler.submit(build_subject_dag(row, template_path, scratch))
+            # luôn xóa scratch khi DAG kết thúc, kể cả khi lỗi
+            future.add_done_callback(lambda f, scratch=scratch: scratch.cleanup())
+            futures[future] = row['mri_link']
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                print(f"❌ {futures[future]}: {future.exception()}")
+    if trace.enabled:
+        print(trace.summary())
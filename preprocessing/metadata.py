@@ -0,0 +1,174 @@
+import os
+import json
+import argparse
+import pandas as pd
+
+
+DTI_DESCRIPTIONS = ['axial dti_fa', 'axial dti repeat_fa']
+MRI_DESCRIPTIONS = ['Accelerated Sagittal MPRAGE', 'Sagittal 3D Accelerated MPRAGE',
+                    'Accelerated Sagittal MPRAGE REPEAT', 'Accelerated Sagittal MPRAGE repeat']
+MRI_REPEAT = ['Accelerated Sagittal MPRAGE repeat', 'Accelerated Sagittal MPRAGE REPEAT']
+
+
+def _subdirs(path):
+    with os.scandir(path) as entries:
+        return [e for e in entries if e.is_dir()]
+
+
+def index_path(data_dir):
+    """ File cache của chỉ mục thư mục: data/DTI -> data/.DTI_index.json """
+    data_dir = os.path.abspath(data_dir)
+    return os.path.join(os.path.dirname(data_dir), f".{os.path.basename(data_dir)}_index.json")
+
+
+def _mtimes(dirs):
+    return {d: os.stat(d).st_mtime_ns for d in dirs}
+
+
+def _walk(data_dir):
+    """ Một lượt os.scandir qua 4 cấp subject / description / time / image_id. """
+    rows, dirs = [], [data_dir]
+    for f1 in _subdirs(data_dir):
+        dirs.append(f1.path)
+        for f2 in _subdirs(f1.path):
+            dirs.append(f2.path)
+            for f3 in _subdirs(f2.path):
+                dirs.append(f3.path)
+                for f4 in _subdirs(f3.path):
+                    rows.append((f1.name, f2.name, f3.name, f4.name))
+    return rows, dirs
+
+
+def scan_image_dirs(data_dir, prefix, use_cache=True):
+    """
+    Liệt kê mọi thư mục ảnh data_dir/<subject_id>/<description>/<time>/<image_id>.
+
+    Kết quả được cache kèm mtime của các thư mục đã duyệt; chỉ duyệt lại khi có
+    thư mục được thêm/xóa (mtime của thư mục cha thay đổi).
+    """
+    columns = ['subject_id', f'{prefix}_description', f'{prefix}_time', 'image_id']
+    cache_file = index_path(data_dir)
+
+    if use_cache and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        try:
+            if _mtimes(cached['mtimes']) == cached['mtimes']:
+                return pd.DataFrame(cached['rows'], columns=columns)
+        except OSError:
+            pass
+
+    rows, dirs = _walk(data_dir)
+    if use_cache:
+        with open(cache_file, 'w') as f:
+            json.dump({'mtimes': _mtimes(dirs), 'rows': rows}, f)
+    return pd.DataFrame(rows, columns=columns)
+
+
+def attach_demographics(df, demographics):
+    """
+    Gắn PTGENDER / PTDOBYY theo subject_id bằng map (thay cho vòng lặp df.loc theo từng subject).
+
+    Giống dict trong notebook: nếu một PTID xuất hiện nhiều lần thì giá trị cuối cùng được dùng;
+    subject không có thông tin nhận None.
+    """
+    demo = demographics.drop_duplicates('PTID', keep='last').set_index('PTID')
+    df = df.copy()
+    for col in ['PTDOBYY', 'PTGENDER']:
+        values = df['subject_id'].map(demo[col].astype(object))
+        df[col] = values.where(values.notna(), None)
+    return df
+
+
+def link_column(df, folder, prefix):
+    """ data\\DTI\\<subject>\\<description>\\<time>\\<image_id> như trong notebook. """
+    parts = [df['subject_id'], df[f'{prefix}_description_x'], df[f'{prefix}_time'], df['image_id']]
+    link = "data" + "\\" + folder
+    for part in parts:
+        link = link + "\\" + part
+    return link
+
+
+def build_dti(scores_csv, demographics_csv, data_dir='data/DTI'):
+    """ Tương đương preprocessing/dti.ipynb -> dti.csv """
+    df = pd.read_csv(scores_csv)
+    df = attach_demographics(df, pd.read_csv(demographics_csv))
+
+    df = df[~(df['VISCODE'] == 'sc')]
+    # Xóa các cột thừa gây nhiễu
+    df = df.drop(columns=['VISCODE', 'VISCODE2', 'EXAMDATE', 'days_between_exams_and_dti_scan', 'image_type', 'dti_visit'])
+    df = df.drop_duplicates('image_id')
+
+    # bỏ ảnh axial dti_fa của những subject phải chụp lại
+    repeat = df[df['dti_description'] == 'axial dti repeat_fa']
+    replaced = df[df['subject_id'].isin(repeat['subject_id']) & (df['dti_description'] == 'axial dti_fa')]
+    df3 = df[df['dti_description'].isin(DTI_DESCRIPTIONS)]
+    df3 = df3[~df3['image_id'].isin(replaced['image_id'])].copy()
+
+    dti_df = scan_image_dirs(data_dir, 'dti')
+    df3['image_id'] = 'I' + df3['image_id'].astype(str)
+
+    # chỉ lấy các mẫu dữ liệu thực sự tồn tại:
+    df4 = pd.merge(dti_df, df3, on=['image_id'], how='inner')
+    df4 = df4.rename(columns={'subject_id_x': 'subject_id'})
+    df4['dti_link'] = link_column(df4, 'DTI', 'dti')
+    return df4.drop(columns=['subject_id_y', 'dti_description_y', 'dti_description_x', 'image_id', 'dti_time'])
+
+
+def build_mri(scores_csv, data_dir='data/MRI'):
+    """ Tương đương preprocessing/mri.ipynb -> mri.csv """
+    df = pd.read_csv(scores_csv)
+
+    df = df[~(df['VISCODE'] == 'sc')]
+    # Xóa các cột thừa gây nhiễu
+    df = df.drop(columns=['VISCODE', 'VISCODE2', 'EXAMDATE', 'days_between_exams_and_mri_scan', 'image_type', 'mri_type', 'mri_visit'])
+    df = df.drop_duplicates('image_id')
+
+    # bỏ ảnh gốc của những subject phải chụp lại
+    repeat = df[df['mri_description'].isin(MRI_REPEAT)]
+    replaced = df[df['subject_id'].isin(repeat['subject_id']) & ~df['mri_description'].isin(MRI_REPEAT)]
+    df3 = df[df['mri_description'].isin(MRI_DESCRIPTIONS)]
+    df3 = df3[~df3['image_id'].isin(replaced['image_id'])].copy()
+
+    mri_df = scan_image_dirs(data_dir, 'mri')
+    df3['image_id'] = 'I' + df3['image_id'].astype(str)
+
+    # chỉ lấy các mẫu dữ liệu thực sự tồn tại:
+    df4 = pd.merge(mri_df, df3, on=['image_id'], how='inner')
+    df4 = df4.rename(columns={'subject_id_x': 'subject_id'})
+    df4['mri_link'] = link_column(df4, 'MRI', 'mri')
+    return df4.drop(columns=['subject_id_y', 'mri_description_y', 'mri_description_x', 'image_id', 'mri_time'])
+
+
+def merge_final(dti_df, mri_df, max_days=7):
+    """ Tương đương preprocessing/merge.ipynb -> final.csv """
+    df = pd.merge(dti_df, mri_df, on=['subject_id', 'DIAGNOSIS'], how='inner')
+    df['dti_date'] = pd.to_datetime(df['dti_date'])
+    df['mri_date'] = pd.to_datetime(df['mri_date'])
+    df['days_between'] = abs((df['mri_date'] - df['dti_date']).dt.days)
+    df = df[df['days_between'] < max_days]
+    return df.drop(columns=['dti_date', 'mri_date', 'days_between', 'subject_id'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tạo dti.csv, mri.csv và final.csv từ dữ liệu ADNI.")
+    parser.add_argument("--data", default="data")
+    args = parser.parse_args()
+
+    dti_df = build_dti(os.path.join(args.data, 'c4_cognitive_score_dti.csv'),
+                       os.path.join(args.data, 'c4_demographics.csv'),
+                       os.path.join(args.data, 'DTI'))
+    dti_df.to_csv(os.path.join(args.data, 'dti.csv'), index=False)
+
+    mri_df = build_mri(os.path.join(args.data, 'c4_cognitive_score_mri.csv'), os.path.join(args.data, 'MRI'))
+    mri_df.to_csv(os.path.join(args.data, 'mri.csv'), index=False)
+
+    # merge.ipynb đọc lại từ csv nên kiểu dữ liệu (vd. ngày, image_id) giống hệt
+    final_df = merge_final(pd.read_csv(os.path.join(args.data, 'dti.csv')),
+                           pd.read_csv(os.path.join(args.data, 'mri.csv')))
+    final_df.to_csv(os.path.join(args.data, 'final.csv'), index=False)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import affine_transform, gaussian_filter, map_coordinates
+
+
+# "flirt": gọi FSL flirt (mặc định), "numpy": đăng ký bằng module này trong pool tiến trình
+ENGINE = os.environ.get("ADNI_REGISTRATION", "flirt")
+
+# số tiến trình của pool đăng ký (mặc định: số core)
+POOL_WORKERS = int(os.environ.get("ADNI_REGISTRATION_WORKERS", 0)) or os.cpu_count()
+
+# kích thước voxel (mm) của các mức pyramid, thô -> mịn, giống lịch 8/4/2 mm của flirt
+LEVELS = (8, 4, 2)
+
+
+def _translation(c):
+    m = np.eye(4)
+    m[:3, 3] = c
+    return m
+
+
+def _rodrigues(w):
+    theta = np.linalg.norm(w)
+    if theta < 1e-12:
+        return np.eye(3)
+    k = w / theta
+    K = np.array([[0, -k[2], k[1]], [k[2], 0, -k[0]], [-k[1], k[0], 0]])
+    return np.eye(3) + np.sin(theta) * K + (1 - np.cos(theta)) * K @ K
+
+
+def _volume(img):
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        if any(n != 1 for n in data.shape[3:]):
+            raise ValueError(f"Expected a 3D image, got shape {data.shape}")
+        data = data.reshape(data.shape[:3])
+    return np.asarray(data, dtype=np.float32)
+
+
+def _smooth(data, target_mm, voxel_mm):
+    """ Làm mịn Gauss để độ phân giải hiệu dụng ~ target_mm (ảnh vốn đã mờ ~ nửa voxel). """
+    sigma = [np.sqrt(max((target_mm / 2) ** 2 - (v / 2) ** 2, 0.0)) / v for v in voxel_mm]
+    return gaussian_filter(data, sigma) if max(sigma) > 0 else data
+
+
+def center_of_mass(data, affine):
+    """ Tâm khối (tọa độ world, mm) theo cường độ dương. """
+    w = np.clip(data, 0, None)
+    total = w.sum()
+    if total <= 0:
+        return affine[:3, :3] @ ((np.array(data.shape) - 1) / 2) + affine[:3, 3]
+    idx = [np.arange(n, dtype=np.float64) for n in data.shape]
+    vox = [(w.sum(axis=tuple(j for j in range(3) if j != i)) * idx[i]).sum() / total for i in range(3)]
+    return affine[:3, :3] @ np.array(vox) + affine[:3, 3]
+
+
+class Template:
+    """
+    Template MNI (FMRIB58_FA_1mm / MNI152_T1_1mm) đã chuẩn bị sẵn cho đăng ký inverse-compositional.
+
+    Mỗi mức pyramid giữ: tọa độ world (đã trừ tâm) của các voxel trong vùng có tín hiệu, cường độ đã
+    chuẩn hóa, và với từng DOF là ma trận (H^-1 * SD^T) tính từ gradient của template. Các đại lượng
+    này không phụ thuộc ảnh cần đăng ký nên chỉ tính một lần cho mọi subject trong tiến trình.
+    """
+    def __init__(self, path, levels=LEVELS, threshold=0.01):
+        img = nib.load(path)
+        self.path = path
+        self.affine = img.affine
+        self.header = img.header
+        data = _volume(img)
+        self.shape = data.shape
+        self.center = center_of_mass(data, self.affine)
+        self.levels = []
+        voxel = np.sqrt((self.affine[:3, :3] ** 2).sum(axis=0))
+        for mm in levels:
+            step = max(int(round(mm / voxel.min())), 1)
+            smoothed = _smooth(data, mm, voxel)
+            self.levels.append(self._level(smoothed[::step, ::step, ::step], self.affine @ np.diag([step] * 3 + [1]),
+                                           mm, threshold))
+        self._steepest = {}
+        self._lock = threading.Lock()
+
+    def _level(self, data, affine, mm, threshold):
+        mask = data > threshold * data.max()
+        vox = np.argwhere(mask).astype(np.float64)
+        world = vox @ affine[:3, :3].T + affine[:3, 3]
+        values = data[mask].astype(np.float64)
+        mean, std = values.mean(), values.std() + 1e-8
+        grads = np.stack([g[mask] for g in np.gradient(data.astype(np.float64))], axis=1) / std
+        return {
+            'mm': mm,
+            'points': (world - self.center).astype(np.float32),
+            'values': ((values - mean) / std).astype(np.float32),
+            # gradient theo tọa độ world: inv(A)^T * gradient theo voxel
+            'grad': (grads @ np.linalg.inv(affine[:3, :3])).astype(np.float32),
+        }
+
+    def steepest(self, level, dof):
+        """ (H^-1 SD^T) của mức `level` cho 6 (rigid) hoặc 12 (affine) DOF, tính lần đầu rồi giữ lại. """
+        key = (level, dof)
+        with self._lock:
+            if key not in self._steepest:
+                lv = self.levels[level]
+                x, g = lv['points'].astype(np.float64), lv['grad'].astype(np.float64)
+                if dof == 6:
+                    # W(x; w, t) ~ x + w × x + t
+                    sd = np.stack([
+                        g[:, 2] * x[:, 1] - g[:, 1] * x[:, 2],
+                        g[:, 0] * x[:, 2] - g[:, 2] * x[:, 0],
+                        g[:, 1] * x[:, 0] - g[:, 0] * x[:, 1],
+                        g[:, 0], g[:, 1], g[:, 2],
+                    ], axis=1)
+                elif dof == 12:
+                    # W(x; D) = x + D[:, :3] x + D[:, 3], D lưu theo hàng
+                    xh = np.concatenate([x, np.ones((len(x), 1))], axis=1)
+                    sd = (g[:, :, None] * xh[:, None, :]).reshape(len(x), 12)
+                else:
+                    raise ValueError(f"dof must be 6 or 12, got {dof}")
+                hessian = sd.T @ sd
+                self._steepest[key] = np.linalg.solve(hessian, sd.T).astype(np.float32)
+            return self._steepest[key]
+
+
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
+
+
+def get_template(path, levels=LEVELS):
+    """ Template đã chuẩn bị, dùng chung trong tiến trình (kể cả giữa các thread của Scheduler). """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns, tuple(levels))
+    with _TEMPLATES_LOCK:
+        if key not in _TEMPLATES:
+            _TEMPLATES[key] = Template(path, levels)
+        return _TEMPLATES[key]
+
+
+def _update(dp, dof):
+    d = np.eye(4)
+    if dof == 6:
+        d[:3, :3] = _rodrigues(dp[:3])
+        d[:3, 3] = dp[3:]
+    else:
+        d[:3, :] += dp.reshape(3, 4)
+    return d
+
+
+def _align_level(template, level, dof, data, affine, m, max_iter, tol_mm):
+    lv = template.levels[level]
+    x = lv['points']
+    steepest = template.steepest(level, dof)
+    to_vox = np.linalg.inv(affine) @ _translation(template.center)
+    radius = np.sqrt((x.astype(np.float64) ** 2).sum(axis=1).mean())
+    for _ in range(max_iter):
+        q = to_vox @ m
+        coords = q[:3, :3].astype(np.float32) @ x.T + q[:3, 3:].astype(np.float32)
+        warped = map_coordinates(data, coords, order=1, mode='constant', cval=0.0, prefilter=False)
+        warped = (warped - warped.mean()) / (warped.std() + 1e-8)
+        dp = steepest @ (warped - lv['values'])
+        d = _update(dp.astype(np.float64), dof)
+        m = m @ np.linalg.inv(d)
+        # độ dịch chuyển ước lượng (mm) của bước vừa rồi trên bán kính trung bình của não
+        if np.linalg.norm(d[:3, :3] - np.eye(3)) * radius + np.linalg.norm(d[:3, 3]) < tol_mm:
+            break
+    return m
+
+
+def register(moving, template, dof=12, max_iter=50, tol_mm=0.01):
+    """
+    Đăng ký affine ảnh `moving` (Nifti1Image) vào template bằng Gauss-Newton inverse-compositional.
+
+    Khởi tạo bằng tâm khối, sau đó từ mức thô tới mịn; với 12 DOF, mức thô nhất chạy 6 DOF trước
+    như flirt. Trả về ma trận 4x4 biến tọa độ world của template thành tọa độ world của `moving`.
+    """
+    data = _volume(moving)
+    affine = moving.affine
+    voxel = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    m = _translation(center_of_mass(data, affine) - template.center)
+    for level, lv in enumerate(template.levels):
+        smoothed = _smooth(data, lv['mm'], voxel)
+        stages = (6, dof) if level == 0 and dof == 12 else (dof,)
+        for stage_dof in stages:
+            m = _align_level(template, level, stage_dof, smoothed, affine, m, max_iter, tol_mm * lv['mm'])
+    center = _translation(template.center)
+    return center @ m @ np.linalg.inv(center)
+
+
+def resample(moving, template, world, order=1):
+    """ Nội suy `moving` lên lưới của template theo ma trận world (template -> moving), như ảnh -out của flirt. """
+    vox = np.linalg.inv(moving.affine) @ world @ template.affine
+    out = affine_transform(_volume(moving), vox[:3, :3], offset=vox[:3, 3], output_shape=template.shape,
+                           order=order, mode='constant', cval=0.0)
+    header = template.header.copy()
+    header.set_data_dtype(np.float32)
+    return nib.Nifti1Image(out.astype(np.float32), template.affine, header)
+
+
+def register_file(in_path, template_path, out_path, dof=12):
+    """ Thay cho `flirt -in in_path -ref template_path -out out_path -dof dof`; trả về ma trận world. """
+    template = get_template(template_path)
+    moving = nib.load(in_path)
+    world = register(moving, template, dof=dof)
+    nib.save(resample(moving, template, world), out_path)
+    return world
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn: pool được tạo từ thread của Scheduler, fork khi đang có thread khác là không an toàn
+            _POOL = ProcessPoolExecutor(POOL_WORKERS, mp_context=mp.get_context("spawn"))
+        return _POOL
+
+
+def register_file_pooled(in_path, template_path, out_path, dof=12):
+    """
+    register_file chạy trong pool tiến trình dùng chung: mỗi worker dựng template một lần rồi giữ lại.
+    gaussian_filter / map_coordinates không nhả GIL, nên các thread của Scheduler chỉ chờ kết quả
+    (như chờ tiến trình flirt) còn phần tính toán chạy song song ở các worker.
+    """
+    return _pool().submit(register_file, in_path, template_path, out_path, dof).result()
+
+
+def _scaled_voxel(img):
+    """ Tọa độ "scaled voxel" của FSL: voxel * pixdim, trục x bị lật nếu ảnh lưu theo neurological. """
+    shape = img.shape[:3]
+    s = np.diag(list(img.header.get_zooms()[:3]) + [1.0])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0], flip[0, 3] = -1, shape[0] - 1
+        s = s @ flip
+    return s
+
+
+def flirt_to_world(mat, in_img, ref_img):
+    """ Ma trận .mat của flirt (in -> ref, scaled voxel) đổi sang world template -> moving như register(). """
+    in_to_ref = ref_img.affine @ np.linalg.inv(_scaled_voxel(ref_img)) @ mat @ _scaled_voxel(in_img) @ np.linalg.inv(in_img.affine)
+    return np.linalg.inv(in_to_ref)
+
+
+def synthetic_template(shape=(91, 109, 91), voxel=2.0, seed=0):
+    """ Ảnh giả dạng não: các ellipsoid lồng nhau có cường độ khác nhau, đã làm mịn. """
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij'), axis=-1)
+    data = np.zeros(shape, dtype=np.float32)
+    data[((grid / [0.8, 0.85, 0.75]) ** 2).sum(-1) < 1] = 1.0
+    for _ in range(12):
+        center = rng.uniform(-0.5, 0.5, 3)
+        radii = rng.uniform(0.08, 0.3, 3)
+        data[(((grid - center) / radii) ** 2).sum(-1) < 1] = rng.uniform(0.2, 2.0)
+    affine = np.diag([voxel, voxel, voxel, 1.0])
+    affine[:3, 3] = -voxel * (np.array(shape) - 1) / 2
+    return nib.Nifti1Image(gaussian_filter(data, 1.0), affine)
+
+
+def random_transform(dof, rng, max_rot_deg=10, max_shift_mm=10, max_scale=0.1, max_shear=0.05):
+    """ Ma trận world ngẫu nhiên (template -> moving): rigid cho 6 DOF, thêm scale/shear cho 12 DOF. """
+    m = np.eye(4)
+    m[:3, :3] = _rodrigues(np.deg2rad(rng.uniform(-max_rot_deg, max_rot_deg, 3)))
+    if dof == 12:
+        zoom = np.diag(1 + rng.uniform(-max_scale, max_scale, 3))
+        shear = np.eye(3) + np.triu(rng.uniform(-max_shear, max_shear, (3, 3)), 1)
+        m[:3, :3] = m[:3, :3] @ zoom @ shear
+    m[:3, 3] = rng.uniform(-max_shift_mm, max_shift_mm, 3)
+    return m
+
+
+def synthesize_moving(template_img, world, voxel=(1.8, 1.8, 2.5), noise=0.02, rng=None):
+    """ Ảnh moving = template biến đổi theo `world`, lấy mẫu lại trên lưới khác, thêm nhiễu và đổi thang cường độ. """
+    rng = rng or np.random.default_rng(0)
+    t_affine = template_img.affine
+    extent = np.abs(t_affine[:3, :3]).sum(axis=1) * np.array(template_img.shape[:3])
+    shape = tuple(int(np.ceil(e / v)) + 8 for e, v in zip(extent, voxel))
+    affine = np.diag(list(voxel) + [1.0])
+    affine[:3, 3] = -np.array(voxel) * (np.array(shape) - 1) / 2 + rng.uniform(-20, 20, 3)
+    # voxel moving -> world moving -> world template -> voxel template
+    vox = np.linalg.inv(t_affine) @ np.linalg.inv(world) @ affine
+    data = affine_transform(_volume(template_img), vox[:3, :3], offset=vox[:3, 3], output_shape=shape, order=1)
+    data = 3.0 * data + noise * data.max() * rng.standard_normal(shape)
+    return nib.Nifti1Image(data.astype(np.float32), affine)
+
+
+def displacement_error(world, truth, template):
+    """ Sai lệch trung bình (mm) giữa hai ma trận trên các điểm não của mức mịn nhất. """
+    x = template.levels[-1]['points'].astype(np.float64) + template.center
+    xh = np.concatenate([x, np.ones((len(x), 1))], axis=1)
+    return float(np.linalg.norm(xh @ (world - truth)[:3].T, axis=1).mean())
+
+
+def run_flirt(moving_path, template_path, dof, workdir):
+    mat = os.path.join(workdir, "flirt.mat")
+    subprocess.run(["flirt", "-in", moving_path, "-ref", template_path, "-omat", mat, "-dof", str(dof)],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return np.loadtxt(mat)
+
+
+def validate(template_path=None, cases=4, dofs=(6, 12), seed=0, use_flirt=None):
+    """
+    Đăng ký các ảnh giả lập có phép biến đổi đã biết, so sai số (mm) và thời gian với flirt (nếu có trên PATH).
+    Trả về list dict: dof, case, error_mm, seconds, flirt_error_mm, flirt_seconds.
+    """
+    rng = np.random.default_rng(seed)
+    use_flirt = shutil.which("flirt") is not None if use_flirt is None else use_flirt
+    with tempfile.TemporaryDirectory() as workdir:
+        if template_path is None:
+            template_path = os.path.join(workdir, "template.nii.gz")
+            nib.save(synthetic_template(seed=seed), template_path)
+        template_img = nib.load(template_path)
+        start = time.perf_counter()
+        template = get_template(template_path)
+        print(f"Template pyramid: {time.perf_counter() - start:.2f}s")
+
+        results = []
+        for dof in dofs:
+            for case in range(cases):
+                truth = random_transform(dof, rng)
+                moving = synthesize_moving(template_img, truth, rng=rng)
+                start = time.perf_counter()
+                world = register(moving, template, dof=dof)
+                r = {'dof': dof, 'case': case, 'error_mm': displacement_error(world, truth, template),
+                     'seconds': time.perf_counter() - start, 'flirt_error_mm': None, 'flirt_seconds': None}
+                if use_flirt:
+                    moving_path = os.path.join(workdir, "moving.nii.gz")
+                    nib.save(moving, moving_path)
+                    start = time.perf_counter()
+                    mat = run_flirt(moving_path, template_path, dof, workdir)
+                    r['flirt_seconds'] = time.perf_counter() - start
+                    flirt_world = flirt_to_world(mat, nib.load(moving_path), template_img)
+                    r['flirt_error_mm'] = displacement_error(flirt_world, truth, template)
+                results.append(r)
+    return results
+
+
+def _warm(template_path):
+    get_template(template_path)
+
+
+def throughput(n_subjects=8, workers=4, dof=12, shape=(182, 218, 182), seed=0):
+    """ Số subject/giây khi đăng ký tuần tự, bằng `workers` thread và bằng pool `workers` tiến trình. """
+    rng = np.random.default_rng(seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        template_img = synthetic_template(shape=shape, voxel=1.0, seed=seed)
+        template_path = os.path.join(workdir, "template.nii")
+        nib.save(template_img, template_path)
+        jobs = []
+        for i in range(n_subjects):
+            path = os.path.join(workdir, f"moving{i}.nii")
+            nib.save(synthesize_moving(template_img, random_transform(dof, rng), rng=rng), path)
+            jobs.append((path, template_path, os.path.join(workdir, f"out{i}.nii"), dof))
+        get_template(template_path)
+
+        start = time.perf_counter()
+        for job in jobs:
+            register_file(*job)
+        results['serial'] = n_subjects / (time.perf_counter() - start)
+
+        with ThreadPoolExecutor(workers) as pool:
+            start = time.perf_counter()
+            list(pool.map(lambda job: register_file(*job), jobs))
+            results['threads'] = n_subjects / (time.perf_counter() - start)
+
+        with ProcessPoolExecutor(workers, mp_context=mp.get_context("spawn")) as pool:
+            # khởi động worker và dựng template trước khi bấm giờ, như pool sống suốt một lần chạy
+            list(pool.map(_warm, [template_path] * workers))
+            start = time.perf_counter()
+            list(pool.map(register_file, *zip(*jobs)))
+            results['processes'] = n_subjects / (time.perf_counter() - start)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kiểm tra đăng ký affine trong tiến trình trên ảnh giả lập, so với flirt.")
+    parser.add_argument("--template", default=None, help="vd. templates/FMRIB58_FA_1mm.nii.gz (mặc định: ảnh giả lập 2mm)")
+    parser.add_argument("--cases", type=int, default=4)
+    parser.add_argument("--dof", type=int, nargs="+", default=[6, 12], choices=[6, 12])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-flirt", action="store_true")
+    parser.add_argument("--throughput", type=int, default=0, metavar="N",
+                        help="đo subject/giây với N ảnh: tuần tự, thread, pool tiến trình (--workers)")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.throughput:
+        for name, rate in throughput(args.throughput, args.workers).items():
+            print(f"{name:>10}: {rate:.2f} subjects/s")
+        return
+
+    results = validate(args.template, args.cases, args.dof, args.seed, use_flirt=False if args.no_flirt else None)
+    print(f"{'dof':>3} {'case':>4} {'error(mm)':>10} {'time(s)':>8} {'flirt err':>10} {'flirt(s)':>9}")
+    for r in results:
+        flirt = (f"{r['flirt_error_mm']:>10.3f} {r['flirt_seconds']:>9.2f}" if r['flirt_error_mm'] is not None
+                 else f"{'-':>10} {'-':>9}")
+        print(f"{r['dof']:>3} {r['case']:>4} {r['error_mm']:>10.3f} {r['seconds']:>8.2f} {flirt}")
+
+
+if __name__ == "__main__":
+    main()
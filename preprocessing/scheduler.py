@@ -0,0 +1,196 @@
+import os
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def available_memory_gb():
+    """ Bộ nhớ còn trống (MemAvailable trong /proc/meminfo); None nếu không đọc được. """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / (1024 ** 2)
+    except OSError:
+        pass
+    return None
+
+
+class Task:
+    """
+    Một stage của một subject.
+
+    kind: "io" (dcm2niix, fslroi, copy...) hoặc "cpu" (bet, dtifit, flirt).
+    mem_gb: bộ nhớ ước tính, dùng để không chạy quá nhiều stage nặng cùng lúc.
+    fn nhận dict {tên stage phụ thuộc: kết quả} và trả về kết quả của stage.
+    """
+    def __init__(self, fn, deps=(), kind="cpu", mem_gb=0.5):
+        self.fn = fn
+        self.deps = list(deps)
+        self.kind = kind
+        self.mem_gb = mem_gb
+
+
+class _MemoryBudget:
+    """ Ngân sách bộ nhớ; chỉ dùng dưới lock của Scheduler, không bao giờ chặn thread. """
+    def __init__(self, budget_gb):
+        self.budget = budget_gb
+        self.used = 0.0
+
+    def try_acquire(self, gb):
+        # một task lớn hơn cả budget vẫn được chạy khi không có gì khác đang chạy
+        gb = min(gb, self.budget)
+        if self.used + gb > self.budget:
+            return None
+        self.used += gb
+        return gb
+
+    def release(self, gb):
+        self.used -= gb
+
+
+def dag_depths(dag):
+    """ Độ sâu của mỗi stage: số stage trên đường dài nhất từ gốc (gốc = 0). """
+    depths = {}
+
+    def depth(name):
+        if name not in depths:
+            depths[name] = 1 + max((depth(d) for d in dag[name].deps), default=-1)
+        return depths[name]
+
+    for name in dag:
+        depth(name)
+    return depths
+
+
+class Scheduler:
+    """
+    Chạy mỗi subject như một DAG các stage.
+
+    Các công cụ FSL / dcm2niix là tiến trình con nên dùng thread là đủ: pool "io"
+    cho các stage đọc/ghi nhẹ, pool "cpu" cho các stage nặng, cùng một ngân sách bộ
+    nhớ chung. Nhờ vậy dcm2niix/fslroi của subject này chạy chồng lên dtifit/flirt
+    của subject khác.
+
+    Stage sẵn sàng chờ trong hàng đợi ưu tiên theo độ sâu trong DAG (sâu hơn trước,
+    rồi subject gửi trước): fslroi của subject 1 không phải xếp sau dcm2niix của mọi
+    subject, nên pool "cpu" sớm có việc. Bộ nhớ được giữ trước khi gửi stage vào pool,
+    thread trong pool không bao giờ ngồi chờ ngân sách.
+    """
+    def __init__(self, cpu_slots=None, io_slots=None, mem_budget_gb=None):
+        cores = os.cpu_count() or 1
+        self.cpu_slots = cpu_slots or cores
+        self.io_slots = io_slots or max(2, cores // 4)
+        if mem_budget_gb is None:
+            free = available_memory_gb()
+            mem_budget_gb = 0.8 * free if free else 2.0 * self.cpu_slots
+        self.memory = _MemoryBudget(mem_budget_gb)
+        self.slots = {"cpu": self.cpu_slots, "io": self.io_slots}
+        self.pools = {
+            "cpu": ThreadPoolExecutor(self.cpu_slots, thread_name_prefix="cpu"),
+            "io": ThreadPoolExecutor(self.io_slots, thread_name_prefix="io"),
+        }
+        self.running = {kind: 0 for kind in self.pools}
+        self.ready = {kind: [] for kind in self.pools}
+        self.cond = threading.Condition()
+        self._order = itertools.count()
+        self._dags = itertools.count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self):
+        # stage phụ thuộc được gửi từ callback, nên phải chờ hàng đợi rỗng trước khi đóng pool
+        with self.cond:
+            while any(self.running.values()) or any(self.ready.values()):
+                self.cond.wait()
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
+
+    def _push(self, task, priority, run):
+        with self.cond:
+            heapq.heappush(self.ready[task.kind], (priority, next(self._order), task, run))
+        self._dispatch()
+
+    def _dispatch(self):
+        """ Gửi stage ưu tiên nhất của mỗi pool khi còn slot và đủ bộ nhớ. """
+        started = []
+        with self.cond:
+            for kind, heap in self.ready.items():
+                while heap and self.running[kind] < self.slots[kind]:
+                    gb = self.memory.try_acquire(heap[0][2].mem_gb)
+                    if gb is None:
+                        break
+                    _, _, task, run = heapq.heappop(heap)
+                    self.running[kind] += 1
+                    started.append((task, run, gb))
+        for task, run, gb in started:
+            self.pools[task.kind].submit(self._run_task, task, run, gb)
+
+    def _run_task(self, task, run, gb):
+        try:
+            run()
+        finally:
+            with self.cond:
+                self.memory.release(gb)
+                self.running[task.kind] -= 1
+                self.cond.notify_all()
+            self._dispatch()
+
+    def submit(self, dag):
+        """
+        Gửi một DAG {tên: Task}. Trả về Future với kết quả {tên: kết quả} khi mọi
+        stage xong, hoặc exception của stage đầu tiên bị lỗi (các stage chưa chạy bị bỏ qua).
+        """
+        done = Future()
+        results = {}
+        remaining = {name: set(task.deps) for name, task in dag.items()}
+        depths = dag_depths(dag)
+        dag_order = next(self._dags)
+        lock = threading.Lock()
+
+        def launch(name):
+            task = dag[name]
+            inputs = {d: results[d] for d in task.deps}
+
+            def run():
+                if done.done():
+                    return
+                try:
+                    result = task.fn(inputs)
+                except BaseException as error:
+                    with lock:
+                        if not done.done():
+                            done.set_exception(error)
+                    return
+                finished(name, result)
+
+            self._push(task, (-depths[name], dag_order), run)
+
+        def finished(name, result):
+            ready = []
+            with lock:
+                if done.done():
+                    return
+                results[name] = result
+                del remaining[name]
+                for other, deps in remaining.items():
+                    if name in deps:
+                        deps.discard(name)
+                        if not deps:
+                            ready.append(other)
+                if not remaining:
+                    done.set_result(dict(results))
+            for other in ready:
+                launch(other)
+
+        roots = [name for name, deps in remaining.items() if not deps]
+        if not roots:
+            raise ValueError("DAG has no root task")
+        for name in roots:
+            launch(name)
+        return done
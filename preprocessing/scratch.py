@@ -0,0 +1,64 @@
+import os
+import gzip
+import shutil
+import tempfile
+
+
+def default_scratch_root():
+    """ Thư mục scratch: biến môi trường SCRATCH_DIR, nếu không có thì /dev/shm (tmpfs), cuối cùng là /tmp. """
+    root = os.environ.get("SCRATCH_DIR")
+    if root:
+        return root
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def fsl_env(compressed=False):
+    """ Môi trường cho các lệnh FSL: ghi .nii (không nén) cho file trung gian. """
+    env = os.environ.copy()
+    env["FSLOUTPUTTYPE"] = "NIFTI_GZ" if compressed else "NIFTI"
+    return env
+
+
+def compress_nifti(src, dst, level=6):
+    """ Nén file .nii trung gian thành artifact .nii.gz cuối cùng (ghi tạm rồi đổi tên). """
+    tmp = dst + ".part"
+    with open(src, "rb") as f_in, gzip.open(tmp, "wb", compresslevel=level) as f_out:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+    os.replace(tmp, dst)
+    return dst
+
+
+class ScratchDir:
+    """
+    Thư mục làm việc tạm cho các file trung gian không nén.
+
+    Dùng với `with ScratchDir() as tmp:`; thư mục luôn bị xóa khi thoát,
+    kể cả khi stage bị lỗi. Có thể gọi cleanup() trực tiếp (idempotent).
+    """
+    def __init__(self, root=None, prefix="adni-"):
+        self.root = root or default_scratch_root()
+        self.prefix = prefix
+        self.path = None
+
+    def create(self):
+        if self.path is None:
+            os.makedirs(self.root, exist_ok=True)
+            self.path = tempfile.mkdtemp(prefix=self.prefix, dir=self.root)
+        return self.path
+
+    def join(self, *parts):
+        return os.path.join(self.create(), *parts)
+
+    def cleanup(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    def __enter__(self):
+        self.create()
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
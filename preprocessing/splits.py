@@ -0,0 +1,139 @@
+import os
+import random
+import argparse
+import numpy as np
+import pandas as pd
+
+
+SPLIT_COUNTS = {1: 10, 2: 5, 3: 5}
+# xác suất BỎ QUA một dòng khi sinh dữ liệu tăng cường (p2.py / m2.py)
+DTI_SKIP_PROB = {2: 0.7, 3: 0.2}
+MRI_SKIP_PROB = {3: 0.2}
+EXCLUDED_SUBJECTS = ['022_S_5004']
+
+
+def prepare_final(df):
+    """ Các bước đầu của p1.ipynb: cột chữ thường, link dạng '/', bỏ subject lỗi, thêm subject_id. """
+    df = df.copy()
+    df.columns = df.columns.str.lower()
+    df['dti_link'] = df['dti_link'].str.replace('\\', '/', regex=False)
+    df['mri_link'] = df['mri_link'].str.replace('\\', '/', regex=False)
+    for subject in EXCLUDED_SUBJECTS:
+        df = df[~df['dti_link'].str.contains(subject, regex=False)]
+    df['subject_id'] = df['dti_link'].str.split('/').str[2]
+    return df
+
+
+def sample_by_label(df, label_col, counts, seed=42):
+    """ Lấy ngẫu nhiên counts[label] dòng cho mỗi nhãn (giống hệt p1.ipynb). """
+    sampled = []
+    remaining = []
+    for label, n in counts.items():
+        subset = df[df[label_col] == label]
+        n_samples = min(len(subset), n)
+        sampled_part = subset.sample(n=n_samples, random_state=seed)
+        sampled.append(sampled_part)
+        remaining.append(subset.drop(sampled_part.index))
+    return pd.concat(sampled), pd.concat(remaining)
+
+
+def absorb_subjects(sampled, remaining, subject_col='subject_id'):
+    """
+    Chuyển mọi dòng còn lại của các subject đã được chọn sang `sampled`.
+
+    Thay cho vòng lặp concat/lọc theo từng subject: các dòng được chuyển giữ đúng
+    thứ tự như vòng lặp cũ (theo thứ tự xuất hiện của subject trong `sampled`,
+    rồi theo thứ tự trong `remaining`).
+    """
+    order = pd.Series(np.arange(sampled[subject_col].nunique()), index=sampled[subject_col].unique())
+    rank = remaining[subject_col].map(order)
+    moved = rank.notna().to_numpy()
+
+    moving = remaining[moved]
+    moving = moving.iloc[np.argsort(rank[moved].to_numpy(), kind='stable')]
+    return pd.concat([sampled, moving]), remaining[~moved]
+
+
+def split_by_subject(df, test_counts=SPLIT_COUNTS, val_counts=SPLIT_COUNTS, seed=42):
+    """ p1.ipynb: chia train / val / test không trùng subject. Trả về (train, val, test). """
+    test_df, remaining_df = sample_by_label(df, 'diagnosis', test_counts, seed)
+    test_df, remaining_df = absorb_subjects(test_df, remaining_df)
+
+    val_df, train_df = sample_by_label(remaining_df, 'diagnosis', val_counts, seed)
+    val_df, train_df = absorb_subjects(val_df, train_df)
+
+    return tuple(d.drop(columns=['subject_id']) for d in (train_df, val_df, test_df))
+
+
+def drop_fraction(df, label=1, fraction=0.3, seed=42):
+    """ p3.ipynb: xóa ngẫu nhiên `fraction` số dòng có diagnosis = label. """
+    rng = random.Random(seed)
+    indices = df[df['diagnosis'] == label].index.tolist()
+    return df.drop(rng.sample(indices, int(len(indices) * fraction)))
+
+
+def replication_counts(labels, skip_prob, seed=46, max_copies=3):
+    """
+    Số bản sao tăng cường cho từng dòng (0 = không tăng cường).
+
+    Chuỗi số ngẫu nhiên phải trùng với p2.py / m2.py (random.seed(46), một lần
+    random() cho mỗi dòng thuộc nhãn trong skip_prob, rồi randint(1, 3) nếu giữ lại),
+    nên phần rút số vẫn đi tuần tự qua mảng nhãn; phần tốn kém (ghi từng dòng vào
+    DataFrame) được thay bằng np.repeat trong augmentation_manifest.
+    """
+    rng = random.Random(seed)
+    counts = np.zeros(len(labels), dtype=np.int64)
+    for i, label in enumerate(labels):
+        p = skip_prob.get(label)
+        if p is None or rng.random() < p:
+            continue
+        counts[i] = rng.randint(1, max_copies)
+    return counts
+
+
+def augmentation_manifest(train_df, skip_prob=DTI_SKIP_PROB, seed=46, link_cols=('dti_link', 'mri_link')):
+    """
+    Tạo train_augmented.csv: mỗi dòng được chọn lặp lại k lần với link '<link>/1' ... '<link>/k'.
+
+    Giữ nguyên mọi cột của train_df theo tên; chỉ các cột link_cols được thêm hậu tố.
+    p2.py / m2.py gốc gán 5 giá trị theo vị trí vào các cột (..., dti_link, mri_link) của train.csv:
+    p2 ghi [..., dti_link, mri_link] nên khớp, còn m2 ghi [..., mri_link, dti_link] nên hai cột link
+    bị đảo. Với --mri kết quả ở đây khác m2: mỗi link nằm đúng cột tên của nó.
+    """
+    counts = replication_counts(train_df['diagnosis'].tolist(), skip_prob, seed)
+    rows = np.repeat(np.arange(len(train_df)), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    suffix = '/' + pd.Series(np.arange(len(rows)) - starts + 1).astype(str)
+
+    picked = train_df.iloc[rows].reset_index(drop=True)
+    for col in link_cols:
+        picked[col] = picked[col].astype(str) + suffix
+    return picked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chia train/val/test và sinh train_augmented.csv (p1, p2/m2, p3).")
+    parser.add_argument("--data", default="data")
+    parser.add_argument("--mri", action="store_true", help="sinh dữ liệu tăng cường như m2.py (chỉ nhãn 3)")
+    args = parser.parse_args()
+
+    df = prepare_final(pd.read_csv(os.path.join(args.data, 'final.csv')))
+    train_df, val_df, test_df = split_by_subject(df)
+    val_df.to_csv(os.path.join(args.data, 'val.csv'), index=False)
+    test_df.to_csv(os.path.join(args.data, 'test.csv'), index=False)
+
+    # p2 / m2 đọc lại train.csv do p1 ghi ra
+    train_df.to_csv(os.path.join(args.data, 'train.csv'), index=False)
+    train_df = pd.read_csv(os.path.join(args.data, 'train.csv'))
+    if args.mri:
+        augmented = augmentation_manifest(train_df, MRI_SKIP_PROB)
+    else:
+        augmented = augmentation_manifest(train_df, DTI_SKIP_PROB)
+    augmented.to_csv(os.path.join(args.data, 'train_augmented.csv'), index=False)
+
+    drop_fraction(train_df).to_csv(os.path.join(args.data, 'train.csv'), index=False)
+    print("Train:", len(train_df), "Val:", len(val_df), "Test:", len(test_df), "Augmented:", len(augmented))
+
+
+if __name__ == "__main__":
+    main()
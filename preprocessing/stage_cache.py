@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import shutil
+import threading
+import hashlib
+
+
+def hash_files(paths, chunk_size=1 << 20):
+    """ Hash sha256 nội dung (và tên) của một danh sách file, vd. toàn bộ DICOM của một series. """
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        h.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(chunk_size), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def hash_dir(path):
+    """ Hash nội dung mọi file (không đệ quy) trong thư mục. """
+    files = [e.path for e in os.scandir(path) if e.is_file()]
+    return hash_files(files)
+
+
+def stage_key(stage, *parts):
+    """ Khóa của một stage = hash(tên stage, khóa stage trước, tham số). """
+    payload = json.dumps([stage, [str(p) for p in parts]])
+    return hashlib.sha256(payload.encode()).hexdigest()[:24]
+
+
+class StageCache:
+    """
+    Cache theo nội dung cho từng stage: <root>/<stage>/<key>/ chứa output và manifest.json.
+
+    Stage chỉ chạy lại khi chưa có manifest cho khóa đó; stage chạy trong thư mục
+    tạm rồi mới đổi tên, nên một lần chạy bị ngắt không để lại kết quả dở dang.
+    Chỉ các output được trả về được giữ lại, file phụ khác của công cụ bị xóa.
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def stage_dir(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def lookup(self, stage, key):
+        manifest = os.path.join(self.stage_dir(stage, key), self.MANIFEST)
+        if not os.path.exists(manifest):
+            return None
+        with open(manifest) as f:
+            record = json.load(f)
+        outputs = [os.path.join(self.stage_dir(stage, key), o) for o in record["outputs"]]
+        if not all(os.path.exists(o) for o in outputs):
+            return None
+        return outputs
+
+    def run(self, stage, key, fn, events=None, **info):
+        """
+        Chạy fn(work_dir) nếu chưa có trong cache. fn trả về đường dẫn output
+        (một path hoặc tuple) nằm trong work_dir. Trả về các path tương ứng trong cache.
+        """
+        cached = self.lookup(stage, key)
+        if cached is not None:
+            if events is not None:
+                events.append({"stage": stage, "key": key, "status": "cached", **info})
+            return cached[0] if len(cached) == 1 else tuple(cached)
+
+        final_dir = self.stage_dir(stage, key)
+        work_dir = f"{final_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+
+        start = time.time()
+        try:
+            result = fn(work_dir)
+        except Exception as e:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            if events is not None:
+                events.append({"stage": stage, "key": key, "status": "failed", "error": str(e),
+                               "seconds": round(time.time() - start, 3), **info})
+            raise
+
+        outputs = list(result) if isinstance(result, (tuple, list)) else [result]
+        rel = [os.path.relpath(o, work_dir) for o in outputs]
+        self._prune(work_dir, {os.path.normpath(os.path.join(work_dir, r)) for r in rel})
+        with open(os.path.join(work_dir, self.MANIFEST), "w") as f:
+            json.dump({"stage": stage, "key": key, "outputs": rel, "created": time.time(), **info}, f)
+
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.makedirs(os.path.dirname(final_dir), exist_ok=True)
+        os.replace(work_dir, final_dir)
+
+        if events is not None:
+            events.append({"stage": stage, "key": key, "status": "done",
+                           "seconds": round(time.time() - start, 3), **info})
+        paths = [os.path.join(final_dir, r) for r in rel]
+        return paths[0] if len(paths) == 1 else tuple(paths)
+
+
+    @staticmethod
+    def _prune(work_dir, keep):
+        for root, _, files in os.walk(work_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.normpath(path) not in keep:
+                    os.remove(path)
+
+
+class Journal:
+    """ Nhật ký JSONL riêng cho mỗi lần chạy; chỉ tiến trình chính ghi vào. """
+    def __init__(self, log_dir, name="run"):
+        os.makedirs(log_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(log_dir, f"{name}-{stamp}-{os.getpid()}.jsonl")
+
+    def write(self, records):
+        with open(self.path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
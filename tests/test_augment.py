@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "training"))
+from augment import BatchAffine3D  # noqa: E402
+from precision import synthetic_batch, train_step  # noqa: E402
+
+
+class Recorder(torch.nn.Module):
+    """ Model giả: ghi lại inputs nhận được, logits từ trung bình ảnh. """
+    def __init__(self):
+        super().__init__()
+        self.fc = torch.nn.Linear(2, 3)
+        self.seen = None
+
+    def forward(self, mri, dti, age, gender):
+        self.seen = {'mri': mri, 'dti': dti}
+        return self.fc(torch.stack([mri.mean((1, 2, 3, 4)), dti.mean((1, 2, 3, 4))], dim=1))
+
+
+def test_train_step_applies_paired_batch_affine():
+    batch = synthetic_batch(4, (24, 24, 8))
+    batch['dti'] = batch['mri'].clone()
+    inputs = {k: batch[k] for k in ('mri', 'dti', 'age', 'gender')}
+    model = Recorder()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+
+    train_step(model, inputs, batch['label'], torch.nn.CrossEntropyLoss(), optimizer, 'fp32', BatchAffine3D(seed=0))
+
+    seen = model.seen
+    assert not torch.equal(seen['mri'], batch['mri'])
+    # MRI và DTI của cùng một mẫu nhận cùng một phép biến đổi
+    assert torch.equal(seen['mri'], seen['dti'])
+
+
+def test_batch_affine_is_identity_in_eval():
+    batch = synthetic_batch(2, (24, 24, 8))
+    out = BatchAffine3D(seed=0).eval()(batch)
+    assert out['mri'] is batch['mri'] and out['dti'] is batch['dti']
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pydicom")
+pytest.importorskip("dicom2nifti")
+pytest.importorskip("nipype")
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing", "MRI"))
+import m1  # noqa: E402
+
+# LPS: trục x, y bị lật so với RAS
+LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def test_dicom_to_nifti_uncompressed_roundtrip(tmp_path, monkeypatch):
+    data = np.arange(32 * 24 * 16, dtype=np.int16).reshape(32, 24, 16)
+    dicom_dir = tmp_path / "dicom"
+    dicom_dir.mkdir()
+    (dicom_dir / "I0001.dcm").write_bytes(b"")
+
+    def convert_directory(src, output_dir, compression=True):
+        nib.save(nib.Nifti1Image(data, LPS), os.path.join(output_dir, "series.nii"))
+
+    monkeypatch.setattr(m1.pydicom, "dcmread", lambda path: None)
+    monkeypatch.setattr(m1.dicom2nifti, "convert_directory", convert_directory)
+
+    save_path = str(tmp_path / "out" / "image.nii")
+    os.makedirs(os.path.dirname(save_path))
+    assert m1.dicom_to_nifti(str(dicom_dir), save_path, compression=False)
+
+    img = nib.load(save_path)
+    assert nib.aff2axcodes(img.affine) == ("R", "A", "S")
+    np.testing.assert_array_equal(np.asarray(img.dataobj), data[::-1, ::-1, :])
+    assert sorted(os.listdir(os.path.dirname(save_path))) == ["image.nii"]
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "training"))
+from madnet import MADNet, StackedMADNet  # noqa: E402
+from precision import synthetic_batch  # noqa: E402
+
+
+def _train_model_checkpoint(path, model):
+    """ Lưu giống train_model trong notebook MADNet. """
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=10)
+    torch.save({
+        'epoch': 1,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scheduler_state_dict': scheduler.state_dict(),
+        'best_acc': 0.5,
+        'history': {'train_loss': [1.0]},
+    }, path)
+
+
+@pytest.mark.parametrize("source", ["path", "dict"])
+def test_stacked_loads_train_model_checkpoint(tmp_path, source):
+    torch.manual_seed(0)
+    model = MADNet(num_classes=3).eval()
+    path = str(tmp_path / "checkpoint.pt")
+    _train_model_checkpoint(path, model)
+
+    state = path if source == "path" else torch.load(path, map_location='cpu')
+    stacked = StackedMADNet().load_madnet_state_dict(state).eval()
+
+    batch = synthetic_batch(2, (32, 32, 4))
+    inputs = [batch[k] for k in ('mri', 'dti', 'age', 'gender')]
+    with torch.no_grad():
+        assert torch.allclose(stacked(*inputs), model(*inputs), atol=1e-4)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+registration = pytest.importorskip("registration")
+
+
+# sai số dịch chuyển trung bình tối đa (mm) trên các điểm não của template giả lập 2mm
+MAX_ERROR_MM = {6: 0.5, 12: 1.0}
+
+
+@pytest.mark.parametrize("dof", [6, 12])
+def test_recovers_known_transforms(dof):
+    results = registration.validate(cases=3, dofs=(dof,), seed=0, use_flirt=False)
+    errors = [r['error_mm'] for r in results]
+    assert max(errors) < MAX_ERROR_MM[dof], errors
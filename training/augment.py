@@ -0,0 +1,100 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+AUGMENTED_SUFFIX = r'/\d+$'
+
+
+def strip_augmented_suffix(df):
+    """
+    Trỏ các dòng của train_augmented.csv (link/1, link/2, ...) về ảnh gốc.
+
+    Số bản sao mỗi ảnh vẫn giữ nguyên (tác dụng oversampling như p2/m2), còn phép
+    biến đổi ngẫu nhiên được làm trực tiếp trên batch bằng BatchAffine3D, nên
+    không cần chạy p5.py / m3.py để ghi các ảnh tăng cường ra đĩa.
+    """
+    df = df.copy()
+    for col in ['mri_link', 'dti_link']:
+        df[col] = df[col].str.replace(AUGMENTED_SUFFIX, '', regex=True)
+    return df
+
+
+def _rotation_matrix(angles):
+    """ angles: (B, 3) radian quanh 3 trục -> (B, 3, 3). """
+    cx, cy, cz = torch.cos(angles).unbind(1)
+    sx, sy, sz = torch.sin(angles).unbind(1)
+    one, zero = torch.ones_like(cx), torch.zeros_like(cx)
+    rx = torch.stack([one, zero, zero, zero, cx, -sx, zero, sx, cx], 1).view(-1, 3, 3)
+    ry = torch.stack([cy, zero, sy, zero, one, zero, -sy, zero, cy], 1).view(-1, 3, 3)
+    rz = torch.stack([cz, -sz, zero, sz, cz, zero, zero, zero, one], 1).view(-1, 3, 3)
+    return rz @ ry @ rx
+
+
+def random_affine_3d(batch_size, size, degrees=10, translate=2, scale=(0.9, 1.1), generator=None, device='cpu'):
+    """
+    Sinh ma trận affine ngẫu nhiên (B, 3, 4) cho affine_grid của ảnh có kích thước không gian size = (D, H, W).
+
+    Phép xoay / scale / dịch được dựng trong không gian voxel (ảnh MNI 1mm, voxel đẳng hướng) rồi
+    đổi sang tọa độ chuẩn hóa [-1, 1] theo kích thước từng trục: theta = S^-1 [A | t] S, với
+    S = diag(W/2, H/2, D/2) (align_corners=False). Nhờ vậy trên slab mỏng như (182, 182, 10) phép
+    xoay vẫn là xoay cứng chứ không thành shear.
+    degrees: góc xoay tối đa (độ) quanh mỗi trục; translate: dịch tối đa (voxel) theo mỗi trục.
+    """
+    def uniform(low, high, *shape):
+        return torch.rand(*shape, generator=generator) * (high - low) + low
+
+    angles = uniform(-degrees, degrees, batch_size, 3) * (math.pi / 180)
+    scales = uniform(scale[0], scale[1], batch_size, 1, 1)
+    shifts = uniform(-translate, translate, batch_size, 3)
+
+    # affine_grid dùng thứ tự trục (x, y, z) = (W, H, D)
+    half = torch.tensor([size[2], size[1], size[0]], dtype=torch.float32) / 2
+    linear = _rotation_matrix(angles) / scales
+    linear = linear * half.view(1, 1, 3) / half.view(1, 3, 1)
+    theta = torch.cat([linear, (shifts / half).unsqueeze(2)], dim=2)
+    return theta.to(device)
+
+
+class BatchAffine3D(nn.Module):
+    """
+    Tăng cường affine 3D trên cả batch đã collate, bằng một lần grid_sample.
+
+    Các modality trong `keys` được ghép theo kênh nên MRI và DTI của cùng một mẫu
+    nhận đúng cùng một phép biến đổi. Chỉ hoạt động khi module ở chế độ train().
+    Vùng ngoài ảnh được điền 0, trùng với giá trị nền sau chuẩn hóa + pad. translate tính theo voxel.
+    """
+    def __init__(self, keys=('mri', 'dti'), degrees=10, translate=2, scale=(0.9, 1.1), p=1.0, seed=None):
+        super().__init__()
+        self.keys = keys
+        self.degrees = degrees
+        self.translate = translate
+        self.scale = scale
+        self.p = p
+        self.generator = torch.Generator().manual_seed(seed) if seed is not None else None
+
+    def forward(self, batch):
+        if not self.training:
+            return batch
+        keys = [k for k in self.keys if k in batch]
+        if not keys:
+            return batch
+        volumes = torch.cat([batch[k] for k in keys], dim=1)  # (B, C_tổng, D, H, W)
+        B = volumes.size(0)
+
+        theta = random_affine_3d(B, volumes.shape[2:], self.degrees, self.translate, self.scale, self.generator,
+                                 volumes.device)
+        if self.p < 1.0:
+            # mẫu không được chọn giữ ma trận đơn vị
+            keep = torch.rand(B, generator=self.generator).to(volumes.device) >= self.p
+            identity = torch.eye(3, 4, device=volumes.device).expand(B, 3, 4)
+            theta = torch.where(keep.view(B, 1, 1), identity, theta)
+
+        grid = F.affine_grid(theta.to(volumes.dtype), volumes.shape, align_corners=False)
+        warped = F.grid_sample(volumes, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+        out = dict(batch)
+        for k, part in zip(keys, warped.split([batch[k].size(1) for k in keys], dim=1)):
+            out[k] = part
+        return out
@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from nifti_io import load_nifti, load_slab, resize_vol, write_stats
+from datasets import model_dataset
+from checkpoints import ARCHITECTURES, build_model
+
+
+# kích thước ảnh sau đăng ký MNI 1mm (MNI152_T1_1mm / FMRIB58_FA_1mm)
+VOLUME_SHAPE = (182, 218, 182)
+
+
+def make_synthetic_data(root, n_subjects=12, shape=VOLUME_SHAPE, seed=0):
+    """
+    Sinh ảnh MRI/DTI NIfTI giả (image.nii, float32) và train/val/test.csv cùng schema với dữ liệu thật:
+    mri_link, dti_link, diagnosis, ptgender, age_at_visit. Link tương đối so với `root`.
+    """
+    rng = np.random.default_rng(seed)
+    zz, yy, xx = np.meshgrid(*[np.linspace(-1, 1, s, dtype=np.float32) for s in shape], indexing='ij')
+    brain = (zz ** 2 + yy ** 2 + xx ** 2 < 0.8).astype(np.float32)
+
+    rows = []
+    for i in range(n_subjects):
+        subject = f"{100 + i:03d}_S_{1000 + i:04d}"
+        row = {'diagnosis': i % 3 + 1, 'ptgender': i % 2 + 1, 'age_at_visit': float(rng.uniform(60, 90))}
+        for modality, scale in (('mri', 1000.0), ('dti', 1.0)):
+            link = f"{modality.upper()}/{subject}/scan/I{i:05d}"
+            os.makedirs(os.path.join(root, link), exist_ok=True)
+            vol = brain * scale * (0.5 + rng.random(shape, dtype=np.float32))
+            path = os.path.join(root, link, 'image.nii')
+            nib.save(nib.Nifti1Image(vol, np.eye(4)), path)
+            write_stats(path)
+            row[f'{modality}_link'] = link
+        rows.append(row)
+
+    df = pd.DataFrame(rows, columns=['mri_link', 'dti_link', 'diagnosis', 'ptgender', 'age_at_visit'])
+    n_val = n_test = max(3, n_subjects // 6)
+    splits = {'test': df[:n_test], 'val': df[n_test:n_test + n_val], 'train': df[n_test + n_val:]}
+    for name, part in splits.items():
+        part.to_csv(os.path.join(root, f'{name}.csv'), index=False)
+    return root
+
+
+def timeit(fn, repeat=5, warmup=1):
+    """ Thời gian trung vị (giây) của fn() qua `repeat` lần chạy. """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def datasets_for(arch, root):
+    train = pd.read_csv(os.path.join(root, 'train.csv'))
+    mean, std = train['age_at_visit'].mean(), train['age_at_visit'].std(ddof=0)
+    return {name: model_dataset(arch, pd.read_csv(os.path.join(root, f'{name}.csv')), root, mean, std)
+            for name in ('train', 'val')}
+
+
+def bench_primitives(root, repeat=5):
+    path = os.path.join(root, pd.read_csv(os.path.join(root, 'train.csv'))['mri_link'][0], 'image.nii')
+    vol = load_nifti(path)
+    return {
+        'load_nifti_s': (timeit(lambda: load_nifti(path), repeat), False),
+        'resize_vol_s': (timeit(lambda: resize_vol(vol, (182, 182, 10)), repeat), False),
+        'load_slab_s': (timeit(lambda: load_slab(path, (182, 182, 10)), repeat), False),
+    }
+
+
+def bench_model(arch, root, batch_size=4, repeat=3, num_workers=0):
+    """ Throughput loader, thời gian một bước train và một lượt eval trên tập val (trung vị của `repeat` lần). """
+    torch.manual_seed(0)
+    sets = datasets_for(arch, root)
+    keys = ARCHITECTURES[arch][1]
+    loader = DataLoader(sets['train'], batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    val_loader = DataLoader(sets['val'], batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    def epoch():
+        for _ in loader:
+            pass
+    loader_rate = len(sets['train']) / timeit(epoch, repeat)
+
+    model = build_model(arch)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-5)
+    batch = next(iter(loader))
+    inputs = [batch[k].float() for k in keys]
+
+    def train_step():
+        model.train()
+        optimizer.zero_grad()
+        criterion(model(*inputs), batch['label']).backward()
+        optimizer.step()
+
+    @torch.no_grad()
+    def eval_pass():
+        model.eval()
+        for b in val_loader:
+            model(*[b[k].float() for k in keys])
+
+    return {
+        f'{arch}.loader_samples_per_s': (loader_rate, True),
+        f'{arch}.train_step_s': (timeit(train_step, repeat), False),
+        f'{arch}.eval_pass_s': (timeit(eval_pass, repeat), False),
+    }
+
+
+def run(root, archs=('madnet', 'multimodal'), batch_size=4, repeat=3):
+    results = dict(bench_primitives(root, repeat))
+    for arch in archs:
+        results.update(bench_model(arch, root, batch_size, repeat))
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'cpu_count': os.cpu_count(),
+            'threads': torch.get_num_threads(),
+            'machine': platform.machine(),
+        },
+        'results': {name: {'value': value, 'higher_is_better': higher}
+                    for name, (value, higher) in results.items()},
+    }
+
+
+# meta phải trùng với baseline thì số liệu mới so sánh được
+COMPARABLE_META = ('python', 'torch', 'cpu_count', 'threads', 'machine')
+
+
+def meta_mismatch(current, baseline):
+    """ Các khóa meta khác nhau giữa hai lần chạy: {khóa: (baseline, hiện tại)}. """
+    return {k: (baseline['meta'].get(k), current['meta'].get(k)) for k in COMPARABLE_META
+            if baseline['meta'].get(k) != current['meta'].get(k)}
+
+
+def compare(current, baseline, threshold=0.15, allow_meta_mismatch=False):
+    """
+    Trả về danh sách (tên, baseline, hiện tại, thay đổi tương đối) của các số liệu tệ hơn quá threshold.
+
+    Baseline đo trên máy / số thread / phiên bản torch khác thì không so sánh được: ValueError,
+    hoặc chỉ cảnh báo nếu allow_meta_mismatch.
+    """
+    mismatch = meta_mismatch(current, baseline)
+    if mismatch:
+        detail = ", ".join(f"{k}: {b} -> {c}" for k, (b, c) in mismatch.items())
+        if not allow_meta_mismatch:
+            raise ValueError(f"Baseline was measured in a different environment ({detail})")
+        print(f"Warning: baseline environment differs ({detail})")
+    regressions = []
+    for name, cur in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or not base['value']:
+            continue
+        change = (cur['value'] - base['value']) / base['value']
+        worse = -change if cur['higher_is_better'] else change
+        if worse > threshold:
+            regressions.append((name, base['value'], cur['value'], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark trên dữ liệu NIfTI giả lập, so sánh với baseline JSON.")
+    parser.add_argument("--data", default="bench_data", help="thư mục dữ liệu giả lập (tạo nếu chưa có)")
+    parser.add_argument("--subjects", type=int, default=12)
+    parser.add_argument("--arch", nargs="+", default=["madnet", "multimodal"], choices=sorted(ARCHITECTURES))
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="ghi kết quả lần này làm baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="tỉ lệ chậm đi tối đa cho phép")
+    parser.add_argument("--allow-meta-mismatch", action="store_true",
+                        help="vẫn so sánh khi cpu_count / threads / phiên bản torch khác baseline (chỉ cảnh báo)")
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.data, 'train.csv')):
+        make_synthetic_data(args.data, args.subjects)
+
+    current = run(args.data, args.arch, args.batch_size, args.repeat)
+    with open(args.out, 'w') as f:
+        json.dump(current, f, indent=2)
+    for name, r in current['results'].items():
+        print(f"{name:<36} {r['value']:.4f}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(current, f, indent=2)
+        print("Saved baseline", args.baseline)
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one.")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    try:
+        regressions = compare(current, baseline, args.threshold, args.allow_meta_mismatch)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+    for name, base, cur, change in regressions:
+        print(f"REGRESSION {name}: {base:.4f} -> {cur:.4f} ({change:+.1%})")
+    if regressions:
+        sys.exit(1)
+    print(f"No regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import torch
+
+
+# tên kiến trúc -> (target_shape mà Dataset tương ứng dùng, các khóa đầu vào theo thứ tự forward)
+ARCHITECTURES = {
+    'madnet': ((182, 182, 10), ('mri', 'dti', 'age', 'gender')),
+    'multimodal': ((6, 182, 182), ('mri', 'dti', 'age', 'gender')),
+}
+
+
+def build_model(arch, num_classes=3):
+    """ Dựng model rỗng (không tải trọng số pretrained) để nạp state_dict đã huấn luyện. """
+    if arch == 'madnet':
+        from madnet import MADNet
+        return MADNet(num_classes=num_classes)
+    if arch == 'multimodal':
+        from classifiers import MultimodalAlzheimerClassifier
+        return MultimodalAlzheimerClassifier(num_classes=num_classes, pretrained=False)
+    raise ValueError(f"Unknown architecture: {arch}")
+
+
+def load_state_dict(path, map_location='cpu'):
+    """ Đọc cả state_dict thuần (EarlyStopping.save_checkpoint) lẫn dict của train_model ('model_state_dict'). """
+    checkpoint = torch.load(path, map_location=map_location)
+    if isinstance(checkpoint, dict) and 'model_state_dict' in checkpoint:
+        return checkpoint['model_state_dict']
+    return checkpoint
+
+
+def load_model(path, arch='madnet', num_classes=3, device='cpu'):
+    model = build_model(arch, num_classes)
+    model.load_state_dict(load_state_dict(path))
+    return model.to(device).eval()
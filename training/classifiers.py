@@ -0,0 +1,162 @@
+import torch
+import torch.nn as nn
+import torchvision.models.video as models
+
+
+class TabularMLP(nn.Module):
+    def __init__(self, in_features=2, hidden_dim=64):
+        super().__init__()
+        self.model = nn.Sequential(
+            nn.Linear(in_features, hidden_dim),
+            nn.BatchNorm1d(hidden_dim),
+            nn.ReLU(),
+            nn.Dropout(0.3),
+            nn.Linear(hidden_dim, hidden_dim),
+            nn.ReLU()
+        )
+
+    def forward(self, x):
+        return self.model(x)
+
+
+class AttentionFusion(nn.Module):
+    def __init__(self, input_dim):
+        super().__init__()
+        self.attn_layer = nn.Sequential(
+            nn.Linear(input_dim, input_dim),
+            nn.Tanh(),
+            nn.Linear(input_dim, input_dim),
+            nn.Sigmoid()
+        )
+
+    def forward(self, x):
+        alpha = self.attn_layer(x)
+        return x * alpha
+
+
+def r3d_18_backbone(pretrained=True):
+    """ r3d_18 với stem 1 kênh, bỏ fc -> đầu ra (B, 512). """
+    backbone = models.r3d_18(pretrained=pretrained)
+    backbone.stem[0] = nn.Conv3d(1, 64, kernel_size=(3,7,7), stride=(1,2,2), padding=(1,3,3), bias=False)
+    backbone.fc = nn.Identity()
+    return backbone
+
+
+class MultimodalAlzheimerClassifier(nn.Module):
+    def __init__(self, num_classes=3, tabular_dim=2, backbone_out_dim=512, freeze_backbone=True, pretrained=True):
+        super().__init__()
+
+        # MRI backbone
+        self.mri_backbone = r3d_18_backbone(pretrained)
+
+        # DTI backbone
+        self.dti_backbone = r3d_18_backbone(pretrained)
+
+        if freeze_backbone:
+            for param in self.mri_backbone.parameters():
+                param.requires_grad = False
+            for param in self.dti_backbone.parameters():
+                param.requires_grad = False
+
+        self.tabular_branch = TabularMLP(in_features=tabular_dim, hidden_dim=64)
+
+        self.fusion_dim = 2 * backbone_out_dim + 64
+        self.attn_fusion = AttentionFusion(self.fusion_dim)
+
+        self.classifier = nn.Sequential(
+            nn.Linear(self.fusion_dim, 256),
+            nn.BatchNorm1d(256),
+            nn.ReLU(),
+            nn.Dropout(0.5),
+            nn.Linear(256, num_classes)
+        )
+        self.cached_features = False
+
+    def use_cached_features(self, enabled=True):
+        """ Bật chế độ nhận embedding backbone đã cache thay cho ảnh 3D. """
+        self.cached_features = enabled
+
+    def backbones(self):
+        return {'mri': self.mri_backbone, 'dti': self.dti_backbone}
+
+    def forward(self, mri, dti, age, gender):
+        if self.cached_features:
+            # mri/dti đã là embedding 512 chiều từ embedding_cache
+            return self.head(mri, dti, age, gender)
+        mri_feat = self.mri_backbone(mri)      # (B, 512)
+        dti_feat = self.dti_backbone(dti)      # (B, 512)
+        return self.head(mri_feat, dti_feat, age, gender)
+
+    def head(self, mri_feat, dti_feat, age, gender):
+        """ Phần sau backbone: tabular + fusion + classifier. """
+        tabular = torch.stack([age, gender], dim=1)
+        tab_feat = self.tabular_branch(tabular)  # (B, 64)
+
+        fused = torch.cat([mri_feat, dti_feat, tab_feat], dim=1)  # (B, 1088)
+        fused = self.attn_fusion(fused)
+
+        out = self.classifier(fused)
+        return out
+
+    def unfreeze_backbones(self):
+        for param in self.mri_backbone.parameters():
+            param.requires_grad = True
+        for param in self.dti_backbone.parameters():
+            param.requires_grad = True
+
+
+class SingleModalWithTabularClassifier(nn.Module):
+    def __init__(self, modality="mri", num_classes=3, tabular_dim=2, backbone_out_dim=512, freeze_backbone=True,
+                 pretrained=True):
+        super().__init__()
+
+        assert modality in ["mri", "dti"]
+        self.modality = modality
+
+        # Shared structure for either MRI or DTI
+        self.backbone = r3d_18_backbone(pretrained)
+
+        if freeze_backbone:
+            for param in self.backbone.parameters():
+                param.requires_grad = False
+
+        self.tabular_branch = TabularMLP(in_features=tabular_dim, hidden_dim=64)
+
+        self.fusion_dim = backbone_out_dim + 64
+        self.attn_fusion = AttentionFusion(self.fusion_dim)
+
+        self.classifier = nn.Sequential(
+            nn.Linear(self.fusion_dim, 256),
+            nn.BatchNorm1d(256),
+            nn.ReLU(),
+            nn.Dropout(0.5),
+            nn.Linear(256, num_classes)
+        )
+        self.cached_features = False
+
+    def use_cached_features(self, enabled=True):
+        """ Bật chế độ nhận embedding backbone đã cache thay cho ảnh 3D. """
+        self.cached_features = enabled
+
+    def backbones(self):
+        return {self.modality: self.backbone}
+
+    def forward(self, image, age, gender):
+        if self.cached_features:
+            return self.head(image, age, gender)
+        feat = self.backbone(image)
+        return self.head(feat, age, gender)
+
+    def head(self, feat, age, gender):
+        """ Phần sau backbone: tabular + fusion + classifier. """
+        tabular = torch.stack([age, gender], dim=1)
+        tab_feat = self.tabular_branch(tabular)
+
+        fused = torch.cat([feat, tab_feat], dim=1)
+        fused = self.attn_fusion(fused)
+
+        return self.classifier(fused)
+
+    def unfreeze_backbone(self):
+        for param in self.backbone.parameters():
+            param.requires_grad = True
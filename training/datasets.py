@@ -0,0 +1,151 @@
+import os
+import sys
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torchvision.transforms import RandomAffine
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from nifti_io import load_slab
+from sampling import subject_ids
+from instrument import trace
+from checkpoints import ARCHITECTURES
+
+
+class SlabDataset(Dataset):
+    """ Đọc slab qua load_slab, hoặc qua volume_cache (loaders.SharedVolumeCache) nếu được gắn. """
+    volume_cache = None
+
+    def load_volume(self, path):
+        with trace.timer("dataset.load"):
+            if self.volume_cache is not None:
+                return self.volume_cache.load(path, self.target_shape)
+            return load_slab(path, self.target_shape)
+
+
+class CustomDataset(SlabDataset):
+    """ Dataset MRI + DTI + tabular (medical-code-final.ipynb), đọc slab thay vì cả volume. """
+    def __init__(self, df, target_shape=(6, 182, 182)):
+        super().__init__()
+        self.df = df.reset_index(drop=True)
+        self.target_shape = target_shape
+        self.labels = self.df['label'].to_numpy(dtype=np.int64)
+        self.groups = subject_ids(self.df)
+
+    def __len__(self):
+        return len(self.df)
+
+    def __getitem__(self, idx):
+        row = self.df.iloc[idx]
+
+        mri_vol = self.load_volume(row['mri_link'])
+        dti_vol = self.load_volume(row['dti_link'])
+
+        # Chuyển thành tensor 5D: [C=1, D, H, W] mỗi modality
+        mri_tensor = torch.from_numpy(mri_vol).unsqueeze(0)  # (1, D, H, W)
+        dti_tensor = torch.from_numpy(dti_vol).unsqueeze(0)  # (1, D, H, W)
+
+        return {
+            'mri':    mri_tensor,
+            'dti':    dti_tensor,
+            'age':    torch.tensor(row['age'], dtype=torch.float32),
+            'gender': torch.tensor(row['gender'], dtype=torch.float32),
+            'label':  torch.tensor(row['label'], dtype=torch.long)
+        }
+
+
+class SingleModalDataset(SlabDataset):
+    """ Dataset một modality + tabular (dti-or-mri-only-final.ipynb). """
+    modality = None
+
+    def __init__(self, df, target_shape=(6, 182, 182)):
+        super().__init__()
+        self.df = df.reset_index(drop=True)
+        self.target_shape = target_shape
+        self.labels = self.df['label'].to_numpy(dtype=np.int64)
+        self.groups = subject_ids(self.df)
+
+    def __len__(self):
+        return len(self.df)
+
+    def __getitem__(self, idx):
+        row = self.df.iloc[idx]
+
+        vol = self.load_volume(row[f'{self.modality}_link'])
+        tensor = torch.from_numpy(vol).unsqueeze(0)  # (1, D, H, W)
+
+        return {
+            self.modality: tensor,
+            'age':    torch.tensor(row['age'], dtype=torch.float32),
+            'gender': torch.tensor(row['gender'], dtype=torch.float32),
+            'label':  torch.tensor(row['label'], dtype=torch.long)
+        }
+
+
+class MRIDataset(SingleModalDataset):
+    modality = 'mri'
+
+
+class DTIDataset(SingleModalDataset):
+    modality = 'dti'
+
+
+class MedicalDataset(SlabDataset):
+    """ Dataset của MADNet (models/Vinh/MRI+DTI_MADNet.ipynb). """
+    def __init__(self, df, data_dir, target_shape=(182, 182, 10), is_train=False):
+        super().__init__()
+        self.df = df.reset_index(drop=True)
+        self.data_dir = data_dir
+        self.target_shape = target_shape
+        self.is_train = is_train
+        self.labels = self.df['label'].to_numpy(dtype=np.int64)
+        self.groups = subject_ids(self.df)
+
+    def __len__(self):
+        return len(self.df)
+
+    def image_path(self, link):
+        return os.path.join(self.data_dir, link, 'image.nii').replace('\\', '/')
+
+    def __getitem__(self, idx):
+        row = self.df.iloc[idx]
+
+        mri_vol = self.load_volume(self.image_path(row['mri_link']))
+        dti_vol = self.load_volume(self.image_path(row['dti_link']))
+
+        # augment khi training
+        if self.is_train:
+            with trace.timer("dataset.augment"):
+                aug = RandomAffine(degrees=10, translate=(0.1, 0.1), scale=(0.9, 1.1))
+                mri_vol = aug(torch.from_numpy(mri_vol).unsqueeze(0)).squeeze().numpy()
+                dti_vol = aug(torch.from_numpy(dti_vol).unsqueeze(0)).squeeze().numpy()
+
+        mri_tensor = torch.from_numpy(mri_vol).unsqueeze(0)  # (1, D, H, W)
+        dti_tensor = torch.from_numpy(dti_vol).unsqueeze(0)  # (1, D, H, W)
+
+        return {
+            'mri': mri_tensor,
+            'dti': dti_tensor,
+            'age': torch.tensor(row['age_norm'], dtype=torch.float32),
+            'gender': torch.tensor(row['gender'], dtype=torch.float32),
+            'label': torch.tensor(row['label'], dtype=torch.long)
+        }
+
+
+def model_dataset(arch, df, data_dir, age_mean, age_std, target_shape=None):
+    """
+    Thêm các cột label / age / gender như trong notebook của từng kiến trúc rồi dựng Dataset.
+    target_shape mặc định là slab của kiến trúc; fullvolume.FULL_SHAPE để dùng cả volume.
+    """
+    target_shape = target_shape or ARCHITECTURES[arch][0]
+    df = df.copy()
+    df['label'] = df['diagnosis'] - 1
+    df['gender'] = df['ptgender'] - 1
+    if arch == 'madnet':
+        # StandardScaler fit trên train (độ lệch chuẩn ddof=0)
+        df['age_norm'] = (df['age_at_visit'] - age_mean) / age_std
+        return MedicalDataset(df, data_dir, target_shape=target_shape)
+    df['age'] = df['age_at_visit']
+    for col in ('mri_link', 'dti_link'):
+        df[col] = df[col].map(lambda p: os.path.join(data_dir, p.replace('\\', '/')))
+    return CustomDataset(df, target_shape=target_shape)
@@ -0,0 +1,141 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Subset
+
+from nifti_io import find_nifti
+
+
+# tăng số này khi đổi cách crop / chuẩn hóa ảnh để toàn bộ cache cũ bị bỏ qua
+PREPROCESS_VERSION = 1
+
+
+def weights_hash(module):
+    """ Hash sha256 của state_dict (tham số + buffer BatchNorm) của backbone. """
+    h = hashlib.sha256()
+    for name, tensor in module.state_dict().items():
+        h.update(name.encode())
+        h.update(str(tuple(tensor.shape)).encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def volume_key(dataset, link):
+    """ Khóa của một ảnh: đường dẫn + target_shape + phiên bản tiền xử lý + size/mtime của file. """
+    path = dataset.image_path(link) if hasattr(dataset, 'image_path') else link
+    parts = [path, str(tuple(dataset.target_shape)), str(PREPROCESS_VERSION)]
+    try:
+        st = os.stat(find_nifti(path))
+        parts += [str(st.st_size), str(st.st_mtime_ns)]
+    except OSError:
+        pass
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """ Cache embedding trên đĩa: <cache_dir>/<modality>/<weights_hash>/<volume_key>.npy """
+    def __init__(self, cache_dir, modality, backbone):
+        self.root = os.path.join(cache_dir, modality)
+        self.weights = weights_hash(backbone)
+        self.dir = os.path.join(self.root, self.weights)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.dir, key + '.npy')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        return np.load(self.path(key))
+
+    def put(self, key, feat):
+        tmp = self.path(key) + '.tmp.npy'
+        np.save(tmp, feat.astype(np.float32))
+        os.replace(tmp, self.path(key))
+
+    def prune(self):
+        """ Xóa embedding của các bộ trọng số cũ. """
+        for name in os.listdir(self.root):
+            if name != self.weights:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+
+def build_embeddings(model, dataset, cache_dir, device, batch_size=16, num_workers=4, prune=False):
+    """
+    Tính (hoặc đọc từ cache) embedding 512 chiều của mọi ảnh trong dataset cho
+    từng backbone của model. Chỉ các ảnh chưa có trong cache mới chạy qua r3d_18.
+
+    Một lượt đọc dataset duy nhất: mỗi batch (đã decode cả MRI lẫn DTI) đưa modality
+    tương ứng vào từng backbone, chỉ cho các mẫu còn thiếu embedding của backbone đó.
+
+    Backbone luôn chạy ở eval() nên BatchNorm dùng running stats cố định; đây là
+    điều kiện để embedding không phụ thuộc batch và có thể cache.
+    """
+    backbones = model.backbones()
+    caches, keys, missing = {}, {}, {}
+    for modality, backbone in backbones.items():
+        caches[modality] = EmbeddingCache(cache_dir, modality, backbone)
+        if prune:
+            caches[modality].prune()
+        links = dataset.df[f'{modality}_link'].tolist()
+        keys[modality] = [volume_key(dataset, link) for link in links]
+        missing[modality] = {i for i, k in enumerate(keys[modality]) if k not in caches[modality]}
+
+    todo = sorted(set().union(*missing.values()))
+    if todo:
+        print("Computing " + ", ".join(f"{len(missing[m])}/{len(keys[m])} {m}" for m in backbones) + " embeddings")
+        loader = DataLoader(Subset(dataset, todo), batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        was_training = {m: b.training for m, b in backbones.items()}
+        for backbone in backbones.values():
+            backbone.eval()
+        pos = 0
+        with torch.no_grad():
+            for batch in loader:
+                rows = todo[pos:pos + len(batch['label'])]
+                pos += len(rows)
+                for modality, backbone in backbones.items():
+                    picked = [j for j, i in enumerate(rows) if i in missing[modality]]
+                    if not picked:
+                        continue
+                    volumes = batch[modality][picked] if len(picked) < len(rows) else batch[modality]
+                    feats = backbone(volumes.to(device).float()).cpu().numpy()
+                    for j, feat in zip(picked, feats):
+                        caches[modality].put(keys[modality][rows[j]], feat)
+        for modality, backbone in backbones.items():
+            backbone.train(was_training[modality])
+
+    return {m: np.stack([caches[m].get(k) for k in keys[m]]) for m in backbones}
+
+
+class EmbeddingDataset(Dataset):
+    """
+    Dataset trả về embedding đã cache dưới cùng khóa 'mri' / 'dti' như dataset ảnh,
+    để train_model của notebook dùng lại được với model.use_cached_features().
+    """
+    def __init__(self, dataset, embeddings, age_col='age'):
+        super().__init__()
+        self.df = dataset.df
+        self.labels = dataset.labels
+        self.groups = dataset.groups
+        self.embeddings = {m: torch.from_numpy(e) for m, e in embeddings.items()}
+        self.age_col = age_col
+
+    def __len__(self):
+        return len(self.df)
+
+    def __getitem__(self, idx):
+        row = self.df.iloc[idx]
+
+        sample = {m: e[idx] for m, e in self.embeddings.items()}
+        sample['age'] = torch.tensor(row[self.age_col], dtype=torch.float32)
+        sample['gender'] = torch.tensor(row['gender'], dtype=torch.float32)
+        sample['label'] = torch.tensor(row['label'], dtype=torch.long)
+        return sample
+
+
+def cached_dataset(model, dataset, cache_dir, device, **kwargs):
+    """ Tiện ích: build_embeddings + EmbeddingDataset. """
+    return EmbeddingDataset(dataset, build_embeddings(model, dataset, cache_dir, device, **kwargs))
@@ -0,0 +1,131 @@
+import sys
+import json
+import time
+import argparse
+import subprocess
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from checkpoints import ARCHITECTURES, load_model
+from precision import synthetic_batch
+from runtime import ExportedModel, meta_path
+
+
+def _fuse_sequential(seq):
+    children = list(seq.children())
+    for i in range(len(children) - 1):
+        conv, bn = children[i], children[i + 1]
+        if isinstance(conv, nn.Conv3d) and isinstance(bn, nn.BatchNorm3d):
+            seq[i] = fuse_conv_bn_eval(conv, bn)
+            seq[i + 1] = nn.Identity()
+
+
+def _fuse_named(module):
+    # BasicBlock3D / ResNet14_3D: self.conv1 + self.bn1, self.conv2 + self.bn2
+    for n in (1, 2, 3):
+        conv, bn = getattr(module, f'conv{n}', None), getattr(module, f'bn{n}', None)
+        if isinstance(conv, nn.Conv3d) and isinstance(bn, nn.BatchNorm3d):
+            setattr(module, f'conv{n}', fuse_conv_bn_eval(conv, bn))
+            setattr(module, f'bn{n}', nn.Identity())
+
+
+def fuse_conv_bn(model):
+    """
+    Gộp BatchNorm3d vào Conv3d đứng ngay trước nó (chỉ đúng ở eval()).
+
+    Áp dụng cho cặp conv/bn theo tên (BasicBlock3D, ResNet14_3D) và cặp liền nhau
+    trong nn.Sequential (shortcut của BasicBlock3D, stem / block của r3d_18).
+    """
+    model.eval()
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            _fuse_sequential(module)
+        else:
+            _fuse_named(module)
+    return model
+
+
+def export(model, arch, out, fmt='torchscript', batch_size=2):
+    """ Export model (đã fuse) ra TorchScript (.pt) hoặc ONNX (.onnx) kèm file meta <out>.json. """
+    target_shape, input_keys = ARCHITECTURES[arch]
+    model = fuse_conv_bn(model)
+    batch = synthetic_batch(batch_size, target_shape)
+    example = tuple(batch[k] for k in input_keys)
+
+    with torch.no_grad():
+        if fmt == 'onnx':
+            torch.onnx.export(model, example, out, input_names=list(input_keys), output_names=['logits'],
+                              dynamic_axes={k: {0: 'batch'} for k in (*input_keys, 'logits')}, opset_version=17)
+        else:
+            traced = torch.jit.trace(model, example)
+            traced = torch.jit.freeze(traced)
+            traced.save(out)
+
+    num_classes = model(*example).size(1)
+    with open(meta_path(out), 'w') as f:
+        json.dump({'arch': arch, 'format': fmt, 'target_shape': list(target_shape),
+                   'input_keys': list(input_keys), 'num_classes': num_classes}, f)
+    return out
+
+
+@torch.no_grad()
+def check_parity(model, exported, batch, atol=1e-3):
+    """ So sánh logits của model eager (chưa fuse) với bản export trên cùng một batch. """
+    model.eval()
+    inputs = {k: batch[k] for k in exported.input_keys}
+    reference = model(*inputs.values())
+    outputs = exported(**inputs)
+    diff = (outputs - reference).abs().max().item()
+    return {'max_abs_diff': diff, 'ok': diff <= atol}
+
+
+@torch.no_grad()
+def latency_ms(fn, inputs, steps=10, warmup=2):
+    for _ in range(warmup):
+        fn(inputs)
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn(inputs)
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def startup_seconds(code):
+    """ Thời gian một tiến trình Python mới chạy `code` (import + nạp model), đo từ bên ngoài. """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export checkpoint ra TorchScript / ONNX (Conv3d+BatchNorm3d đã gộp).")
+    parser.add_argument("checkpoint")
+    parser.add_argument("--arch", choices=sorted(ARCHITECTURES), default="madnet")
+    parser.add_argument("--format", choices=["torchscript", "onnx"], default="torchscript")
+    parser.add_argument("--out", default=None, help="mặc định model.pt / model.onnx")
+    parser.add_argument("--check", action="store_true", help="kiểm tra sai số, độ trễ và thời gian khởi động")
+    args = parser.parse_args()
+
+    out = args.out or ("model.onnx" if args.format == "onnx" else "model.pt")
+    export(load_model(args.checkpoint, args.arch), args.arch, out, args.format)
+    print("Exported", out)
+    if not args.check:
+        return
+
+    model = load_model(args.checkpoint, args.arch)
+    exported = ExportedModel(out)
+    batch = synthetic_batch(2, exported.target_shape)
+    parity = check_parity(model, exported, batch)
+    print(f"parity: max |diff| = {parity['max_abs_diff']:.3g}, ok = {parity['ok']}")
+
+    inputs = {k: batch[k] for k in exported.input_keys}
+    print(f"latency (batch 2): eager {latency_ms(lambda x: model(**x), inputs):.1f} ms, "
+          f"exported {latency_ms(lambda x: exported(**x), inputs):.1f} ms")
+
+    eager = startup_seconds(f"from checkpoints import load_model; load_model({args.checkpoint!r}, {args.arch!r})")
+    light = startup_seconds(f"from runtime import ExportedModel; ExportedModel({out!r})")
+    print(f"cold start: eager {eager:.2f} s, exported {light:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+import time
+import queue as queue_mod
+import resource
+import traceback
+import argparse
+import multiprocessing as mp
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+from checkpoints import build_model
+
+
+# ảnh sau đăng ký MNI 1mm, không crop
+FULL_SHAPE = (182, 218, 182)
+
+# kiến trúc -> (trục không gian bị Dataset crop còn vài lát, tổng stride của backbone theo trục đó)
+# ResNet14_3D: conv1 + maxpool + layer3 + layer4 = 16; r3d_18: stem (1,2,2), layer2..4 = 8 theo trục depth
+SLAB_AXIS = {
+    'madnet': (4, 16),
+    'multimodal': (2, 8),
+}
+
+# các cấu hình thử theo thứ tự tốn bộ nhớ giảm dần
+SETTINGS = [
+    {'name': 'full', 'checkpoint': False, 'slab': None, 'overlap': 0},
+    {'name': 'checkpoint', 'checkpoint': True, 'slab': None, 'overlap': 0},
+    {'name': 'slab96', 'checkpoint': True, 'slab': 96, 'overlap': 32},
+    {'name': 'slab64', 'checkpoint': True, 'slab': 64, 'overlap': 32},
+]
+
+
+def _batch_norms(module):
+    return [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.running_mean is not None]
+
+
+def _checkpoint(module, fn, *args):
+    """
+    torch.utils.checkpoint cho fn(*args). Lần chạy lại trong backward không được cập nhật
+    running_mean / running_var của BatchNorm thêm lần nữa, nên buffer được khôi phục sau đó.
+    """
+    calls = [0]
+
+    def run(*a):
+        calls[0] += 1
+        if calls[0] == 1:
+            return fn(*a)
+        saved = [(m, m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone())
+                 for m in _batch_norms(module)]
+        try:
+            return fn(*a)
+        finally:
+            for m, mean, var, n in saved:
+                m.running_mean.copy_(mean)
+                m.running_var.copy_(var)
+                m.num_batches_tracked.copy_(n)
+
+    return checkpoint(run, *args, use_reentrant=False)
+
+
+class _CheckpointedBlock:
+    """ Mixin: chỉ giữ đầu vào của block khi train, activation bên trong được tính lại trong backward. """
+    def forward(self, x):
+        if self.training and torch.is_grad_enabled():
+            return _checkpoint(self, super().forward, x)
+        return super().forward(x)
+
+
+class _StreamedBackbone:
+    """ Mixin: backbone chạy trên từng slab chồng lấn theo một trục, gộp đặc trưng trước avgpool. """
+    def forward(self, x):
+        return stream_features(self, x, self.slab, self.overlap, self.slab_dim, self.slab_stride)
+
+
+_SWAPPED = {}
+
+
+def _swap_class(module, mixin):
+    """ Đổi lớp của module sang lớp con có mixin: không đổi tên khóa state_dict, an toàn với deepcopy. """
+    cls = type(module)
+    if issubclass(cls, mixin):
+        return module
+    key = (mixin, cls)
+    if key not in _SWAPPED:
+        _SWAPPED[key] = type(mixin.__name__.lstrip('_') + cls.__name__, (mixin, cls), {})
+    module.__class__ = _SWAPPED[key]
+    return module
+
+
+def image_backbones(model):
+    """ Các backbone ảnh 3D của model: MADNet / StackedMADNet / các classifier có backbones(). """
+    if hasattr(model, 'backbones'):
+        return model.backbones()
+    if hasattr(model, 'mri_branch'):
+        return {'mri': model.mri_branch[0], 'dti': model.dti_branch[0]}
+    if hasattr(model, 'branches'):
+        return {'stacked': model.branches}
+    raise ValueError(f"No 3D backbone found in {type(model).__name__}")
+
+
+def residual_blocks(backbone):
+    """ BasicBlock3D của ResNet14_3D (layers) hoặc BasicBlock của r3d_18 (layer1..layer4). """
+    if hasattr(backbone, 'layers'):
+        return [block for layer in backbone.layers for block in layer]
+    return [block for name in ('layer1', 'layer2', 'layer3', 'layer4') for block in getattr(backbone, name)]
+
+
+def feature_map(backbone, x):
+    """ Đặc trưng của backbone ngay trước avgpool: (B, 512, d, h, w). """
+    if hasattr(backbone, 'layers'):
+        x = F.relu(backbone.bn1(backbone.conv1(x)))
+        x = backbone.maxpool(x)
+        return backbone.layers(x)
+    x = backbone.stem(x)
+    for name in ('layer1', 'layer2', 'layer3', 'layer4'):
+        x = getattr(backbone, name)(x)
+    return x
+
+
+def slab_plan(length, slab, overlap, stride):
+    """
+    Chia trục độ dài `length` thành các slab [start, start + slab) bước slab - overlap.
+
+    Mỗi slab sở hữu một đoạn liên tiếp của bản đồ đặc trưng đầu ra (tọa độ toàn cục, chia stride):
+    ranh giới đặt giữa vùng chồng lấn nên phần mép slab (thiếu ngữ cảnh) bị bỏ. Trả về danh sách
+    (start, lo, hi) với lo/hi là chỉ số đặc trưng cục bộ trong slab.
+    """
+    step = slab - overlap
+    if step <= 0 or slab % stride or step % stride or overlap % (2 * stride):
+        raise ValueError(f"slab={slab}, overlap={overlap} must be multiples of stride={stride} (overlap of 2*stride)")
+    n_out = -(-length // stride)
+    starts = list(range(0, max(length - overlap, 1), step))
+    plan = []
+    for i, start in enumerate(starts):
+        lo = 0 if i == 0 else (start + overlap // 2) // stride
+        hi = n_out if i == len(starts) - 1 else (starts[i + 1] + overlap // 2) // stride
+        plan.append((start, lo - start // stride, min(hi, n_out) - start // stride))
+    return plan
+
+
+def stream_features(backbone, x, slab, overlap, dim, stride, use_checkpoint=True):
+    """
+    Tương đương avgpool(feature_map(backbone, x)) nhưng chỉ chạy backbone trên từng slab.
+
+    Với use_checkpoint (khi train), mỗi slab chỉ giữ lại tổng đặc trưng (B, C) của nó, activation
+    được tính lại từng slab một trong backward, nên bộ nhớ đỉnh ~ một slab thay vì cả volume.
+    Kết quả gần đúng so với chạy cả volume: khác ở mép slab và (khi train) thống kê BatchNorm theo slab.
+    """
+    plan = slab_plan(x.size(dim), slab, overlap, stride)
+    needed = plan[-1][0] + slab
+    if needed > x.size(dim):
+        x = F.pad(x, [0, 0] * (x.dim() - dim - 1) + [0, needed - x.size(dim)])
+
+    def depth_sum(part, lo, hi):
+        # trung bình trên hai trục còn lại, cộng dồn theo trục slab -> chia cho tổng số vị trí ở cuối
+        feat = feature_map(backbone, part).narrow(dim, lo, hi - lo)
+        return feat.sum(dim).flatten(2).mean(2)
+
+    total, count = 0, 0
+    for start, lo, hi in plan:
+        if hi <= lo:
+            continue
+        part = x.narrow(dim, start, slab)
+        if use_checkpoint and backbone.training and torch.is_grad_enabled():
+            s = _checkpoint(backbone, depth_sum, part, lo, hi)
+        else:
+            s = depth_sum(part, lo, hi)
+        total = total + s
+        count += hi - lo
+    return total / count
+
+
+def configure(model, checkpoint=False, slab=None, overlap=0, dim=4, stride=16):
+    """
+    Bật chế độ tiết kiệm bộ nhớ cho mọi backbone ảnh 3D của model (tại chỗ, giữ nguyên state_dict).
+
+    checkpoint: activation checkpointing trên từng residual block.
+    slab: độ dài slab theo trục `dim` của đầu vào (B, 1, D, H, W); None = chạy cả volume.
+    Khi có slab, mỗi slab đã được checkpoint nguyên khối nên không checkpoint thêm từng block.
+    """
+    if slab:
+        slab_plan(slab * 2, slab, overlap, stride)  # kiểm tra tham số sớm
+    for backbone in image_backbones(model).values():
+        if slab:
+            _swap_class(backbone, _StreamedBackbone)
+            backbone.slab, backbone.overlap = slab, overlap
+            backbone.slab_dim, backbone.slab_stride = dim, stride
+        elif checkpoint:
+            for block in residual_blocks(backbone):
+                _swap_class(block, _CheckpointedBlock)
+    return model
+
+
+def configure_for(model, arch, setting):
+    dim, stride = SLAB_AXIS[arch]
+    return configure(model, setting['checkpoint'], setting['slab'], setting['overlap'], dim, stride)
+
+
+def peak_rss_mb():
+    """
+    RSS đỉnh của tiến trình từ lúc khởi động (VmHWM). VmHWM thuộc không gian địa chỉ mới sau exec;
+    ru_maxrss (chỉ dùng khi không có /proc) còn giữ giá trị của tiến trình cha qua fork/exec.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def freeze_batchnorm1d(model):
+    """ BatchNorm1d của các head về eval (dùng running stats): train mode không chạy được với batch 1. """
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm1d):
+            m.eval()
+    return model
+
+
+def _measure(arch, setting, shape, batch_size, steps, threads, unfreeze, augment, queue):
+    try:
+        queue.put(_train_steps(arch, setting, shape, batch_size, steps, threads, unfreeze, augment))
+    except BaseException:
+        # lỗi Python gửi về tiến trình cha để phân biệt với bị OOM killer dừng
+        queue.put({'error': traceback.format_exc()})
+        raise
+
+
+def _train_steps(arch, setting, shape, batch_size, steps, threads, unfreeze, augment=False):
+    from augment import BatchAffine3D
+    from precision import prepare_inputs, synthetic_batch
+
+    torch.manual_seed(0)
+    if threads:
+        torch.set_num_threads(threads)
+    model = build_model(arch)
+    if unfreeze:
+        for p in model.parameters():
+            p.requires_grad = True
+    configure_for(model, arch, setting).train()
+    if batch_size < 2:
+        freeze_batchnorm1d(model)
+    batch = synthetic_batch(batch_size, shape)
+    inputs = prepare_inputs(batch, 'cpu', 'fp32', ('mri', 'dti', 'age', 'gender'))
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-5)
+    criterion = nn.CrossEntropyLoss()
+    transform = BatchAffine3D(seed=0) if augment else None
+    base = peak_rss_mb()
+
+    times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        optimizer.zero_grad(set_to_none=True)
+        step_inputs = transform(inputs) if transform is not None else inputs
+        criterion(model(**step_inputs), batch['label']).backward()
+        optimizer.step()
+        times.append(time.perf_counter() - start)
+    return {'peak_rss_mb': peak_rss_mb(), 'model_rss_mb': base, 'step_s': min(times)}
+
+
+def measure(arch, setting, shape=FULL_SHAPE, batch_size=2, steps=2, threads=None, unfreeze=False, augment=False):
+    """
+    Đo RSS đỉnh và thời gian một bước train của một cấu hình trong tiến trình riêng (RSS đỉnh không reset được).
+
+    Thất bại trả về peak_rss_mb=None kèm 'error': traceback nếu tiến trình con ném exception,
+    'killed (signal N)' nếu bị dừng bằng tín hiệu (SIGKILL thường là OOM killer).
+    """
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    args = (arch, setting, shape, batch_size, steps, threads, unfreeze, augment, queue)
+    proc = ctx.Process(target=_measure, args=args)
+    proc.start()
+    result = None
+    # đọc queue trước khi join: tiến trình con chỉ thoát khi dữ liệu đã được đẩy hết qua pipe
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except queue_mod.Empty:
+            if not proc.is_alive():
+                break
+    proc.join()
+    if result is None:
+        result = {'error': f"killed (signal {-proc.exitcode})" if proc.exitcode < 0 else f"exit {proc.exitcode}"}
+    if 'error' in result:
+        result.update({'peak_rss_mb': None, 'model_rss_mb': None, 'step_s': None, 'exitcode': proc.exitcode})
+    return result
+
+
+def select(results, budget_mb):
+    """ Cấu hình nhanh nhất có RSS đỉnh trong budget; None nếu không cấu hình nào vừa. """
+    fits = [(r['step_s'], name) for name, r in results.items()
+            if r['peak_rss_mb'] is not None and r['peak_rss_mb'] <= budget_mb]
+    return min(fits)[1] if fits else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo RSS đỉnh / thời gian bước train cả volume với checkpointing và slab.")
+    parser.add_argument("--arch", default="madnet", choices=sorted(SLAB_AXIS))
+    parser.add_argument("--shape", type=int, nargs=3, default=list(FULL_SHAPE))
+    parser.add_argument("--batch-size", type=int, default=2,
+                        help="batch 1 chạy được nhưng BatchNorm1d của head bị chuyển sang eval")
+    parser.add_argument("--steps", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--settings", nargs="+", default=[s['name'] for s in SETTINGS],
+                        choices=[s['name'] for s in SETTINGS])
+    parser.add_argument("--unfreeze", action="store_true", help="train cả backbone r3d_18 (multimodal)")
+    parser.add_argument("--augment", action="store_true", help="tính cả BatchAffine3D trên batch vào bước train")
+    parser.add_argument("--budget-mb", type=float, default=None, help="chọn cấu hình nhanh nhất vừa budget")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'setting':<12} {'peak RSS (MB)':>14} {'step (s)':>10}")
+    for setting in SETTINGS:
+        if setting['name'] not in args.settings:
+            continue
+        r = measure(args.arch, setting, tuple(args.shape), args.batch_size, args.steps, args.threads, args.unfreeze,
+                    args.augment)
+        results[setting['name']] = r
+        if r['peak_rss_mb'] is None:
+            print(f"{setting['name']:<12} {'failed':>14}  {r['error'].strip().splitlines()[-1]}")
+        else:
+            print(f"{setting['name']:<12} {r['peak_rss_mb']:>14.0f} {r['step_s']:>10.2f}")
+
+    if args.budget_mb is not None:
+        print(f"Budget {args.budget_mb:.0f} MB -> {select(results, args.budget_mb) or 'none fits'}")
+
+
+if __name__ == "__main__":
+    main()
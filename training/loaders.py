@@ -0,0 +1,175 @@
+import os
+import math
+import time
+import statistics
+import fcntl
+import hashlib
+import tempfile
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset, default_collate
+
+from nifti_io import find_nifti, load_slab, stats_path
+
+
+def default_cache_dir():
+    """ /dev/shm (tmpfs, dùng chung giữa các worker) nếu có, ngược lại thư mục tạm. """
+    root = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+    return os.path.join(root, f"adni-volumes-{os.getuid()}")
+
+
+class SharedVolumeCache:
+    """
+    Cache LRU các slab đã đọc + crop + chuẩn hóa, dùng chung giữa mọi worker của DataLoader.
+
+    Mỗi slab là một file .npy trong tmpfs (/dev/shm) nên các tiến trình đọc qua
+    memory-map cùng một vùng nhớ. Tổng dung lượng bị giới hạn bởi budget_bytes;
+    khi vượt, xóa các slab lâu không dùng nhất (theo mtime, được cập nhật mỗi lần hit).
+    Khóa theo ảnh gồm đường dẫn, target_shape, size/mtime của file gốc và mtime của sidecar mean/std
+    (ghi lại stats thì slab đã chuẩn hóa cũ không còn được dùng).
+    readonly=True: chỉ đọc cache đã được làm nóng trước, miss thì decode nhưng không ghi / evict
+    (vd. nhiều tiến trình sweep dùng chung một cache).
+    """
+    LOCK = ".lock"
+
+    def __init__(self, budget_bytes=4 << 30, cache_dir=None, readonly=False):
+        self.budget = budget_bytes
+        self.readonly = readonly
+        self.dir = cache_dir or default_cache_dir()
+        os.makedirs(self.dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path, target_shape):
+        path = find_nifti(path)
+        st = os.stat(path)
+        try:
+            stats_mtime = os.stat(stats_path(path)).st_mtime_ns
+        except OSError:
+            stats_mtime = None
+        parts = [os.path.abspath(path), str(tuple(target_shape)), str(st.st_size), str(st.st_mtime_ns), str(stats_mtime)]
+        return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.dir, key + ".npy")
+
+    def get(self, key):
+        try:
+            vol = np.load(self._file(key), mmap_mode="r")
+            os.utime(self._file(key))
+        except (OSError, ValueError):
+            return None
+        return np.array(vol)
+
+    def put(self, key, vol):
+        tmp = os.path.join(self.dir, f".{key}.{os.getpid()}.tmp.npy")
+        np.save(tmp, vol)
+        with open(os.path.join(self.dir, self.LOCK), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            os.replace(tmp, self._file(key))
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        with os.scandir(self.dir) as it:
+            for e in it:
+                if e.name.endswith(".npy") and not e.name.startswith("."):
+                    st = e.stat()
+                    entries.append((st.st_mtime_ns, st.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def load(self, path, target_shape, loader=load_slab):
+        """ Trả về slab (np.ndarray float32) từ cache, hoặc đọc bằng loader rồi lưu lại. """
+        key = self.key(path, target_shape)
+        vol = self.get(key)
+        if vol is not None:
+            self.hits += 1
+            return vol
+        self.misses += 1
+        vol = loader(path, target_shape)
+        if not self.readonly:
+            self.put(key, vol)
+        return vol
+
+    def clear(self):
+        with os.scandir(self.dir) as it:
+            for e in it:
+                if e.name.endswith(".npy"):
+                    os.remove(e.path)
+
+
+def attach_cache(dataset, cache):
+    """ Gắn cache vào dataset (kể cả khi bọc trong Subset); các Dataset đọc slab qua dataset.load_volume. """
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    dataset.volume_cache = cache
+    return dataset
+
+
+def measure_decode_time(dataset, samples=4):
+    """ Thời gian trung bình (giây) để lấy một mẫu dataset[i] và các mẫu đã đọc, đo trên vài mẫu đầu. """
+    n = min(samples, len(dataset))
+    if n == 0:
+        return 0.0, []
+    start = time.perf_counter()
+    items = [dataset[i] for i in range(n)]
+    return (time.perf_counter() - start) / n, items
+
+
+def measure_step_time(step, batch, repeat=3):
+    """ Trung vị thời gian (giây) của step(batch) sau một lần chạy làm nóng. """
+    step(batch)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        step(batch)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def prefetch_for(decode_time, batch_size, num_workers, step_time, max_prefetch=8):
+    """
+    Số batch mỗi worker chuẩn bị trước.
+
+    Mỗi worker cần decode_time * batch_size giây cho một batch; hàng đợi cần đủ
+    batch để che hai lần khoảng đó với tốc độ tiêu thụ step_time của vòng train.
+    """
+    if step_time <= 0:
+        return max_prefetch
+    batch_time = decode_time * batch_size
+    return int(min(max(math.ceil(2 * batch_time / (max(num_workers, 1) * step_time)), 2), max_prefetch))
+
+
+def make_loader(dataset, batch_size=16, shuffle=False, sampler=None, num_workers=4, drop_last=False,
+                cache=None, step_time=None, probe=4):
+    """
+    DataLoader với worker sống qua các epoch (persistent_workers), pin_memory khi có GPU
+    và prefetch_factor tính từ thời gian decode so với thời gian một bước train.
+
+    step_time: số giây một bước train (cấu hình sẵn) hoặc hàm step(batch) được đo trên một batch
+    ghép từ chính các mẫu dùng để đo decode (`probe` mẫu đầu, ít nhất batch_size khi đo step).
+    None: không đo gì, giữ prefetch_factor mặc định của DataLoader.
+    cache: SharedVolumeCache dùng chung, vd. cho val/test để mỗi ảnh chỉ decode một lần mỗi lần chạy.
+    """
+    if cache is not None:
+        attach_cache(dataset, cache)
+    kwargs = {}
+    if num_workers > 0:
+        kwargs['persistent_workers'] = True
+        if step_time is not None:
+            n = max(probe, batch_size) if callable(step_time) else probe
+            decode_time, items = measure_decode_time(dataset, n)
+            if callable(step_time):
+                step_time = measure_step_time(step_time, default_collate(items[:batch_size])) if items else 0.0
+            kwargs['prefetch_factor'] = prefetch_for(decode_time, batch_size, num_workers, step_time)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle if sampler is None else False,
+                      sampler=sampler, num_workers=num_workers, drop_last=drop_last,
+                      pin_memory=torch.cuda.is_available(), **kwargs)
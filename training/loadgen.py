@@ -0,0 +1,86 @@
+import json
+import time
+import argparse
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def make_requests(df):
+    """
+    Mỗi dòng csv (test.csv / val.csv) -> một request cho serve.py.
+
+    Gửi tuổi gốc age_at_visit và gender = ptgender - 1 như model_dataset; serve.py chuẩn hóa
+    tuổi bằng mean/std của tập train (--train-csv).
+    """
+    return [{'mri': r.mri_link.replace('\\', '/'), 'dti': r.dti_link.replace('\\', '/'),
+             'age': float(r.age_at_visit), 'gender': float(r.ptgender - 1)}
+            for r in df.itertuples(index=False)]
+
+
+def post(url, payload, timeout=60):
+    data = json.dumps(payload).encode()
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            resp.read()
+        ok = True
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def run(url, requests, total=200, concurrency=8, burst=0, burst_pause=1.0):
+    """
+    Gửi `total` request với `concurrency` client đồng thời.
+
+    burst > 0: gửi theo từng đợt `burst` request cùng lúc, nghỉ burst_pause giây giữa các đợt.
+    """
+    payloads = [requests[i % len(requests)] for i in range(total)]
+    latencies, failures = [], 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        step = burst or total
+        for i in range(0, total, step):
+            for latency, ok in pool.map(lambda p: post(url + "/predict", p), payloads[i:i + step]):
+                latencies.append(latency)
+                failures += not ok
+            if burst and i + step < total:
+                time.sleep(burst_pause)
+    elapsed = time.perf_counter() - start
+
+    lat = np.array(latencies) * 1000
+    return {
+        'requests': total,
+        'failures': failures,
+        'p50_ms': float(np.percentile(lat, 50)),
+        'p99_ms': float(np.percentile(lat, 99)),
+        'throughput_rps': total / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sinh tải cho serve.py và đo độ trễ p50/p99, throughput.")
+    parser.add_argument("csv", help="vd. data/test.csv (cần mri_link, dti_link, ptgender, age_at_visit)")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--total", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--burst", type=int, default=0)
+    args = parser.parse_args()
+
+    requests = make_requests(pd.read_csv(args.csv))
+    for c in args.concurrency:
+        result = run(args.url, requests, args.total, c, args.burst)
+        print(f"concurrency={c:3d}: p50={result['p50_ms']:.1f}ms p99={result['p99_ms']:.1f}ms "
+              f"{result['throughput_rps']:.1f} req/s failures={result['failures']}")
+
+    with urllib.request.urlopen(args.url + "/metrics") as resp:
+        print("server:", json.loads(resp.read()))
+
+
+if __name__ == "__main__":
+    main()
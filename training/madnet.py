@@ -0,0 +1,354 @@
+import os
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class BasicBlock3D(nn.Module):
+    def __init__(self, in_channels, out_channels, stride=1):
+        super().__init__()
+        self.conv1 = nn.Conv3d(in_channels, out_channels, kernel_size=3, stride=stride, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm3d(out_channels)
+        self.conv2 = nn.Conv3d(out_channels, out_channels, kernel_size=3, padding=1, bias=False)
+        self.bn2 = nn.BatchNorm3d(out_channels)
+
+        self.shortcut = nn.Sequential()
+        if stride != 1 or in_channels != out_channels:
+            self.shortcut = nn.Sequential(
+                nn.Conv3d(in_channels, out_channels, kernel_size=1, stride=stride, bias=False),
+                nn.BatchNorm3d(out_channels)
+            )
+
+        self.se = nn.Sequential(
+            nn.AdaptiveAvgPool3d(1),
+            nn.Conv3d(out_channels, out_channels//16, kernel_size=1),
+            nn.ReLU(),
+            nn.Conv3d(out_channels//16, out_channels, kernel_size=1),
+            nn.Sigmoid()
+        )
+
+    def forward(self, x):
+        residual = x
+        x = F.relu(self.bn1(self.conv1(x)))
+        x = self.bn2(self.conv2(x))
+        x = x * self.se(x)
+        x += self.shortcut(residual)
+        return F.relu(x)
+
+
+class ResNet14_3D(nn.Module):
+    def __init__(self, num_classes=2, in_channels=1):
+        super().__init__()
+        self.in_channels = in_channels
+
+        self.conv1 = nn.Conv3d(in_channels, 64, kernel_size=7, stride=2, padding=3, bias=False)
+        self.bn1 = nn.BatchNorm3d(64)
+        self.maxpool = nn.MaxPool3d(kernel_size=3, stride=2, padding=1)
+
+        self.layers = nn.Sequential(
+            self._make_layer(64, 64, stride=1),
+            self._make_layer(64, 128, stride=1),
+            self._make_layer(128, 256, stride=2),
+            self._make_layer(256, 512, stride=2)
+        )
+
+        self.avgpool = nn.AdaptiveAvgPool3d((1, 1, 1))
+        self.fc = nn.Linear(512, num_classes)
+
+    def _make_layer(self, in_channels, out_channels, stride):
+        return nn.Sequential(
+            BasicBlock3D(in_channels, out_channels, stride),
+            BasicBlock3D(out_channels, out_channels, stride=1)
+        )
+
+    def forward(self, x):
+        x = F.relu(self.bn1(self.conv1(x)))
+        x = self.maxpool(x)
+        x = self.layers(x)
+        x = self.avgpool(x)
+        return torch.flatten(x, 1)
+
+
+class MultiModalAttention(nn.Module):
+    def __init__(self, dim, num_heads=8):
+        super().__init__()
+        self.num_heads = num_heads
+        self.dim_head = dim // num_heads
+
+        self.W_q = nn.Linear(dim, dim)
+        self.W_k = nn.Linear(dim, dim)
+        self.W_v = nn.Linear(dim, dim)
+        self.out = nn.Linear(dim, dim)
+
+    def forward(self, mri_feat, dti_feat):
+        B = mri_feat.size(0)
+        q = self.W_q(mri_feat).view(B, self.num_heads, self.dim_head)
+        k = self.W_k(dti_feat).view(B, self.num_heads, self.dim_head)
+        v = self.W_v(dti_feat).view(B, self.num_heads, self.dim_head)
+
+        attn_scores = torch.einsum('bhd,bhd->bh', q, k) / (self.dim_head ** 0.5)
+        attn_weights = F.softmax(attn_scores, dim=-1)
+
+        attended = torch.einsum('bh,bhd->bhd', attn_weights, v)
+        attended = attended.reshape(B, -1)
+        return self.out(attended)
+
+
+class MADNet(nn.Module):
+    """ Mô hình hai nhánh ResNet14_3D (MRI, DTI) + attention + thông tin nhân khẩu (MRI+DTI_MADNet.ipynb). """
+    def __init__(self, num_classes=3):
+        super().__init__()
+
+        self.mri_branch = nn.Sequential(
+            ResNet14_3D(in_channels=1),
+            nn.Dropout(0.4)
+        )
+
+        self.dti_branch = nn.Sequential(
+            ResNet14_3D(in_channels=1),
+            nn.Dropout(0.4)
+        )
+
+        self.demo_fc = nn.Sequential(
+            nn.Linear(2, 128),
+            nn.BatchNorm1d(128),
+            nn.ReLU(),
+            nn.Dropout(0.3)
+        )
+
+        self.attention = MultiModalAttention(512, num_heads=8)
+        self.classifier = nn.Sequential(
+            nn.Linear(512 + 128, 512),
+            nn.BatchNorm1d(512),
+            nn.ReLU(),
+            nn.Dropout(0.7),
+            nn.Linear(512, num_classes)
+        )
+
+    def forward(self, mri, dti, age, gender):
+        mri_feat = self.mri_branch(mri)
+        dti_feat = self.dti_branch(dti)
+
+        fused = self.attention(mri_feat, dti_feat)
+
+        demo = torch.cat([age.unsqueeze(1), gender.unsqueeze(1)], dim=1)
+        demo_feat = self.demo_fc(demo)
+
+        combined = torch.cat((fused, demo_feat), dim=1)
+        return self.classifier(combined)
+
+
+class GroupedBasicBlock3D(nn.Module):
+    """
+    `branches` bản BasicBlock3D độc lập chạy cùng lúc: kênh được xếp nối nhau theo nhánh
+    ([nhánh 0 | nhánh 1]) và mọi Conv3d dùng groups=branches nên các nhánh không trộn lẫn.
+    Thứ tự module giống hệt BasicBlock3D để chuyển trọng số bằng cách duyệt song song.
+    """
+    def __init__(self, in_channels, out_channels, stride=1, branches=2):
+        super().__init__()
+        g = branches
+        self.conv1 = nn.Conv3d(g * in_channels, g * out_channels, kernel_size=3, stride=stride, padding=1, bias=False, groups=g)
+        self.bn1 = nn.BatchNorm3d(g * out_channels)
+        self.conv2 = nn.Conv3d(g * out_channels, g * out_channels, kernel_size=3, padding=1, bias=False, groups=g)
+        self.bn2 = nn.BatchNorm3d(g * out_channels)
+
+        self.shortcut = nn.Sequential()
+        if stride != 1 or in_channels != out_channels:
+            self.shortcut = nn.Sequential(
+                nn.Conv3d(g * in_channels, g * out_channels, kernel_size=1, stride=stride, bias=False, groups=g),
+                nn.BatchNorm3d(g * out_channels)
+            )
+
+        self.se = nn.Sequential(
+            nn.AdaptiveAvgPool3d(1),
+            nn.Conv3d(g * out_channels, g * (out_channels//16), kernel_size=1, groups=g),
+            nn.ReLU(),
+            nn.Conv3d(g * (out_channels//16), g * out_channels, kernel_size=1, groups=g),
+            nn.Sigmoid()
+        )
+
+    def forward(self, x):
+        residual = x
+        x = F.relu(self.bn1(self.conv1(x)))
+        x = self.bn2(self.conv2(x))
+        x = x * self.se(x)
+        x += self.shortcut(residual)
+        return F.relu(x)
+
+
+class GroupedResNet14_3D(nn.Module):
+    """ Nhiều ResNet14_3D (không có fc) chạy trong một lượt; đầu ra (B, branches * 512). """
+    def __init__(self, in_channels=1, branches=2):
+        super().__init__()
+        g = branches
+        self.conv1 = nn.Conv3d(g * in_channels, g * 64, kernel_size=7, stride=2, padding=3, bias=False, groups=g)
+        self.bn1 = nn.BatchNorm3d(g * 64)
+        self.maxpool = nn.MaxPool3d(kernel_size=3, stride=2, padding=1)
+
+        self.layers = nn.Sequential(
+            self._make_layer(64, 64, 1, g),
+            self._make_layer(64, 128, 1, g),
+            self._make_layer(128, 256, 2, g),
+            self._make_layer(256, 512, 2, g)
+        )
+
+        self.avgpool = nn.AdaptiveAvgPool3d((1, 1, 1))
+
+    def _make_layer(self, in_channels, out_channels, stride, branches):
+        return nn.Sequential(
+            GroupedBasicBlock3D(in_channels, out_channels, stride, branches),
+            GroupedBasicBlock3D(out_channels, out_channels, 1, branches)
+        )
+
+    def forward(self, x):
+        x = F.relu(self.bn1(self.conv1(x)))
+        x = self.maxpool(x)
+        x = self.layers(x)
+        x = self.avgpool(x)
+        return torch.flatten(x, 1)
+
+
+def _stacked_modules(module):
+    return [m for m in module.modules() if isinstance(m, (nn.Conv3d, nn.BatchNorm3d))]
+
+
+class StackedMADNet(nn.Module):
+    """
+    MADNet với hai nhánh MRI / DTI chạy thành một mạng tích chập nhóm (groups=2).
+
+    Cho cùng kết quả với MADNet (ở eval(); khi train chỉ khác chuỗi ngẫu nhiên của Dropout),
+    nhưng mỗi lớp Conv3d chỉ chạy một lần cho cả hai modality. Nạp trọng số của MADNet
+    bằng from_madnet() / load_madnet_state_dict(), đổi ngược bằng to_madnet().
+    fc của ResNet14_3D không dùng trong forward nên không được giữ lại.
+    """
+    def __init__(self, num_classes=3):
+        super().__init__()
+        self.branches = GroupedResNet14_3D(in_channels=1, branches=2)
+        self.branch_dropout = nn.Dropout(0.4)
+
+        self.demo_fc = nn.Sequential(
+            nn.Linear(2, 128),
+            nn.BatchNorm1d(128),
+            nn.ReLU(),
+            nn.Dropout(0.3)
+        )
+
+        self.attention = MultiModalAttention(512, num_heads=8)
+        self.classifier = nn.Sequential(
+            nn.Linear(512 + 128, 512),
+            nn.BatchNorm1d(512),
+            nn.ReLU(),
+            nn.Dropout(0.7),
+            nn.Linear(512, num_classes)
+        )
+
+    def forward(self, mri, dti, age, gender):
+        feats = self.branch_dropout(self.branches(torch.cat([mri, dti], dim=1)))
+        mri_feat, dti_feat = feats.chunk(2, dim=1)
+
+        fused = self.attention(mri_feat, dti_feat)
+
+        demo = torch.cat([age.unsqueeze(1), gender.unsqueeze(1)], dim=1)
+        demo_feat = self.demo_fc(demo)
+
+        combined = torch.cat((fused, demo_feat), dim=1)
+        return self.classifier(combined)
+
+    @torch.no_grad()
+    def copy_from(self, madnet):
+        """ Ghép trọng số / buffer BatchNorm của mri_branch và dti_branch theo chiều kênh. """
+        pairs = zip(_stacked_modules(madnet.mri_branch[0]), _stacked_modules(madnet.dti_branch[0]),
+                    _stacked_modules(self.branches))
+        for mri, dti, stacked in pairs:
+            for name in ('weight', 'bias', 'running_mean', 'running_var'):
+                a, b = getattr(mri, name, None), getattr(dti, name, None)
+                if a is not None:
+                    getattr(stacked, name).copy_(torch.cat([a, b], dim=0))
+            if isinstance(stacked, nn.BatchNorm3d):
+                stacked.num_batches_tracked.copy_(mri.num_batches_tracked)
+        for name in ('demo_fc', 'attention', 'classifier'):
+            getattr(self, name).load_state_dict(getattr(madnet, name).state_dict())
+        return self
+
+    @classmethod
+    def from_madnet(cls, madnet):
+        num_classes = madnet.classifier[-1].out_features
+        return cls(num_classes).copy_from(madnet).train(madnet.training)
+
+    def load_madnet_state_dict(self, state_dict):
+        """ Nạp trọng số MADNet: đường dẫn checkpoint, state_dict thuần hoặc dict của train_model ('model_state_dict'). """
+        if isinstance(state_dict, (str, os.PathLike)):
+            from checkpoints import load_state_dict
+            state_dict = load_state_dict(state_dict)
+        elif 'model_state_dict' in state_dict:
+            state_dict = state_dict['model_state_dict']
+        madnet = MADNet(num_classes=self.classifier[-1].out_features)
+        madnet.load_state_dict(state_dict)
+        return self.copy_from(madnet)
+
+    @torch.no_grad()
+    def to_madnet(self):
+        """ Tách lại thành MADNet hai nhánh (vd. để lưu checkpoint cùng định dạng cũ). """
+        madnet = MADNet(num_classes=self.classifier[-1].out_features)
+        pairs = zip(_stacked_modules(madnet.mri_branch[0]), _stacked_modules(madnet.dti_branch[0]),
+                    _stacked_modules(self.branches))
+        for mri, dti, stacked in pairs:
+            for name in ('weight', 'bias', 'running_mean', 'running_var'):
+                value = getattr(stacked, name, None)
+                if value is not None:
+                    a, b = value.chunk(2, dim=0)
+                    getattr(mri, name).copy_(a)
+                    getattr(dti, name).copy_(b)
+            if isinstance(stacked, nn.BatchNorm3d):
+                mri.num_batches_tracked.copy_(stacked.num_batches_tracked)
+                dti.num_batches_tracked.copy_(stacked.num_batches_tracked)
+        for name in ('demo_fc', 'attention', 'classifier'):
+            getattr(madnet, name).load_state_dict(getattr(self, name).state_dict())
+        return madnet.train(self.training)
+
+
+@torch.no_grad()
+def stacked_parity(model, batch, atol=1e-4):
+    """ So sánh logits của MADNet và StackedMADNet tương ứng (eval) trên cùng một batch. """
+    stacked = StackedMADNet.from_madnet(model).eval()
+    was_training = model.training
+    model.eval()
+    inputs = [batch[k] for k in ('mri', 'dti', 'age', 'gender')]
+    reference, outputs = model(*inputs), stacked(*inputs)
+    model.train(was_training)
+    diff = (outputs - reference).abs().max().item()
+    return {'max_abs_diff': diff, 'ok': diff <= atol}
+
+
+def main():
+    import argparse
+    from checkpoints import load_state_dict
+    from precision import MODES, benchmark, synthetic_batch
+
+    parser = argparse.ArgumentParser(description="So sánh MADNet hai nhánh với StackedMADNet (conv nhóm, một lượt).")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--shape", type=int, nargs=3, default=[182, 182, 10])
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--modes", nargs="+", default=["fp32"], choices=MODES)
+    parser.add_argument("--train", action="store_true", help="đo forward + backward thay vì inference")
+    parser.add_argument("--checkpoint", help="checkpoint MADNet để nạp, state_dict hoặc dict của train_model (mặc định khởi tạo ngẫu nhiên)")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = MADNet(num_classes=3)
+    if args.checkpoint:
+        model.load_state_dict(load_state_dict(args.checkpoint))
+    batch = synthetic_batch(args.batch_size, tuple(args.shape))
+
+    parity = stacked_parity(model, batch)
+    print(f"stacked vs two-branch: max |diff| = {parity['max_abs_diff']:.3g}, ok = {parity['ok']}")
+
+    stacked = StackedMADNet.from_madnet(model)
+    for name, m in (('two-branch', model), ('stacked', stacked)):
+        for mode, rate in benchmark(m, batch, modes=args.modes, steps=args.steps, train=args.train).items():
+            print(f"{name:>10} {mode:>5}: {rate:.2f} samples/sec")
+
+
+if __name__ == "__main__":
+    main()
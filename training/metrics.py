@@ -0,0 +1,102 @@
+import numpy as np
+import torch
+
+
+class MetricsAccumulator:
+    """
+    Cộng dồn loss và confusion matrix ngay trên device, không .item() / .cpu() mỗi batch.
+
+    Dùng trong vòng lặp train/val thay cho train_loss += loss.item() và
+    all_preds.extend(preds.cpu().numpy()); chỉ đồng bộ với host khi gọi
+    postfix() (mỗi log_every batch) hoặc compute() (cuối epoch).
+    """
+    def __init__(self, num_classes=3, device='cpu', log_every=10):
+        self.num_classes = num_classes
+        self.device = torch.device(device)
+        self.log_every = log_every
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.last_loss = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.confusion = torch.zeros(self.num_classes, self.num_classes, dtype=torch.int64, device=self.device)
+        self.num_batches = 0
+
+    @torch.no_grad()
+    def update(self, outputs, labels, loss=None):
+        """ outputs: logits (B, C) hoặc nhãn dự đoán (B,); labels: (B,). """
+        preds = outputs.argmax(1) if outputs.dim() > 1 else outputs
+        idx = labels.long() * self.num_classes + preds.long()
+        self.confusion += torch.bincount(idx, minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+        if loss is not None:
+            self.last_loss = loss.detach().double()
+            self.loss_sum += self.last_loss
+        self.num_batches += 1
+
+    def should_log(self):
+        return self.num_batches % self.log_every == 0
+
+    def postfix(self):
+        """ Giá trị cho tqdm set_postfix như trong train_model: loss batch cuối + accuracy tích lũy. """
+        correct = self.confusion.diagonal().sum()
+        total = self.confusion.sum().clamp(min=1)
+        return {'Loss': f'{self.last_loss.item():.4f}', 'Acc': f'{(correct / total).item():.4f}'}
+
+    def compute(self):
+        """
+        Đồng bộ một lần và trả về dict: loss (trung bình theo batch như train_loss / len(loader)),
+        accuracy, precision/recall/f1 (macro và weighted, cùng quy ước zero_division=0 của sklearn),
+        confusion (np.ndarray).
+        """
+        cm = self.confusion.cpu().numpy()
+        tp = np.diag(cm).astype(np.float64)
+        support = cm.sum(axis=1)
+        predicted = cm.sum(axis=0)
+
+        precision = np.divide(tp, predicted, out=np.zeros_like(tp), where=predicted > 0)
+        recall = np.divide(tp, support, out=np.zeros_like(tp), where=support > 0)
+        denom = precision + recall
+        f1 = np.divide(2 * precision * recall, denom, out=np.zeros_like(tp), where=denom > 0)
+
+        # sklearn chỉ tính trung bình trên các lớp xuất hiện trong nhãn thật hoặc dự đoán
+        present = (support + predicted) > 0
+        weights = support[present] / max(support.sum(), 1)
+        total = cm.sum()
+
+        def macro(values):
+            return float(values[present].mean()) if present.any() else 0.0
+
+        return {
+            'loss': self.loss_sum.item() / max(self.num_batches, 1),
+            'accuracy': float(tp.sum() / total) if total else 0.0,
+            'precision': macro(precision),
+            'recall': macro(recall),
+            'f1': macro(f1),
+            'f1_weighted': float((f1[present] * weights).sum()),
+            'confusion': cm,
+        }
+
+    def expand(self):
+        """
+        (labels, preds) dựng lại từ confusion matrix, dùng được trực tiếp cho
+        classification_report / confusion_matrix / plot_confusion_matrix (thứ tự mẫu không giữ).
+        """
+        cm = self.confusion.cpu().numpy()
+        true, pred = np.divmod(np.arange(cm.size), self.num_classes)
+        counts = cm.ravel()
+        return np.repeat(true, counts), np.repeat(pred, counts)
+
+
+@torch.no_grad()
+def evaluate_model(model, loader, device, num_classes=3, keys=('mri', 'dti', 'age', 'gender')):
+    """
+    Như evaluate_model trong notebook nhưng trả về MetricsAccumulator thay cho hai list.
+    keys: thứ tự tham số của model, vd. ('dti', 'age', 'gender') cho SingleModalWithTabularClassifier.
+    """
+    model.eval()
+    metrics = MetricsAccumulator(num_classes, device)
+    for batch in loader:
+        inputs = [batch[k].to(device, non_blocking=True).float() for k in keys]
+        labels = batch['label'].to(device, non_blocking=True)
+        metrics.update(model(*inputs), labels)
+    return metrics
@@ -0,0 +1,169 @@
+import os
+import sys
+import glob
+import json
+import argparse
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from instrument import trace
+
+
+EPS = 1e-8
+
+
+def find_nifti(path):
+    """ Nếu path là thư mục, trả về file .nii hoặc .nii.gz đầu tiên bên trong. """
+    if os.path.isdir(path):
+        nii_files = glob.glob(os.path.join(path, "*.nii*"))
+        if not nii_files:
+            raise FileNotFoundError(f"No NIfTI file found in folder {path}")
+        path = nii_files[0]
+    return path
+
+
+def crop_window(shape, target_shape):
+    """
+    Tính cửa sổ crop/pad tâm giống resize_vol, chỉ dựa trên shape của header.
+
+    Trả về (src, dst): src là slice cần đọc từ ảnh gốc, dst là vị trí đặt vào mảng đích.
+    """
+    src, dst = [], []
+    for n, t in zip(shape, target_shape):
+        c = min(n, t)
+        s, d = (n - c) // 2, (t - c) // 2
+        src.append(slice(s, s + c))
+        dst.append(slice(d, d + c))
+    return tuple(src), tuple(dst)
+
+
+def resize_vol(vol, shape):
+    """ Resize bằng crop/pad tâm (giữ nguyên hành vi của các notebook). """
+    src, dst = crop_window(vol.shape, shape)
+    out = np.zeros(shape, dtype=vol.dtype)
+    out[dst] = vol[src]
+    return out
+
+
+def stats_path(path):
+    """ Đường dẫn file sidecar chứa mean/std của ảnh: image.nii.gz -> image.stats.json """
+    base = path[:-len(".nii.gz")] if path.endswith(".nii.gz") else os.path.splitext(path)[0]
+    return base + ".stats.json"
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def compute_stats(path, chunk=16):
+    """
+    Tính mean/std của toàn ảnh theo từng khối lát cắt trên trục cuối,
+    không bao giờ giữ cả volume float64 trong bộ nhớ.
+    """
+    img = nib.load(path, mmap=True)
+    proxy = img.dataobj
+    depth = img.shape[2]
+
+    total, total_sq, n = 0.0, 0.0, 0
+    for k in range(0, depth, chunk):
+        block = np.asarray(proxy[:, :, k:k + chunk], dtype=np.float64)
+        total += block.sum()
+        total_sq += np.square(block).sum()
+        n += block.size
+
+    mean = total / n
+    std = float(np.sqrt(max(total_sq / n - mean * mean, 0.0)))
+    return {"mean": float(mean), "std": std, "shape": list(img.shape[:3]), **_file_key(path)}
+
+
+def write_stats(path, chunk=16):
+    """ Tính và ghi sidecar mean/std cạnh file ảnh. """
+    stats = compute_stats(path, chunk=chunk)
+    with open(stats_path(path), "w") as f:
+        json.dump(stats, f)
+    return stats
+
+
+def load_stats(path, compute_missing=True):
+    """
+    Đọc mean/std từ sidecar. Sidecar bị coi là cũ nếu kích thước hoặc mtime
+    của ảnh thay đổi; khi đó (hoặc khi chưa có) sẽ tính lại nếu compute_missing=True.
+    """
+    sidecar = stats_path(path)
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            stats = json.load(f)
+        key = _file_key(path)
+        if stats.get("size") == key["size"] and stats.get("mtime_ns") == key["mtime_ns"]:
+            return stats["mean"], stats["std"]
+
+    if not compute_missing:
+        raise FileNotFoundError(f"Missing or stale stats sidecar for {path}")
+
+    try:
+        stats = write_stats(path)
+    except OSError:
+        # thư mục dữ liệu chỉ đọc (vd. /kaggle/input): tính nhưng không ghi
+        stats = compute_stats(path)
+    return stats["mean"], stats["std"]
+
+
+def load_slab(path, target_shape, stats=None):
+    """
+    Đọc đúng phần slab cần cho target_shape rồi chuẩn hóa z-score.
+
+    Cửa sổ crop được tính từ header trước, sau đó chỉ slice qua img.dataobj
+    (memory-map nếu file không nén), ép thẳng về float32. Mean/std lấy từ
+    sidecar nên không cần đọc toàn bộ volume. Kết quả giống
+    resize_vol(load_nifti(path), target_shape) trong các notebook.
+    """
+    path = find_nifti(path)
+    mean, std = stats if stats is not None else load_stats(path)
+
+    # đọc header + chỉ cửa sổ crop (crop nằm ở đây, không tách được khỏi phần decode)
+    with trace.timer("nifti.read_slab"):
+        img = nib.load(path, mmap=True)
+        src, dst = crop_window(img.shape[:3], target_shape)
+        slab = np.asarray(img.dataobj[src], dtype=np.float32)
+        if not slab.flags.writeable:
+            # float32 không scale + cửa sổ liên tục: nibabel trả thẳng view của memmap chỉ đọc
+            slab = slab.copy()
+
+    with trace.timer("nifti.normalize"):
+        slab -= np.float32(mean)
+        slab /= np.float32(std + EPS)
+        out = np.zeros(target_shape, dtype=np.float32)
+        out[dst] = slab
+    return out
+
+
+def load_nifti(path):
+    """ Đọc toàn bộ volume và chuẩn hóa z-score (phiên bản gốc, giữ lại để so sánh). """
+    arr = nib.load(find_nifti(path)).get_fdata().astype(np.float32)
+    return (arr - arr.mean()) / (arr.std() + EPS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tính trước sidecar mean/std cho mọi ảnh trong các file csv.")
+    parser.add_argument("csv", nargs="+", help="train.csv / val.csv / test.csv")
+    parser.add_argument("--data-dir", default="", help="thư mục gốc nối trước mri_link/dti_link")
+    parser.add_argument("--columns", nargs="+", default=["mri_link", "dti_link"])
+    args = parser.parse_args()
+
+    links = set()
+    for csv in args.csv:
+        df = pd.read_csv(csv)
+        for col in args.columns:
+            links.update(df[col].str.replace("\\", "/", regex=False))
+
+    for link in sorted(links):
+        path = find_nifti(os.path.join(args.data_dir, link))
+        stats = write_stats(path)
+        print(f"Done {path}: mean={stats['mean']:.4f} std={stats['std']:.4f}")
+
+
+if __name__ == "__main__":
+    main()
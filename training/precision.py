@@ -0,0 +1,167 @@
+import os
+import sys
+import copy
+import time
+import argparse
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from instrument import trace
+
+
+MODES = ('fp32', 'bf16')
+
+
+def autocast(mode, device='cpu'):
+    """ Context autocast: bf16 -> torch.autocast(bfloat16), fp32 -> không làm gì. """
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=(mode == 'bf16'))
+
+
+def prepare_model(model, mode):
+    """ Chế độ bf16: chuyển trọng số Conv3d/BatchNorm3d sang channels_last_3d (trọng số vẫn là fp32). """
+    if mode == 'bf16':
+        model = model.to(memory_format=torch.channels_last_3d)
+    return model
+
+
+def prepare_inputs(batch, device, mode, keys=('mri', 'dti', 'image', 'age', 'gender')):
+    """ Đưa các tensor của batch lên device; ảnh 5D được chuyển sang channels_last_3d ở chế độ bf16. """
+    inputs = {}
+    for k in keys:
+        if k not in batch:
+            continue
+        v = batch[k].to(device, non_blocking=True)
+        if mode == 'bf16' and v.dim() == 5:
+            v = v.contiguous(memory_format=torch.channels_last_3d)
+        inputs[k] = v
+    return inputs
+
+
+def predict(model, inputs, mode):
+    """ Forward trong autocast; logits luôn trả về dạng fp32. """
+    device = next(model.parameters()).device
+    with autocast(mode, device):
+        outputs = model(**inputs)
+    return outputs.float()
+
+
+def train_step(model, inputs, labels, criterion, optimizer, mode, augment=None):
+    """
+    Một bước huấn luyện như trong train_model, có autocast. bf16 không cần GradScaler.
+
+    augment: vd. augment.BatchAffine3D(), áp dụng lên inputs (đã ở trên device) trước forward,
+    MRI và DTI của cùng một mẫu nhận cùng một phép biến đổi.
+    """
+    if augment is not None:
+        with trace.timer("train.augment", sync=True):
+            inputs = augment(inputs)
+    optimizer.zero_grad()
+    with trace.timer("train.forward", sync=True):
+        outputs = predict(model, inputs, mode)
+        loss = criterion(outputs, labels.long())
+    with trace.timer("train.backward", sync=True):
+        loss.backward()
+    with trace.timer("train.optimizer", sync=True):
+        optimizer.step()
+    return loss, outputs
+
+
+@torch.no_grad()
+def check_parity(model, batch, mode='bf16', atol=5e-2, rtol=5e-2):
+    """
+    So sánh logits của chế độ `mode` với fp32 trên cùng một batch (model ở eval()).
+
+    Chạy trên bản sao của model nên không đổi memory format của model gốc.
+    Trả về dict: max_abs_diff, argmax_agreement, ok (allclose theo atol/rtol).
+    """
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+    reference = predict(model, prepare_inputs(batch, device, 'fp32'), 'fp32')
+
+    other = prepare_model(copy.deepcopy(model), mode).eval()
+    outputs = predict(other, prepare_inputs(batch, device, mode), mode)
+    model.train(was_training)
+
+    diff = (outputs - reference).abs()
+    return {
+        'max_abs_diff': diff.max().item(),
+        'argmax_agreement': (outputs.argmax(1) == reference.argmax(1)).float().mean().item(),
+        'ok': torch.allclose(outputs, reference, atol=atol, rtol=rtol),
+    }
+
+
+def benchmark(model, batch, modes=MODES, steps=10, warmup=2, train=False):
+    """
+    Đo samples/sec cho từng chế độ trên cùng một batch.
+
+    train=True đo forward + backward (không cập nhật trọng số), ngược lại chỉ đo inference.
+    """
+    device = next(model.parameters()).device
+    batch_size = next(v for v in batch.values() if v.dim() == 5).size(0)
+    results = {}
+    for mode in modes:
+        m = prepare_model(copy.deepcopy(model), mode)
+        m.train(train)
+        inputs = prepare_inputs(batch, device, mode)
+        labels = batch['label'].to(device) if 'label' in batch else None
+        criterion = nn.CrossEntropyLoss()
+
+        def step():
+            if train:
+                m.zero_grad(set_to_none=True)
+                outputs = predict(m, inputs, mode)
+                target = labels if labels is not None else outputs.argmax(1)
+                criterion(outputs, target).backward()
+            else:
+                with torch.no_grad():
+                    predict(m, inputs, mode)
+
+        for _ in range(warmup):
+            step()
+        start = time.perf_counter()
+        for _ in range(steps):
+            step()
+        elapsed = time.perf_counter() - start
+        results[mode] = steps * batch_size / elapsed
+    return results
+
+
+def synthetic_batch(batch_size=4, target_shape=(182, 182, 10), num_classes=3, seed=0):
+    """ Batch ngẫu nhiên có cùng khóa/kích thước với MedicalDataset. """
+    g = torch.Generator().manual_seed(seed)
+    return {
+        'mri': torch.randn(batch_size, 1, *target_shape, generator=g),
+        'dti': torch.randn(batch_size, 1, *target_shape, generator=g),
+        'age': torch.randn(batch_size, generator=g),
+        'gender': torch.randint(0, 2, (batch_size,), generator=g).float(),
+        'label': torch.randint(0, num_classes, (batch_size,), generator=g),
+    }
+
+
+def main():
+    from madnet import MADNet
+
+    parser = argparse.ArgumentParser(description="Kiểm tra sai số và đo tốc độ MADNet fp32 / bf16 + channels_last_3d trên CPU.")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--shape", type=int, nargs=3, default=[182, 182, 10])
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--train", action="store_true", help="đo forward + backward thay vì inference")
+    parser.add_argument("--atol", type=float, default=5e-2)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = MADNet(num_classes=3)
+    batch = synthetic_batch(args.batch_size, tuple(args.shape))
+
+    parity = check_parity(model, batch, atol=args.atol, rtol=args.atol)
+    print(f"bf16 vs fp32: max |diff| = {parity['max_abs_diff']:.4g}, "
+          f"argmax agreement = {parity['argmax_agreement']:.2%}, ok = {parity['ok']}")
+
+    for mode, rate in benchmark(model, batch, steps=args.steps, train=args.train).items():
+        print(f"{mode:>5}: {rate:.2f} samples/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import io
+import os
+import copy
+import time
+import argparse
+import tempfile
+import multiprocessing as mp
+import torch
+import torch.nn as nn
+import pandas as pd
+from sklearn.metrics import classification_report
+from torch.utils.data import DataLoader, Subset
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from checkpoints import ARCHITECTURES, load_model
+from datasets import model_dataset
+from metrics import evaluate_model
+
+
+CLASS_NAMES = ['Normal', 'MCI', 'Alzheimer']
+
+
+def _inputs(batch, keys):
+    return tuple(batch[k].float() for k in keys)
+
+
+@torch.no_grad()
+def quantize_static(model, calib_loader, input_keys, backend='x86'):
+    """
+    Post-training static quantization (FX graph mode) cho CPU.
+
+    Mọi Conv3d / Linear (kể cả Conv3d 1x1 trong nhánh squeeze-excitation của BasicBlock3D)
+    được lượng tử hóa INT8; phép nhân/cộng residual do FX tự chèn quantize/dequantize.
+    Observer được hiệu chỉnh trên calib_loader (một phần val.csv).
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).eval()
+    example = _inputs(next(iter(calib_loader)), input_keys)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example)
+    for batch in calib_loader:
+        prepared(*_inputs(batch, input_keys))
+    return convert_fx(prepared)
+
+
+def quantize_linear_dynamic(model):
+    """ Dynamic INT8 chỉ cho nn.Linear (không cần hiệu chỉnh; Conv3d giữ fp32). """
+    return quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def rss_mb(field="VmRSS"):
+    """ Bộ nhớ thường trú hiện tại của tiến trình (VmRSS), hoặc đỉnh (VmHWM) từ /proc/self/status. """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """ Đặt lại VmHWM về RSS hiện tại (Linux >= 4.0); ru_maxrss thì không reset được và còn kế thừa từ tiến trình cha. """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _memory_child(model_path, inputs_path, queue):
+    inputs = torch.load(inputs_path)
+    reset_peak_rss()
+    base = rss_mb()
+    model = torch.jit.load(model_path)
+    loaded = rss_mb()
+    with torch.no_grad():
+        model(*inputs)
+    peak = rss_mb("VmHWM")
+    queue.put({'load_rss_mb': loaded - base, 'peak_rss_mb': peak - base})
+
+
+def memory_usage(model, example):
+    """
+    Bộ nhớ riêng của một model: bản TorchScript được nạp và chạy forward trên `example` trong
+    tiến trình mới (spawn), trả về RSS tăng thêm khi nạp và RSS đỉnh khi suy luận so với trước khi nạp.
+    Đo trong cùng tiến trình thì RSS gồm cả các model khác, dữ liệu test và bộ nhớ allocator giữ lại.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path, inputs_path = os.path.join(tmp, 'model.pt'), os.path.join(tmp, 'inputs.pt')
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(model, example), model_path)
+        torch.save(example, inputs_path)
+        ctx = mp.get_context('spawn')
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_memory_child, args=(model_path, inputs_path, queue))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            return {'load_rss_mb': None, 'peak_rss_mb': None}
+        return queue.get()
+
+
+@torch.no_grad()
+def throughput(model, loader, input_keys, max_batches=None):
+    """ samples/sec chỉ tính forward (ảnh đã được đọc trước vào bộ nhớ). """
+    batches = [_inputs(b, input_keys) for i, b in zip(range(max_batches or len(loader)), loader)]
+    model(*batches[0])  # warmup
+    start = time.perf_counter()
+    n = 0
+    for inputs in batches:
+        model(*inputs)
+        n += inputs[0].size(0)
+    return n / (time.perf_counter() - start)
+
+
+def compare(models, loader, input_keys, num_classes=3, max_batches=None):
+    """
+    Accuracy / macro-F1 / throughput / kích thước cho từng model {tên: model}, cùng một loader.
+
+    size_mb: state_dict đã serialize; load_rss_mb / peak_rss_mb: bộ nhớ của riêng model đó (memory_usage).
+    """
+    report = {}
+    example = _inputs(next(iter(loader)), input_keys)
+    for name, model in models.items():
+        metrics = evaluate_model(model, loader, 'cpu', num_classes, keys=input_keys)
+        result = metrics.compute()
+        report[name] = {
+            'metrics': metrics,
+            'accuracy': result['accuracy'],
+            'f1': result['f1'],
+            'samples_per_sec': throughput(model, loader, input_keys, max_batches),
+            'size_mb': model_size_mb(model),
+            **memory_usage(model, example),
+            'confusion': result['confusion'],
+        }
+    return report
+
+
+def _mb(value):
+    return "failed" if value is None else f"{value:.0f}MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lượng tử hóa INT8 sau huấn luyện và so sánh với fp32.")
+    parser.add_argument("checkpoint")
+    parser.add_argument("--arch", choices=sorted(ARCHITECTURES), default="madnet")
+    parser.add_argument("--data", default="data", help="thư mục chứa train.csv / val.csv / test.csv")
+    parser.add_argument("--data-dir", default="", help="thư mục gốc của ảnh")
+    parser.add_argument("--mode", choices=["static", "dynamic"], default="static")
+    parser.add_argument("--calib-size", type=int, default=64, help="số mẫu val.csv dùng để hiệu chỉnh")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--out", default=None, help="lưu model INT8 (torch.jit) vào file này")
+    args = parser.parse_args()
+
+    _, input_keys = ARCHITECTURES[args.arch]
+    train_df = pd.read_csv(os.path.join(args.data, 'train.csv'))
+    age_mean, age_std = train_df['age_at_visit'].mean(), train_df['age_at_visit'].std(ddof=0)
+    val = model_dataset(args.arch, pd.read_csv(os.path.join(args.data, 'val.csv')), args.data_dir, age_mean, age_std)
+    test = model_dataset(args.arch, pd.read_csv(os.path.join(args.data, 'test.csv')), args.data_dir, age_mean, age_std)
+
+    model = load_model(args.checkpoint, args.arch)
+    if args.mode == 'static':
+        calib = Subset(val, range(min(args.calib_size, len(val))))
+        quantized = quantize_static(model, DataLoader(calib, batch_size=args.batch_size), input_keys)
+    else:
+        quantized = quantize_linear_dynamic(model)
+
+    test_loader = DataLoader(test, batch_size=args.batch_size, num_workers=4)
+    report = compare({'fp32': model, 'int8': quantized}, test_loader, input_keys)
+    for name, r in report.items():
+        print(f"\nClassification Report ({name}):")
+        print(classification_report(*r['metrics'].expand(), labels=[0, 1, 2], target_names=CLASS_NAMES, zero_division=0))
+        print(f"{name:>5}: acc={r['accuracy']:.4f} macro-F1={r['f1']:.4f} "
+              f"{r['samples_per_sec']:.2f} samples/sec size={r['size_mb']:.1f}MB "
+              f"load={_mb(r['load_rss_mb'])} peak={_mb(r['peak_rss_mb'])}")
+    print(f"delta: acc={report['int8']['accuracy'] - report['fp32']['accuracy']:+.4f} "
+          f"macro-F1={report['int8']['f1'] - report['fp32']['f1']:+.4f} "
+          f"speedup={report['int8']['samples_per_sec'] / report['fp32']['samples_per_sec']:.2f}x")
+
+    if args.out:
+        example = _inputs(next(iter(test_loader)), input_keys)
+        torch.jit.save(torch.jit.trace(quantized, example), args.out)
+        print("Saved", args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import json
+import numpy as np
+import torch
+
+
+def meta_path(path):
+    return path + '.json'
+
+
+class ExportedModel:
+    """
+    Chạy model đã export bằng export.py (TorchScript .pt hoặc ONNX .onnx).
+
+    Chỉ cần torch (hoặc onnxruntime cho .onnx): không import torchvision, không
+    dựng lại lớp Python của model, không tải trọng số pretrained qua mạng.
+    Thông tin arch / target_shape / input_keys đọc từ file <path>.json.
+    """
+    def __init__(self, path, num_threads=None):
+        with open(meta_path(path)) as f:
+            self.meta = json.load(f)
+        self.input_keys = self.meta['input_keys']
+        self.target_shape = tuple(self.meta['target_shape'])
+        self.format = self.meta['format']
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        if self.format == 'onnx':
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        else:
+            self.module = torch.jit.load(path, map_location='cpu').eval()
+
+    def __call__(self, **inputs):
+        """ inputs: các tensor theo input_keys (có chiều batch). Trả về logits (B, num_classes) dạng tensor. """
+        if self.format == 'onnx':
+            feed = {k: np.ascontiguousarray(inputs[k].cpu().numpy(), dtype=np.float32) for k in self.input_keys}
+            return torch.from_numpy(self.session.run(None, feed)[0])
+        with torch.no_grad():
+            return self.module(*[inputs[k].float() for k in self.input_keys])
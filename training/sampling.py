@@ -0,0 +1,92 @@
+import numpy as np
+import torch
+from torch.utils.data import Subset, WeightedRandomSampler
+
+from loaders import make_loader
+
+
+SUBJECT_PATTERN = r'(\d{3}_S_\d{4})'
+
+
+def subject_ids(df, link_col='mri_link'):
+    """ Lấy subject_id (vd. 022_S_5004) từ đường dẫn ảnh, dùng làm khóa nhóm. """
+    if 'subject_id' in df.columns:
+        return df['subject_id'].astype(str).to_numpy()
+    links = df[link_col].astype(str).str.replace('\\', '/', regex=False)
+    return links.str.extract(SUBJECT_PATTERN, expand=False).fillna(links).to_numpy()
+
+
+def dataset_labels(dataset):
+    """ Nhãn của dataset (hoặc Subset) mà không đọc ảnh nào. """
+    if isinstance(dataset, Subset):
+        return dataset_labels(dataset.dataset)[np.asarray(dataset.indices)]
+    return dataset.labels
+
+
+def class_counts(labels, num_classes=None):
+    """ Số mẫu mỗi lớp; num_classes để lớp không có mẫu nào vẫn có mặt (đếm 0). """
+    return np.bincount(labels, minlength=num_classes or 0)
+
+
+def undersample_indices(labels, seed=42):
+    """ Lấy ngẫu nhiên min_class_size mẫu cho mỗi lớp. """
+    rng = np.random.default_rng(seed)
+    classes, counts = np.unique(labels, return_counts=True)
+    n = counts.min()
+    picked = [rng.choice(np.flatnonzero(labels == c), n, replace=False) for c in classes]
+    return rng.permutation(np.concatenate(picked))
+
+
+def oversample_indices(labels, seed=42):
+    """ Giữ toàn bộ mẫu, lặp lại (có hoàn lại) các lớp nhỏ tới max_class_size. """
+    rng = np.random.default_rng(seed)
+    classes, counts = np.unique(labels, return_counts=True)
+    n = counts.max()
+    picked = []
+    for c, k in zip(classes, counts):
+        idx = np.flatnonzero(labels == c)
+        picked.append(np.concatenate([idx, rng.choice(idx, n - k, replace=True)]))
+    return rng.permutation(np.concatenate(picked))
+
+
+def sample_weights(labels):
+    """ Trọng số 1 / class_count[label] như WeightedRandomSampler trong __main__ của MADNet. """
+    counts = class_counts(labels)
+    return 1. / counts[labels]
+
+
+def weighted_sampler(labels, num_samples=None, seed=None):
+    weights = torch.as_tensor(sample_weights(labels), dtype=torch.double)
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    return WeightedRandomSampler(weights, num_samples or len(weights), generator=generator)
+
+
+def balance_train_dataset(train_dataset, batch_size=16, seed=42, num_workers=4, mode='under', cache=None,
+                          step_time=None):
+    """
+    Tạo DataLoader cân bằng lớp từ dataset.labels, không đọc ảnh.
+    Loader được tạo qua loaders.make_loader (worker sống qua các epoch, cache dùng chung nếu có,
+    prefetch theo step_time nếu có).
+
+    mode: 'under' (undersampling như notebook), 'over' (oversampling) hoặc 'weighted' (WeightedRandomSampler).
+    Batch cuối chỉ có một mẫu bị bỏ (BatchNorm1d của head không train được với batch 1).
+    """
+    labels = dataset_labels(train_dataset)
+
+    if mode == 'weighted':
+        sampler = weighted_sampler(labels, seed=seed)
+        return make_loader(train_dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers,
+                           drop_last=len(sampler) % batch_size == 1, cache=cache, step_time=step_time)
+
+    if mode == 'under':
+        indices = undersample_indices(labels, seed)
+        print(f"Undersampling to {len(indices) // len(np.unique(labels))} samples per class")
+    elif mode == 'over':
+        indices = oversample_indices(labels, seed)
+        print(f"Oversampling to {len(indices) // len(np.unique(labels))} samples per class")
+    else:
+        raise ValueError(f"Unknown balancing mode: {mode}")
+
+    balanced_subset = Subset(train_dataset, indices.tolist())
+    return make_loader(balanced_subset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                       drop_last=len(indices) % batch_size == 1, cache=cache, step_time=step_time)
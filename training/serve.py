@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import torch
+
+from nifti_io import load_slab
+from checkpoints import ARCHITECTURES, load_model
+from precision import MODES, prepare_model, predict
+
+
+class LatencyStats:
+    """ Độ trễ của các request gần nhất (p50/p99) và throughput kể từ lúc khởi động. """
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.completed = 0
+        self.errors = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.completed += 1
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def record_batch(self, size):
+        with self.lock:
+            self.batch_sizes.append(size)
+
+    def snapshot(self):
+        with self.lock:
+            lat = np.array(self.latencies) * 1000
+            sizes = np.array(self.batch_sizes)
+            completed, errors = self.completed, self.errors
+        return {
+            'completed': completed,
+            'errors': errors,
+            'p50_ms': float(np.percentile(lat, 50)) if lat.size else None,
+            'p99_ms': float(np.percentile(lat, 99)) if lat.size else None,
+            'throughput_rps': completed / max(time.time() - self.started, 1e-9),
+            'mean_batch_size': float(sizes.mean()) if sizes.size else None,
+        }
+
+
+class DynamicBatcher:
+    """
+    Gom các request đồng thời thành batch cho một instance model duy nhất.
+
+    Một thread riêng lấy request đầu tiên trong hàng đợi rồi chờ thêm tối đa
+    max_wait_ms (hoặc tới khi đủ max_batch_size) trước khi chạy forward.
+    """
+    def __init__(self, model, input_keys, max_batch_size=8, max_wait_ms=10, mode='fp32', stats=None):
+        self.model = model
+        self.input_keys = input_keys
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.mode = mode
+        self.stats = stats
+        self.device = next(model.parameters()).device
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name="batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, sample):
+        """ sample: dict tensor không có chiều batch. Trả về Future của xác suất (num_classes,). """
+        fut = Future()
+        self.queue.put((sample, fut))
+        return fut
+
+    def _collect(self):
+        items = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def _loop(self):
+        while True:
+            items = self._collect()
+            samples = [s for s, _ in items]
+            try:
+                inputs = {k: torch.stack([s[k] for s in samples]).to(self.device) for k in self.input_keys}
+                if self.mode == 'bf16':
+                    inputs = {k: v.contiguous(memory_format=torch.channels_last_3d) if v.dim() == 5 else v
+                              for k, v in inputs.items()}
+                with torch.no_grad():
+                    probs = torch.softmax(predict(self.model, inputs, self.mode), dim=1).cpu()
+            except Exception as e:
+                for _, fut in items:
+                    fut.set_exception(e)
+                continue
+            if self.stats is not None:
+                self.stats.record_batch(len(items))
+            for (_, fut), p in zip(items, probs):
+                fut.set_result(p)
+
+
+class InferenceService:
+    """
+    Model được nạp một lần; đọc ảnh chạy trong pool worker, forward chạy qua DynamicBatcher.
+
+    age_stats: (mean, std) của age_at_visit trên tập train, dùng để chuẩn hóa tuổi cho madnet
+    như model_dataset; None thì tuổi trong request được dùng nguyên (đã chuẩn hóa sẵn).
+    multimodal train trên tuổi gốc nên không chuẩn hóa.
+    """
+    def __init__(self, checkpoint, arch='madnet', data_dir='', device='cpu', workers=4,
+                 max_batch_size=8, max_wait_ms=10, mode='fp32', age_stats=None):
+        self.target_shape, self.input_keys = ARCHITECTURES[arch]
+        self.data_dir = data_dir
+        self.age_stats = age_stats if arch == 'madnet' else None
+        model = prepare_model(load_model(checkpoint, arch, device=device), mode)
+        self.stats = LatencyStats()
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="preprocess")
+        self.batcher = DynamicBatcher(model, self.input_keys, max_batch_size, max_wait_ms, mode, self.stats)
+
+    def preprocess(self, request):
+        """ request: {'mri': path, 'dti': path, 'age': age_at_visit (năm), 'gender': ptgender - 1} """
+        sample = {}
+        for key in ('mri', 'dti'):
+            path = os.path.join(self.data_dir, request[key]).replace('\\', '/')
+            sample[key] = torch.from_numpy(load_slab(path, self.target_shape)).unsqueeze(0)
+        age = float(request['age'])
+        if self.age_stats is not None:
+            mean, std = self.age_stats
+            age = (age - mean) / std
+        sample['age'] = torch.tensor(age, dtype=torch.float32)
+        sample['gender'] = torch.tensor(float(request['gender']), dtype=torch.float32)
+        return sample
+
+    def predict(self, request):
+        start = time.perf_counter()
+        try:
+            sample = self.pool.submit(self.preprocess, request).result()
+            probs = self.batcher.submit(sample).result()
+        except Exception:
+            self.stats.record_error()
+            raise
+        latency = time.perf_counter() - start
+        self.stats.record(latency)
+        return {
+            'prediction': int(probs.argmax()),
+            'probabilities': probs.tolist(),
+            'latency_ms': latency * 1000,
+        }
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._send(200, service.stats.snapshot())
+            elif self.path == "/health":
+                self._send(200, {"status": "ok"})
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                self._send(200, service.predict(request))
+            except (KeyError, ValueError, FileNotFoundError) as e:
+                self._send(400, {"error": f"{type(e).__name__}: {e}"})
+            except Exception as e:
+                self._send(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server HTTP dự đoán theo batch động (MADNet / MultimodalAlzheimerClassifier).")
+    parser.add_argument("checkpoint")
+    parser.add_argument("--arch", choices=sorted(ARCHITECTURES), default="madnet")
+    parser.add_argument("--data-dir", default="", help="thư mục gốc nối trước đường dẫn mri/dti trong request")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=4, help="số worker đọc ảnh")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--mode", choices=MODES, default="fp32")
+    parser.add_argument("--train-csv", default=None,
+                        help="train.csv của checkpoint: mean/std age_at_visit để chuẩn hóa tuổi (madnet)")
+    args = parser.parse_args()
+
+    age_stats = None
+    if args.train_csv:
+        train_df = pd.read_csv(args.train_csv)
+        age_stats = (train_df['age_at_visit'].mean(), train_df['age_at_visit'].std(ddof=0))
+    elif args.arch == 'madnet':
+        print("Warning: no --train-csv, request 'age' must already be normalized with the training mean/std")
+
+    service = InferenceService(args.checkpoint, args.arch, args.data_dir, workers=args.workers,
+                               max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, mode=args.mode,
+                               age_stats=age_stats)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f"Serving {args.arch} on http://{args.host}:{args.port} (POST /predict, GET /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
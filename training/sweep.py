@@ -0,0 +1,356 @@
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from sklearn.model_selection import StratifiedGroupKFold
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from augment import BatchAffine3D
+from checkpoints import ARCHITECTURES, build_model
+from datasets import model_dataset
+from loaders import SharedVolumeCache, default_cache_dir, make_loader
+from metrics import MetricsAccumulator
+from precision import predict, prepare_inputs, train_step
+from instrument import trace
+from sampling import balance_train_dataset, class_counts, subject_ids
+
+
+# giá trị mặc định theo notebook của từng kiến trúc
+DEFAULTS = {
+    'madnet': {'lr': 1e-5, 'weight_decay': 1e-3, 'gamma': 2.0, 'dropout': 0.7, 'freeze_backbone': False},
+    'multimodal': {'lr': 1e-4, 'weight_decay': 1e-5, 'gamma': 2.0, 'dropout': 0.5, 'freeze_backbone': True},
+}
+
+
+class FocalLoss(nn.Module):
+    """ FocalLoss của MRI+DTI_MADNet.ipynb; gamma=0 tương đương CrossEntropyLoss. """
+    def __init__(self, alpha=None, gamma=2):
+        super().__init__()
+        self.alpha = alpha
+        self.gamma = gamma
+
+    def forward(self, inputs, targets):
+        ce_loss = F.cross_entropy(inputs, targets, reduction='none')
+        pt = torch.exp(-ce_loss)
+
+        focal_loss = (1 - pt).clamp(min=1e-7)**self.gamma * ce_loss
+
+        if self.alpha is not None:
+            alpha_t = self.alpha[targets]
+            focal_loss = alpha_t * focal_loss
+
+        return focal_loss.mean()
+
+
+def subject_folds(df, k=5, seed=42):
+    """ K fold (train_idx, val_idx) phân tầng theo diagnosis, không để một subject nằm ở cả hai phía. """
+    splitter = StratifiedGroupKFold(n_splits=k, shuffle=True, random_state=seed)
+    return list(splitter.split(df, df['diagnosis'], groups=subject_ids(df)))
+
+
+def grid(space):
+    """ {'lr': [1e-5, 1e-4], 'gamma': [0, 2]} -> list các dict tham số (tích Descartes). """
+    keys = sorted(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+
+
+def trial_name(params, fold):
+    parts = [f"{k}={params[k]:g}" if isinstance(params[k], float) else f"{k}={params[k]}" for k in sorted(params)]
+    return "_".join(parts + [f"fold{fold}"])
+
+
+def make_trials(arch, space, n_folds):
+    trials = []
+    for params in grid(space):
+        params = {**DEFAULTS[arch], **params}
+        for fold in range(n_folds):
+            trials.append({'name': trial_name(params, fold), 'params': params, 'fold': fold})
+    return trials
+
+
+class Board:
+    """
+    Kết quả theo epoch của mọi trial (mỗi trial một file history.jsonl trong thư mục của nó),
+    dùng cho median stopping rule: dừng trial nếu giá trị tốt nhất tới epoch e của nó
+    thấp hơn trung vị của các trial khác cùng fold tại cùng epoch.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def history_path(self, name):
+        return os.path.join(self.root, name, 'history.jsonl')
+
+    def report(self, name, fold, epoch, value):
+        with open(self.history_path(name), 'a') as f:
+            f.write(json.dumps({'fold': fold, 'epoch': epoch, 'value': value}) + "\n")
+
+    def best_at(self, name, epoch):
+        """ Giá trị tốt nhất tới epoch `epoch`; None nếu trial chưa chạy tới epoch đó. """
+        try:
+            with open(self.history_path(name)) as f:
+                records = [json.loads(line) for line in f]
+        except (OSError, ValueError):
+            return None
+        values = [r['value'] for r in records if r['epoch'] <= epoch]
+        if not values or max(r['epoch'] for r in records) < epoch:
+            return None
+        return max(values)
+
+    def should_stop(self, name, fold, epoch, grace=3, min_peers=2):
+        if epoch < grace:
+            return False
+        peers = []
+        for other in os.listdir(self.root):
+            if other == name or not other.endswith(f"_fold{fold}"):
+                continue
+            value = self.best_at(other, epoch)
+            if value is not None:
+                peers.append(value)
+        if len(peers) < min_peers:
+            return False
+        return self.best_at(name, epoch) < float(np.median(peers))
+
+
+def build_trial_model(arch, params, num_classes=3, pretrained=True):
+    """ Model theo tham số trial: dropout áp vào classifier, freeze_backbone đóng băng các nhánh ảnh 3D. """
+    if arch == 'multimodal':
+        from classifiers import MultimodalAlzheimerClassifier
+        model = MultimodalAlzheimerClassifier(num_classes, freeze_backbone=params['freeze_backbone'],
+                                              pretrained=pretrained)
+    else:
+        model = build_model(arch, num_classes)
+        if params['freeze_backbone']:
+            for branch in (model.mri_branch, model.dti_branch):
+                for p in branch.parameters():
+                    p.requires_grad = False
+    for m in model.classifier.modules():
+        if isinstance(m, nn.Dropout):
+            m.p = params['dropout']
+    return model
+
+
+def fold_frames(config, fold):
+    pool = config['pool']
+    if config['n_folds'] > 1:
+        train_idx, val_idx = config['folds'][fold]
+        return pool.iloc[train_idx], pool.iloc[val_idx]
+    return config['train'], config['val']
+
+
+def step_timer(model, criterion, keys, device, augment=None):
+    """ step(batch) một bước train trên bản sao model (không đổi trọng số / BatchNorm), để make_loader đo step_time. """
+    probe = copy.deepcopy(model).train()
+    optimizer = torch.optim.AdamW([p for p in probe.parameters() if p.requires_grad], lr=0.0, weight_decay=0.0)
+
+    def step(batch):
+        train_step(probe, prepare_inputs(batch, device, 'fp32', keys), batch['label'].to(device), criterion, optimizer,
+                   'fp32', augment)
+    return step
+
+
+def run_trial(trial, config, cores):
+    """ Chạy một trial trong tiến trình riêng, ghim vào `cores`, ghi best_model.pth / result.json vào thư mục riêng. """
+    if cores:
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+    torch.manual_seed(config['seed'])
+    arch, params = config['arch'], trial['params']
+    run_dir = os.path.join(config['out'], trial['name'])
+    os.makedirs(run_dir, exist_ok=True)
+    board = Board(config['out'])
+
+    train_df, val_df = fold_frames(config, trial['fold'])
+    mean, std = train_df['age_at_visit'].mean(), train_df['age_at_visit'].std(ddof=0)
+    train_set = model_dataset(arch, train_df, config['data_dir'], mean, std)
+    val_set = model_dataset(arch, val_df, config['data_dir'], mean, std)
+    # 'batch': BatchAffine3D trên batch đã collate (MRI/DTI cùng phép biến đổi), tắt RandomAffine 2D của Dataset
+    # để không augment hai lần; 'dataset': RandomAffine 2D từng mẫu như notebook
+    augment = BatchAffine3D(seed=config['seed']) if config['augment'] == 'batch' else None
+    if hasattr(train_set, 'is_train'):
+        train_set.is_train = config['augment'] == 'dataset'
+
+    device = config['device']
+    model = build_trial_model(arch, params, pretrained=config['pretrained']).to(device)
+    counts = class_counts(train_set.labels, 3)
+    class_weights = 1.0 / torch.tensor(np.maximum(counts, 1), dtype=torch.float)
+    criterion = FocalLoss(alpha=(class_weights / class_weights.sum()).to(device), gamma=params['gamma'])
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad],
+                                  lr=params['lr'], weight_decay=params['weight_decay'])
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', patience=5, factor=0.2)
+    keys = ARCHITECTURES[arch][1]
+
+    cache = None
+    if config['cache_dir']:
+        cache = SharedVolumeCache(config['cache_bytes'], config['cache_dir'], readonly=True)
+    train_loader = balance_train_dataset(train_set, config['batch_size'], config['seed'], config['num_workers'],
+                                         mode='weighted', cache=cache,
+                                         step_time=step_timer(model, criterion, keys, device, augment))
+    val_loader = make_loader(val_set, config['batch_size'], num_workers=config['num_workers'], cache=cache)
+
+    best, best_epoch, wait, status = -np.inf, -1, 0, 'completed'
+    start = time.time()
+    for epoch in range(config['epochs']):
+        model.train()
+        for batch in trace.iterate(train_loader):
+            inputs = prepare_inputs(batch, device, 'fp32', keys)
+            train_step(model, inputs, batch['label'].to(device), criterion, optimizer, 'fp32', augment)
+
+        model.eval()
+        metrics = MetricsAccumulator(3, device)
+        with torch.no_grad():
+            for batch in val_loader:
+                labels = batch['label'].to(device)
+                outputs = predict(model, prepare_inputs(batch, device, 'fp32', keys), 'fp32')
+                metrics.update(outputs, labels, criterion(outputs, labels))
+        value = metrics.compute()[config['metric']]
+        scheduler.step(value)
+        board.report(trial['name'], trial['fold'], epoch, value)
+
+        if value > best:
+            best, best_epoch, wait = value, epoch, 0
+            torch.save(model.state_dict(), os.path.join(run_dir, 'best_model.pth'))
+        else:
+            wait += 1
+            if wait >= config['patience']:
+                status = 'early_stopped'
+                break
+        if board.should_stop(trial['name'], trial['fold'], epoch, config['grace'], config['min_peers']):
+            status = 'pruned'
+            break
+
+    result = {**trial, 'best': best, 'best_epoch': best_epoch, 'epochs': epoch + 1,
+              'status': status, 'seconds': time.time() - start, 'cores': list(cores or [])}
+    with open(os.path.join(run_dir, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+
+def core_slots(parallel):
+    """ Chia đều các core được phép dùng cho `parallel` tiến trình. """
+    cores = sorted(os.sched_getaffinity(0))
+    per = max(len(cores) // parallel, 1)
+    return [cores[i * per:(i + 1) * per] or cores for i in range(parallel)]
+
+
+def warm_cache(config):
+    """ Decode mọi ảnh của train+val một lần vào cache dùng chung trước khi chạy các trial. """
+    cache = SharedVolumeCache(config['cache_bytes'], config['cache_dir'])
+    pool = config['pool']
+    ds = model_dataset(config['arch'], pool, config['data_dir'], 0.0, 1.0)
+    for _ in make_loader(ds, config['batch_size'], num_workers=config['num_workers'], cache=cache):
+        pass
+    return cache
+
+
+def run_sweep(trials, config, parallel=2):
+    """ Chạy các trial song song, mỗi tiến trình một phần core; trả về list result. """
+    os.makedirs(config['out'], exist_ok=True)
+    if config['cache_dir']:
+        warm_cache(config)
+
+    ctx = mp.get_context('spawn')
+    slots = core_slots(parallel)
+    pending = [t for t in trials if not os.path.exists(os.path.join(config['out'], t['name'], 'result.json'))]
+    running = {}
+    while pending or running:
+        for slot, (proc, trial) in list(running.items()):
+            if not proc.is_alive():
+                proc.join()
+                if proc.exitcode != 0:
+                    print(f"Trial {trial['name']} failed (exit {proc.exitcode})")
+                del running[slot]
+        for slot in range(parallel):
+            if pending and slot not in running:
+                trial = pending.pop(0)
+                proc = ctx.Process(target=run_trial, args=(trial, config, slots[slot]))
+                proc.start()
+                running[slot] = (proc, trial)
+                print(f"Started {trial['name']} on cores {slots[slot]}")
+        time.sleep(1)
+
+    results = []
+    for t in trials:
+        path = os.path.join(config['out'], t['name'], 'result.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                results.append(json.load(f))
+    return results
+
+
+def summarize(results):
+    """ Trung bình / độ lệch chuẩn của giá trị tốt nhất qua các fold cho mỗi bộ tham số. """
+    rows = [{**r['params'], 'fold': r['fold'], 'best': r['best'], 'status': r['status']} for r in results]
+    df = pd.DataFrame(rows)
+    keys = sorted(results[0]['params'])
+    return (df.groupby(keys)['best'].agg(['mean', 'std', 'count'])
+              .sort_values('mean', ascending=False).reset_index())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-validation theo subject và grid search chạy song song.")
+    parser.add_argument("--data", default="data", help="thư mục chứa train.csv / val.csv")
+    parser.add_argument("--data-dir", default="", help="thư mục gốc nối trước mri_link/dti_link")
+    parser.add_argument("--arch", default="madnet", choices=sorted(DEFAULTS))
+    parser.add_argument("--folds", type=int, default=1, help="K fold theo subject trên train+val (1 = dùng val.csv)")
+    parser.add_argument("--lr", type=float, nargs="+")
+    parser.add_argument("--gamma", type=float, nargs="+")
+    parser.add_argument("--dropout", type=float, nargs="+")
+    parser.add_argument("--freeze-backbone", type=int, nargs="+", choices=[0, 1])
+    parser.add_argument("--parallel", type=int, default=2, help="số trial chạy cùng lúc")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--patience", type=int, default=15)
+    parser.add_argument("--metric", default="accuracy", choices=["accuracy", "f1", "f1_weighted"])
+    parser.add_argument("--grace", type=int, default=5, help="số epoch trước khi được dừng sớm theo trung vị")
+    parser.add_argument("--min-peers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-workers", type=int, default=2, help="worker DataLoader của mỗi trial")
+    parser.add_argument("--cache-gb", type=float, default=8, help="0 = không dùng cache chung")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--no-pretrained", action="store_true")
+    parser.add_argument("--augment", default="batch", choices=["batch", "dataset", "none"],
+                        help="batch = BatchAffine3D trên batch, dataset = RandomAffine 2D từng mẫu như notebook")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="sweeps")
+    args = parser.parse_args()
+
+    train = pd.read_csv(os.path.join(args.data, 'train.csv'))
+    val = pd.read_csv(os.path.join(args.data, 'val.csv'))
+    pool = pd.concat([train, val], ignore_index=True)
+
+    space = {}
+    for key in ('lr', 'gamma', 'dropout'):
+        if getattr(args, key):
+            space[key] = getattr(args, key)
+    if args.freeze_backbone:
+        space['freeze_backbone'] = [bool(v) for v in args.freeze_backbone]
+
+    cache_dir = None
+    if args.cache_gb > 0:
+        cache_dir = args.cache_dir or os.path.join(default_cache_dir(), 'sweep')
+    config = {
+        'arch': args.arch, 'data_dir': args.data_dir, 'train': train, 'val': val, 'pool': pool,
+        'n_folds': args.folds, 'folds': subject_folds(pool, args.folds, args.seed) if args.folds > 1 else None,
+        'epochs': args.epochs, 'patience': args.patience, 'metric': args.metric,
+        'grace': args.grace, 'min_peers': args.min_peers, 'batch_size': args.batch_size,
+        'num_workers': args.num_workers, 'cache_dir': cache_dir, 'cache_bytes': int(args.cache_gb * (1 << 30)),
+        'pretrained': not args.no_pretrained, 'seed': args.seed, 'out': args.out, 'device': 'cpu',
+        'augment': args.augment,
+    }
+    trials = make_trials(args.arch, space, max(args.folds, 1))
+    print(f"{len(trials)} trials, {args.parallel} in parallel")
+    results = run_sweep(trials, config, args.parallel)
+    if results:
+        print(summarize(results).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+from nifti_io import find_nifti, load_slab
+from sampling import subject_ids
+
+
+INDEX_FILE = "index.json"
+
+
+def normalize_link(link):
+    return link.replace("\\", "/")
+
+
+def resolve_path(link, data_dir="", filename=None):
+    """ Ghép data_dir + link (+ filename) như CustomDataset / MedicalDataset. """
+    parts = [data_dir, normalize_link(link)] + ([filename] if filename else [])
+    return find_nifti(os.path.join(*parts))
+
+
+def pack(csv_paths, out_dir, data_dir="", filename=None, target_shape=(6, 182, 182),
+         dtype="float16", shard_size=256, columns=("mri_link", "dti_link")):
+    """
+    Đóng gói mọi ảnh MRI/DTI trong các file csv thành vài shard .npy cố định shape.
+
+    Mỗi shard có shape (shard_size, *target_shape), ảnh đã được crop và chuẩn hóa
+    z-score bằng load_slab. index.json ánh xạ link -> (shard, offset).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    links = []
+    seen = set()
+    for csv in csv_paths:
+        df = pd.read_csv(csv)
+        for col in columns:
+            for link in df[col].map(normalize_link):
+                if link not in seen:
+                    seen.add(link)
+                    links.append(link)
+
+    index = {}
+    shards = []
+    for start in range(0, len(links), shard_size):
+        chunk = links[start:start + shard_size]
+        name = f"shard_{len(shards):04d}.npy"
+        arr = np.lib.format.open_memmap(os.path.join(out_dir, name), mode="w+",
+                                        dtype=dtype, shape=(len(chunk), *target_shape))
+        for offset, link in enumerate(chunk):
+            arr[offset] = load_slab(resolve_path(link, data_dir, filename), target_shape)
+            index[link] = [len(shards), offset]
+            print(f"Done {link}")
+        arr.flush()
+        del arr
+        shards.append(name)
+
+    meta = {
+        "target_shape": list(target_shape),
+        "dtype": np.dtype(dtype).name,
+        "shards": shards,
+        "index": index,
+    }
+    # ghi index cuối cùng để store dở dang không bao giờ được coi là hợp lệ
+    tmp = os.path.join(out_dir, INDEX_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(out_dir, INDEX_FILE))
+    return meta
+
+
+class TensorStore:
+    """ Đọc các shard qua memory-map; mỗi worker tự mở shard khi cần. """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE)) as f:
+            meta = json.load(f)
+        self.target_shape = tuple(meta["target_shape"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.shards = meta["shards"]
+        self.index = meta["index"]
+        self._maps = {}
+
+    def __contains__(self, link):
+        return normalize_link(link) in self.index
+
+    def _shard(self, k):
+        if k not in self._maps:
+            # mode "c" (copy-on-write) cho mảng ghi được -> torch.from_numpy không copy, không cảnh báo
+            self._maps[k] = np.load(os.path.join(self.store_dir, self.shards[k]), mmap_mode="c")
+        return self._maps[k]
+
+    def get(self, link):
+        shard, offset = self.index[normalize_link(link)]
+        return self._shard(shard)[offset]
+
+    def __getstate__(self):
+        # không pickle các memmap đã mở sang worker của DataLoader
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+
+class PackedDataset(Dataset):
+    """
+    Thay thế CustomDataset / MRIDataset / DTIDataset / MedicalDataset bằng TensorStore.
+
+    modalities: ('mri', 'dti') cho mô hình đa phương thức, ('mri',) hoặc ('dti',) cho đơn phương thức.
+    age_col: 'age' (notebook final) hoặc 'age_norm' (MADNet).
+    """
+    def __init__(self, df, store, modalities=("mri", "dti"), age_col="age"):
+        super().__init__()
+        self.df = df.reset_index(drop=True)
+        self.store = store if isinstance(store, TensorStore) else TensorStore(store)
+        self.modalities = modalities
+        self.age_col = age_col
+        self.labels = self.df['label'].to_numpy(dtype=np.int64)
+        self.groups = subject_ids(self.df)
+
+    def __len__(self):
+        return len(self.df)
+
+    def __getitem__(self, idx):
+        row = self.df.iloc[idx]
+
+        sample = {}
+        for m in self.modalities:
+            # float32: zero-copy; float16: chỉ một lần ép kiểu slab nhỏ
+            tensor = torch.from_numpy(self.store.get(row[f'{m}_link'])).unsqueeze(0)
+            sample[m] = tensor.float() if tensor.dtype != torch.float32 else tensor
+
+        sample['age'] = torch.tensor(row[self.age_col], dtype=torch.float32)
+        sample['gender'] = torch.tensor(row['gender'], dtype=torch.float32)
+        sample['label'] = torch.tensor(row['label'], dtype=torch.long)
+        return sample
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đóng gói ảnh đã tiền xử lý thành shard memory-map.")
+    parser.add_argument("csv", nargs="+", help="train.csv / val.csv / test.csv")
+    parser.add_argument("--out", required=True, help="thư mục chứa shard + index.json")
+    parser.add_argument("--data-dir", default="")
+    parser.add_argument("--filename", default=None, help="vd. image.nii cho MedicalDataset")
+    parser.add_argument("--target-shape", nargs=3, type=int, default=[6, 182, 182])
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    parser.add_argument("--shard-size", type=int, default=256)
+    args = parser.parse_args()
+
+    meta = pack(args.csv, args.out, data_dir=args.data_dir, filename=args.filename,
+                target_shape=tuple(args.target_shape), dtype=args.dtype, shard_size=args.shard_size)
+    print(f"Packed {len(meta['index'])} volumes into {len(meta['shards'])} shards")
+
+
+if __name__ == "__main__":
+    main()